@@ -0,0 +1,165 @@
+"""
+Per-request CPU time of the access check: the Core fast path in
+``middleware/access_control.py`` against the ORM implementation it replaced.
+
+    python -m benchmarks.access_fast_path --iterations 20000
+
+Both variants run in one process against the same SQLite file, alternating in
+rounds so cache and file-system state affect them equally. Each call is the
+whole check (subscription lookup, plan, permission matrix, quota consume,
+service log insert, commit) for a random user, on a fresh session like a
+request gets. CPU time is measured with ``time.process_time`` around each call,
+so it includes SQLite's own work but not time spent waiting for the disk.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import case, func, insert, update
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.harness import QueryCounter, percentile
+from database import Base, create_db_engine
+from middleware.access_control import check_access
+from models import Plan, UserSubscription
+from services import log_store
+from services.permission_matrix import get_permission_matrix
+from services.quota import current_period_epoch, effective_usage
+
+logger = logging.getLogger("benchmarks.access_fast_path")
+
+ENDPOINT = "cloud-service-1"
+PLANS = 3
+
+def legacy_consume_quota(db, plan, subscription):
+    """consume_quota as it was: an ORM UPDATE built for every call"""
+    epoch = current_period_epoch(plan, subscription)
+    usage = case(
+        (func.coalesce(UserSubscription.period_epoch, 0) < epoch, 0),
+        else_=func.coalesce(UserSubscription.usage_count, 0)
+    )
+    row = db.execute(
+        update(UserSubscription)
+        .where(UserSubscription.id == subscription.id, usage < plan.usage_limit)
+        .values(
+            usage_count=usage + 1,
+            period_epoch=func.max(func.coalesce(UserSubscription.period_epoch, 0), epoch)
+        )
+        .returning(UserSubscription.usage_count, UserSubscription.period_epoch)
+        .execution_options(synchronize_session=False)
+    ).first()
+    return row.usage_count if row is not None else None
+
+def legacy_add_log(db, user_id: int, endpoint: str):
+    """log_store.add_log as it was: an INSERT built per call and run through the Session"""
+    timestamp = datetime.utcnow()
+    connection = db.connection()
+    key = log_store.month_key(timestamp)
+    table = log_store.ensure_partition(connection, key)
+    values = {
+        "user_id": user_id, "service_name": endpoint, "endpoint": endpoint, "status": "success",
+        "error_message": None, "service_metadata": None, "timestamp": timestamp,
+    }
+    db.execute(insert(table), log_store._encode(connection, values))
+
+async def legacy_check(db, user_id: int):
+    """The ORM body of check_access before the fast path, minus the HTTP plumbing"""
+    logger.info(f"Checking access for user {user_id} to endpoint {ENDPOINT}")
+    subscription = db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
+    if not subscription or not subscription.plan:
+        raise LookupError(user_id)
+    logger.info(f"User {user_id} has plan: {subscription.plan.name}")
+    if not get_permission_matrix(db).allows(subscription.plan_id, ENDPOINT, ENDPOINT):
+        raise PermissionError(user_id)
+    logger.info(f"Current usage: {effective_usage(subscription.plan, subscription)}/{subscription.plan.usage_limit}")
+    if legacy_consume_quota(db, subscription.plan, subscription) is None:
+        raise PermissionError(user_id)
+    legacy_add_log(db, user_id, ENDPOINT)
+    db.commit()
+
+@check_access(ENDPOINT)
+async def fast_check(user_id: int, db=None):
+    return None
+
+VARIANTS = {
+    "orm": lambda db, user_id: legacy_check(db, user_id),
+    "core": lambda db, user_id: fast_check(user_id=user_id, db=db),
+}
+
+def seed(engine, users: int):
+    Base.metadata.create_all(bind=engine)
+    log_store.prepare_partitions(engine)
+    with engine.begin() as connection:
+        connection.execute(Plan.__table__.insert(), [
+            {"id": plan_id, "name": f"Plan {plan_id}", "description": "benchmark", "usage_limit": 10**12}
+            for plan_id in range(1, PLANS + 1)
+        ])
+        connection.execute(UserSubscription.__table__.insert(), [
+            {"user_id": user_id, "plan_id": user_id % PLANS + 1, "start_date": datetime.utcnow(), "usage_count": 0}
+            for user_id in range(1, users + 1)
+        ])
+
+async def run_round(Session, variant: str, iterations: int, users: int, rng: random.Random, samples: dict):
+    call = VARIANTS[variant]
+    for _ in range(iterations):
+        db = Session()
+        user_id = rng.randint(1, users)
+        started_cpu = time.process_time()
+        started = time.perf_counter()
+        try:
+            await call(db, user_id)
+        finally:
+            db.close()
+        samples[variant]["cpu"].append(time.process_time() - started_cpu)
+        samples[variant]["wall"].append(time.perf_counter() - started)
+
+async def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}", args.profile)
+        seed(engine, args.users)
+        Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        rng = random.Random(7)
+        samples = {variant: {"cpu": [], "wall": [], "queries": 0} for variant in VARIANTS}
+        warmup = {variant: {"cpu": [], "wall": [], "queries": 0} for variant in VARIANTS}
+        for variant in VARIANTS:
+            await run_round(Session, variant, 200, args.users, rng, warmup)
+
+        per_round = max(args.iterations // args.rounds, 1)
+        for _ in range(args.rounds):
+            for variant in VARIANTS:
+                with QueryCounter(engine) as counter:
+                    await run_round(Session, variant, per_round, args.users, rng, samples)
+                samples[variant]["queries"] += counter.count
+        engine.dispose()
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20_000, help="calls per variant")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--profile", default="production", help="SQLite profile")
+    args = parser.parse_args()
+
+    # Per-request INFO logging would otherwise dominate every measurement
+    logging.getLogger().setLevel(logging.WARNING)
+    samples = asyncio.run(run(args))
+
+    print(f"{'variant':>8} {'cpu mean':>10} {'cpu p50':>9} {'cpu p99':>9} {'wall p50':>9} {'queries':>8}")
+    for variant, result in samples.items():
+        cpu = sorted(result["cpu"])
+        wall = sorted(result["wall"])
+        print(f"{variant:>8} {statistics.fmean(cpu) * 1e6:8.1f}us {percentile(cpu, 0.5) * 1e6:7.1f}us "
+              f"{percentile(cpu, 0.99) * 1e6:7.1f}us {percentile(wall, 0.5) * 1e6:7.1f}us "
+              f"{result['queries'] / len(cpu):8.2f}")
+    orm, core = (statistics.fmean(samples[variant]["cpu"]) for variant in ("orm", "core"))
+    print(f"core fast path uses {core / orm:.0%} of the ORM path's CPU per request ({orm / core:.2f}x faster)")
+
+if __name__ == "__main__":
+    main()
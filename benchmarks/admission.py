@@ -0,0 +1,144 @@
+"""
+Access-check latency while log reads flood the service, with and without
+admission control (middleware/admission.py).
+
+    python -m benchmarks.admission --flood-clients 1 8 32 --check
+
+``--access-clients`` clients call GET /api/access/{user}/{service} back to back
+for ``--duration`` seconds per phase. The first phase has nothing else
+running. Each later phase adds a flood of clients scanning
+GET /api/services/logs, for every ``--flood-clients`` count, once with
+admission control switched off and once with the configured limits, except
+that the reads class is held to ``--reads-limit`` so the floods exceed it.
+
+Every scan costs CPU in the same process, so even one concurrent scan moves
+the access-check latency, and more so on a single core. What admission control
+has to guarantee is that a bigger flood does not move it further. ``--check``
+exits 1 when, with admission control, the access-check p99 under the largest
+flood exceeds ``--max-ratio`` times the p99 under the smallest.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+from benchmarks.harness import SERVICES, load_app, seed_database, percentile
+
+async def run_phase(client, users: int, duration: float, access_clients: int, flood_clients: int) -> dict:
+    access_latencies = []
+    read_latencies = []
+    read_statuses = Counter()
+    access_errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def access_client(seed: int):
+        nonlocal access_errors
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = await client.get(f"/api/access/{rng.randint(1, users)}/{rng.choice(SERVICES)}")
+            # Without limits a big flood can hold every pooled connection
+            access_errors += response.status_code != 200
+            access_latencies.append(time.perf_counter() - started)
+
+    async def flood_client():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = await client.get("/api/services/logs")
+            read_statuses[response.status_code] += 1
+            if response.status_code == 200:
+                read_latencies.append(time.perf_counter() - started)
+            else:
+                # A shed client backs off as Retry-After asks, within the phase
+                await asyncio.sleep(min(float(response.headers.get("retry-after", 1)), 0.05))
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(access_client(seed) for seed in range(access_clients)),
+        *(flood_client() for _ in range(flood_clients))
+    )
+    elapsed = time.perf_counter() - started
+    access_latencies.sort()
+    read_latencies.sort()
+    return {
+        "access_rps": len(access_latencies) / elapsed,
+        "access_p50_ms": percentile(access_latencies, 0.50) * 1000,
+        "access_p99_ms": percentile(access_latencies, 0.99) * 1000,
+        "access_errors": access_errors,
+        "reads_ok": read_statuses[200],
+        "reads_shed": read_statuses[503],
+        "reads_p99_ms": percentile(read_latencies, 0.99) * 1000,
+    }
+
+async def run(args) -> dict:
+    from middleware import admission
+    import main
+
+    configured = dict(admission.limiters)
+    phases = [("baseline", 0, False)]
+    for flood_clients in args.flood_clients:
+        phases += [(f"flood {flood_clients}, unlimited", flood_clients, False),
+                   (f"flood {flood_clients}, admission", flood_clients, True)]
+    results = {}
+    # Answer 500 for an endpoint that raises, as a server would, instead of raising here
+    transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for name, flood_clients, limited in phases:
+            admission.limiters.clear()
+            if limited:
+                admission.limiters.update(admission.build_limiters())
+            results[name] = await run_phase(client, args.users, args.duration, args.access_clients, flood_clients)
+            results[name]["limits"] = {key: limiter.snapshot() for key, limiter in admission.limiters.items()}
+    admission.limiters.clear()
+    admission.limiters.update(configured)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--logs", type=int, default=20_000)
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per phase")
+    parser.add_argument("--access-clients", type=int, default=4)
+    parser.add_argument("--flood-clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--reads-limit", type=int, default=1, help="Concurrent log reads admitted (default 1)")
+    parser.add_argument("--check", action="store_true", help="Exit 1 if a bigger flood moves the access-check p99")
+    parser.add_argument("--max-ratio", type=float, default=2.0,
+                        help="Allowed p99 under the largest flood / p99 under the smallest (default 2)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        load_app(f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        from config import get_settings
+        settings = get_settings()
+        settings.ADMISSION_LIMITS = {**settings.ADMISSION_LIMITS, "reads": args.reads_limit}
+        print(f"Seeding {args.users} users and {args.logs} service logs...", file=sys.stderr)
+        seed_database(args.users, args.logs)
+        results = asyncio.run(run(args))
+
+        from database import engine
+        engine.dispose()
+
+    print(f"{'phase':<22}{'access/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'err':>6}{'reads ok':>10}{'shed':>7}{'read p99':>11}{'reads limit':>13}")
+    for name, r in results.items():
+        reads_limit = r["limits"].get("reads", {}).get("limit", "-")
+        print(
+            f"{name:<22}{r['access_rps']:>9.0f}{r['access_p50_ms']:>10.1f}{r['access_p99_ms']:>10.1f}{r['access_errors']:>6}"
+            f"{r['reads_ok']:>10}{r['reads_shed']:>7}{r['reads_p99_ms']:>11.1f}{reads_limit:>13}"
+        )
+
+    smallest, largest = min(args.flood_clients), max(args.flood_clients)
+    ratio = (results[f"flood {largest}, admission"]["access_p99_ms"]
+             / max(results[f"flood {smallest}, admission"]["access_p99_ms"], 1e-9))
+    print(f"access-check p99 with admission control, {largest} flood clients vs {smallest}: {ratio:.2f}x")
+    if args.check and ratio > args.max_ratio:
+        print(f"REGRESSION: more than {args.max_ratio}x", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
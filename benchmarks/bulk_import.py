@@ -0,0 +1,62 @@
+"""
+Bulk subscription import against one POST /subscriptions call per row.
+
+    python -m benchmarks.bulk_import --rows 100000
+
+Imports ``--rows`` subscriptions through POST /api/subscriptions/bulk, flips
+them all inactive through PUT /api/subscriptions/bulk, and times a sample of
+single-row creates to extrapolate what the same import costs row by row.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.harness import load_app, seed_database, asgi_client, QueryCounter
+
+async def run(args):
+    app = load_app(args.database_url)
+    seed_database(users=0, logs=0, plans=3)
+    from database import engine
+
+    async with asgi_client(app) as client:
+        rows = [{"user_id": user_id, "plan_id": user_id % 3 + 1} for user_id in range(1, args.rows + 1)]
+        with QueryCounter(engine) as counter:
+            started = time.perf_counter()
+            response = await client.post("/api/subscriptions/bulk", json={"subscriptions": rows}, timeout=None)
+            create_elapsed = time.perf_counter() - started
+        result = response.json()
+        print(f"bulk create: {args.rows} rows in {create_elapsed:.2f}s "
+              f"({result['created']} created, {len(result['errors'])} errors, {counter.count} statements)")
+
+        updates = [{"id": subscription_id, "is_active": False} for subscription_id in range(1, args.rows + 1)]
+        with QueryCounter(engine) as counter:
+            started = time.perf_counter()
+            response = await client.put("/api/subscriptions/bulk", json={"subscriptions": updates}, timeout=None)
+            update_elapsed = time.perf_counter() - started
+        result = response.json()
+        print(f"bulk update: {args.rows} rows in {update_elapsed:.2f}s "
+              f"({result['updated']} updated, {len(result['errors'])} errors, {counter.count} statements)")
+
+        started = time.perf_counter()
+        for user_id in range(args.rows + 1, args.rows + args.single_sample + 1):
+            await client.post("/api/subscriptions", json={"user_id": user_id, "plan_id": 1})
+        per_row = (time.perf_counter() - started) / args.single_sample
+        print(f"single rows: {per_row * 1000:.2f}ms each, ~{per_row * args.rows:.0f}s for {args.rows} rows "
+              f"({per_row * args.rows / create_elapsed:.0f}x the bulk import)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--single-sample", type=int, default=500, help="single-row creates timed for comparison")
+    parser.add_argument("--database-url", default=None, help="defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.database_url is None:
+            args.database_url = f"sqlite:///{os.path.join(directory, 'bulk_import.db')}"
+        asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Shared plumbing for the benchmark scripts: a seeded database, the FastAPI app
+with fake cloud clients, an in-process ASGI client and latency statistics.
+
+``main`` drops and recreates every table when it is imported, so the app must
+be loaded (``load_app``) before the database is seeded (``seed_database``).
+"""
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import event
+
+SERVICES = [f"cloud-service-{n}" for n in range(1, 7)]
+SEED_BATCH_SIZE = 50_000
+
+# Schema lookups, such as the periodic refresh of the log partition catalog
+_CATALOG_QUERY = re.compile(r"\b(sqlite_master|sqlite_schema|information_schema|pg_catalog)\b|^\s*PRAGMA\b", re.I)
+
+def load_app(database_url: str, fake_latency: bool = False):
+    """
+    Import the app against ``database_url`` with the cloud clients replaced by
+    the fakes in services/fake_clients.py. Unless ``fake_latency`` is set the
+    fakes answer instantly and never fail, so only this service is measured.
+    """
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.pop("DATABASE_READ_REPLICA_URL", None)
+
+    import logging
+    import main
+    import routers.cloud_services as cloud_services
+    from services import fake_clients
+
+    # Per-request INFO logging would otherwise dominate every measurement
+    logging.getLogger().setLevel(logging.WARNING)
+    if not fake_latency:
+        fake_clients.configure(latency_ms=0, jitter_ms=0, error_rate=0)
+    for name in ("stripe", "es_client", "redis_client", "get_s3_client", "get_auth0_token", "get_rabbitmq_channel"):
+        setattr(cloud_services, name, getattr(fake_clients, name))
+    return main.app
+
+def seed_database(users: int, logs: int, plans: int = 3, seed: int = 42):
+    """Bulk insert plans, one active subscription per user and ``logs`` service log rows"""
+    from database import engine
+    from models import Plan, UserSubscription
+    from services.log_store import insert_logs
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        connection.execute(Plan.__table__.insert(), [
+            {"id": plan_id, "name": f"Plan {plan_id}", "description": "benchmark", "usage_limit": 10**12}
+            for plan_id in range(1, plans + 1)
+        ])
+        for start in range(1, users + 1, SEED_BATCH_SIZE):
+            connection.execute(UserSubscription.__table__.insert(), [
+                {
+                    "user_id": user_id,
+                    "plan_id": (user_id % plans) + 1,
+                    "start_date": now,
+                    "is_active": True,
+                    "usage_count": 0,
+                }
+                for user_id in range(start, min(start + SEED_BATCH_SIZE, users + 1))
+            ])
+        for start in range(0, logs, SEED_BATCH_SIZE):
+            batch = []
+            for _ in range(min(SEED_BATCH_SIZE, logs - start)):
+                service = rng.choice(SERVICES)
+                batch.append({
+                    "user_id": rng.randint(1, users),
+                    "service_name": service,
+                    "endpoint": service,
+                    "status": "success",
+                    "timestamp": now - timedelta(seconds=rng.randint(0, 90 * 86400)),
+                })
+            insert_logs(connection, batch)
+
+def asgi_client(app) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark")
+
+class QueryCounter:
+    """
+    Counts SQL statements sent through an engine. Catalog queries are counted
+    apart: they run on a timer, so how many land in a run is not a property of
+    the code being measured.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.catalog_count = 0
+
+    def _before_cursor_execute(self, conn, cursor, statement, *args, **kwargs):
+        if _CATALOG_QUERY.search(statement):
+            self.catalog_count += 1
+        else:
+            self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+
+def percentile(sorted_samples: list, fraction: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+def summarize(latencies: list, elapsed: float, queries: int) -> dict:
+    """Throughput, latency percentiles (ms) and queries per operation for one benchmark case"""
+    ordered = sorted(latencies)
+    return {
+        "iterations": len(ordered),
+        "ops_per_sec": len(ordered) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(ordered, 0.50) * 1000,
+        "p95_ms": percentile(ordered, 0.95) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+        "queries_per_request": queries / len(ordered) if ordered else 0.0,
+    }
+
+@contextmanager
+def stopwatch(samples: list):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        samples.append(time.perf_counter() - started)
@@ -0,0 +1,179 @@
+"""
+Micro-benchmarks for the request hot paths.
+
+    python -m benchmarks.hot_paths --preset quick                  # run and print
+    python -m benchmarks.hot_paths --preset quick --check          # fail on regressions
+    python -m benchmarks.hot_paths --preset full --save-baseline   # 100k users, 10M logs
+
+Each case reports ops/sec, p50/p95/p99 latency and SQL statements per request.
+Baselines live in benchmarks/baselines.json, keyed by preset. ``--check`` exits
+non-zero when a case is slower than its baseline by more than ``--threshold``
+or issues more queries per request. Catalog queries are not counted, since the
+log partition catalog is refreshed on a timer rather than per request.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import (
+    SERVICES, load_app, seed_database, asgi_client, QueryCounter, summarize, stopwatch
+)
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+PRESETS = {
+    "quick": {"users": 1_000, "logs": 20_000, "iterations": 500, "scan_iterations": 20},
+    "full": {"users": 100_000, "logs": 10_000_000, "iterations": 5_000, "scan_iterations": 3},
+}
+
+async def run_case(name: str, operation, iterations: int, engine) -> dict:
+    latencies = []
+    # One untimed call to warm connection pools and statement caches
+    await operation()
+    with QueryCounter(engine) as counter:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            with stopwatch(latencies):
+                await operation()
+        elapsed = time.perf_counter() - started
+    return {"case": name, **summarize(latencies, elapsed, counter.count)}
+
+async def run_benchmarks(preset: dict, cases: list) -> list:
+    from database import engine, SessionLocal
+    from services.usage_tracker import increment_usage
+    from utils.service_logger import log_service_call
+    import main
+
+    rng = random.Random(7)
+    users = preset["users"]
+    results = []
+
+    async with asgi_client(main.app) as client:
+        async def check_access():
+            response = await client.get(f"/api/{rng.choice(SERVICES)}", params={"user_id": rng.randint(1, users)})
+            assert response.status_code == 200, response.text
+
+        async def access_endpoint():
+            response = await client.get(f"/api/access/{rng.randint(1, users)}/cloud-service-1")
+            assert response.status_code == 200, response.text
+
+        async def increment_usage_call():
+            db = SessionLocal()
+            try:
+                increment_usage(rng.randint(1, users), "cloud-service-1", db)
+            finally:
+                db.close()
+
+        async def log_service_call_call():
+            db = SessionLocal()
+            try:
+                await log_service_call(
+                    db, rng.randint(1, users), "cloud-service-1", "cloud-service-1", "success",
+                    service_metadata={"benchmark": True}
+                )
+            finally:
+                db.close()
+
+        async def user_logs():
+            response = await client.get(f"/api/admin/logs/services/{rng.randint(1, users)}")
+            assert response.status_code == 200, response.text
+
+        async def service_logs():
+            response = await client.get(f"/api/{rng.choice(SERVICES)}/logs")
+            assert response.status_code == 200, response.text
+
+        operations = {
+            "check_access": (check_access, preset["iterations"]),
+            "access_endpoint": (access_endpoint, preset["iterations"]),
+            "increment_usage": (increment_usage_call, preset["iterations"]),
+            "log_service_call": (log_service_call_call, preset["iterations"]),
+            "user_logs": (user_logs, preset["iterations"]),
+            "service_logs": (service_logs, preset["scan_iterations"]),
+        }
+        for name in cases:
+            operation, iterations = operations[name]
+            results.append(await run_case(name, operation, iterations, engine))
+    return results
+
+def compare(results: list, baseline: dict, threshold: float) -> list:
+    """Human readable descriptions of every regression against the stored baseline"""
+    regressions = []
+    for result in results:
+        reference = baseline.get(result["case"])
+        if not reference:
+            continue
+        if result["p95_ms"] > reference["p95_ms"] * (1 + threshold):
+            regressions.append(f"{result['case']}: p95 {result['p95_ms']:.2f}ms vs baseline {reference['p95_ms']:.2f}ms")
+        if result["ops_per_sec"] < reference["ops_per_sec"] * (1 - threshold):
+            regressions.append(f"{result['case']}: {result['ops_per_sec']:.0f} ops/s vs baseline {reference['ops_per_sec']:.0f} ops/s")
+        if result["queries_per_request"] > reference["queries_per_request"] + 1e-9:
+            regressions.append(
+                f"{result['case']}: {result['queries_per_request']:.2f} queries/request "
+                f"vs baseline {reference['queries_per_request']:.2f}"
+            )
+    return regressions
+
+def load_baselines() -> dict:
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=PRESETS, default="quick")
+    parser.add_argument("--cases", nargs="+", default=None, help="Subset of cases to run")
+    parser.add_argument("--users", type=int, help="Override the preset's user count")
+    parser.add_argument("--logs", type=int, help="Override the preset's service log row count")
+    parser.add_argument("--check", action="store_true", help="Exit 1 on regressions against the baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative slowdown (default 0.25)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the preset's baseline")
+    args = parser.parse_args()
+
+    preset = dict(PRESETS[args.preset])
+    if args.users:
+        preset["users"] = args.users
+    if args.logs is not None:
+        preset["logs"] = args.logs
+    cases = args.cases or ["check_access", "access_endpoint", "increment_usage", "log_service_call", "user_logs", "service_logs"]
+
+    with tempfile.TemporaryDirectory() as directory:
+        load_app(f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        print(f"Seeding {preset['users']} users and {preset['logs']} service logs...", file=sys.stderr)
+        seed_database(preset["users"], preset["logs"])
+        results = asyncio.run(run_benchmarks(preset, cases))
+
+        from database import engine
+        engine.dispose()
+
+    print(f"{'case':<18}{'iters':>7}{'ops/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'q/req':>7}")
+    for r in results:
+        print(
+            f"{r['case']:<18}{r['iterations']:>7}{r['ops_per_sec']:>10.0f}{r['p50_ms']:>9.2f}"
+            f"{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['queries_per_request']:>7.2f}"
+        )
+
+    baselines = load_baselines()
+    if args.save_baseline:
+        baselines[args.preset] = {
+            r["case"]: {key: round(value, 4) for key, value in r.items() if key not in ("case", "iterations")}
+            for r in results
+        }
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline for preset '{args.preset}'")
+
+    if args.check:
+        regressions = compare(results, baselines.get(args.preset, {}), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
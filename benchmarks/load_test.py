@@ -0,0 +1,211 @@
+"""
+End-to-end load test: replays a weighted traffic mix across users and plans at
+increasing concurrency and reports throughput and tail latency per route.
+
+Against a running server (start it with the in-process fake cloud backends):
+
+    CLOUD_BACKEND_MODE=fake FAKE_BACKEND_LATENCY_MS=20 uvicorn main:app --workers 4
+    python -m benchmarks.load_test --base-url http://localhost:8000 --concurrency 1 4 16 64 128
+
+Without --base-url the app is loaded in this process on a temporary database,
+which measures a single worker without any network hop.
+
+Requests answered with 429 (quota exhausted) or 503 (shed by admission
+control) are counted as rejections, not errors. The saturation point is the last concurrency step that still raised
+total throughput by at least --saturation-gain.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+import httpx
+
+from benchmarks.harness import percentile
+
+# name: (weight, request builder taking a user id)
+TRAFFIC_MIX = {
+    "GET /access/{user_id}/{api_request}": (30, lambda u: ("GET", f"/api/access/{u}/cloud-service-1", {})),
+    "GET /cloud-service-1": (4, lambda u: ("GET", "/api/cloud-service-1", {"params": {"user_id": u}})),
+    "POST /cloud-service-1/payment": (5, lambda u: ("POST", "/api/cloud-service-1/payment", {"params": {"user_id": u}})),
+    "GET /cloud-service-2/auth": (5, lambda u: ("GET", "/api/cloud-service-2/auth", {"params": {"user_id": u}})),
+    "GET /cloud-service-3": (4, lambda u: ("GET", "/api/cloud-service-3", {"params": {"user_id": u}})),
+    "POST /cloud-service-3/storage": (5, lambda u: (
+        "POST", "/api/cloud-service-3/storage",
+        {"params": {"user_id": u}, "files": {"file": ("load.txt", b"x" * 1024, "text/plain")}}
+    )),
+    "GET /cloud-service-4/search": (10, lambda u: (
+        "GET", "/api/cloud-service-4/search", {"params": {"user_id": u, "query": "load"}}
+    )),
+    "POST /cloud-service-5/queue": (5, lambda u: (
+        "POST", "/api/cloud-service-5/queue", {"params": {"user_id": u, "message": "load"}}
+    )),
+    "GET /cloud-service-6/cache/{key}": (10, lambda u: (
+        "GET", f"/api/cloud-service-6/cache/user-{u}", {"params": {"user_id": u}}
+    )),
+    "POST /cloud-service-6/cache": (5, lambda u: (
+        "POST", "/api/cloud-service-6/cache", {"params": {"user_id": u, "key": f"user-{u}", "value": "cached"}}
+    )),
+    "GET /subscriptions/{user_id}/usage": (4, lambda u: ("GET", f"/api/subscriptions/{u}/usage", {})),
+    "GET /admin/logs/services/{user_id}": (1, lambda u: ("GET", f"/api/admin/logs/services/{u}", {})),
+}
+
+async def setup_tenants(client: httpx.AsyncClient, users: list, plan_limits: list) -> None:
+    """Create one plan per usage limit and spread the users across them"""
+    run_id = uuid.uuid4().hex[:8]
+    plan_ids = []
+    for index, limit in enumerate(plan_limits):
+        response = await client.post("/api/plans", json={
+            "name": f"load-{run_id}-{index}",
+            "description": "load test plan",
+            "usage_limit": limit,
+        })
+        response.raise_for_status()
+        plan_ids.append(response.json()["id"])
+
+    # Stay below the connection pool size so setup never waits on a pool checkout
+    semaphore = asyncio.Semaphore(4)
+
+    async def subscribe(index: int, user_id: int):
+        async with semaphore:
+            await client.post("/api/subscriptions", json={
+                "user_id": user_id,
+                "plan_id": plan_ids[index % len(plan_ids)],
+            })
+
+    await asyncio.gather(*(subscribe(index, user_id) for index, user_id in enumerate(users)))
+
+async def run_step(client: httpx.AsyncClient, concurrency: int, duration: float, users: list, mix: dict, seed: int) -> dict:
+    names = list(mix)
+    weights = [mix[name][0] for name in names]
+    latencies = defaultdict(list)
+    outcomes = defaultdict(lambda: {"ok": 0, "rejected": 0, "errors": 0})
+    deadline = time.perf_counter() + duration
+
+    async def worker(worker_id: int):
+        rng = random.Random(seed * 1000 + worker_id)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            method, url, kwargs = mix[name][1](rng.choice(users))
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = None
+            latencies[name].append(time.perf_counter() - started)
+            if status is not None and status < 400:
+                outcomes[name]["ok"] += 1
+            elif status in (429, 503):
+                outcomes[name]["rejected"] += 1
+            else:
+                outcomes[name]["errors"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for name, samples in latencies.items():
+        ordered = sorted(samples)
+        routes[name] = {
+            "requests": len(ordered),
+            "rps": len(ordered) / elapsed,
+            "p50_ms": percentile(ordered, 0.50) * 1000,
+            "p95_ms": percentile(ordered, 0.95) * 1000,
+            "p99_ms": percentile(ordered, 0.99) * 1000,
+            **outcomes[name],
+        }
+    everything = sorted(sample for samples in latencies.values() for sample in samples)
+    return {
+        "concurrency": concurrency,
+        "rps": len(everything) / elapsed,
+        "p50_ms": percentile(everything, 0.50) * 1000,
+        "p99_ms": percentile(everything, 0.99) * 1000,
+        "errors": sum(outcome["errors"] for outcome in outcomes.values()),
+        "routes": routes,
+    }
+
+def print_step(step: dict) -> None:
+    print(f"\n=== concurrency {step['concurrency']}: {step['rps']:.0f} req/s, "
+          f"p50 {step['p50_ms']:.1f}ms, p99 {step['p99_ms']:.1f}ms, errors {step['errors']}")
+    print(f"{'route':<38}{'reqs':>7}{'rps':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'rej':>6}{'err':>6}")
+    for name, route in sorted(step["routes"].items()):
+        print(
+            f"{name:<38}{route['requests']:>7}{route['rps']:>8.1f}{route['p50_ms']:>8.1f}"
+            f"{route['p95_ms']:>8.1f}{route['p99_ms']:>8.1f}{route['rejected']:>6}{route['errors']:>6}"
+        )
+
+def find_saturation(steps: list, min_gain: float):
+    """The last step whose throughput beat every earlier step by at least ``min_gain``"""
+    best = None
+    for step in steps:
+        if best is None or step["rps"] >= best["rps"] * (1 + min_gain):
+            best = step
+    return best
+
+async def run(args) -> list:
+    if args.base_url:
+        return await run_steps(args, httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout))
+
+    from benchmarks.harness import load_app
+    with tempfile.TemporaryDirectory() as directory:
+        app = load_app(f"sqlite:///{os.path.join(directory, 'load_test.db')}", fake_latency=True)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load-test", timeout=args.timeout)
+        try:
+            return await run_steps(args, client)
+        finally:
+            from database import engine
+            engine.dispose()
+
+async def run_steps(args, client) -> list:
+    users = list(range(args.first_user_id, args.first_user_id + args.users))
+    steps = []
+    async with client:
+        print(f"Creating {len(args.plan_limits)} plans and {len(users)} subscriptions...", file=sys.stderr)
+        await setup_tenants(client, users, args.plan_limits)
+        for concurrency in args.concurrency:
+            if args.warmup:
+                await run_step(client, concurrency, args.warmup, users, TRAFFIC_MIX, seed=0)
+            step = await run_step(client, concurrency, args.duration, users, TRAFFIC_MIX, seed=concurrency)
+            print_step(step)
+            steps.append(step)
+    return steps
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="Server to load; omit to run the app in-process")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--duration", type=float, default=15.0, help="Seconds measured per concurrency step")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds before each step")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--first-user-id", type=int, default=random.randint(1, 10**6) * 1000)
+    parser.add_argument("--plan-limits", type=int, nargs="+", default=[10**9, 100_000, 500])
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--saturation-gain", type=float, default=0.05)
+    parser.add_argument("--json", help="Also write every step to this file")
+    args = parser.parse_args()
+
+    steps = asyncio.run(run(args))
+
+    print("\n=== summary")
+    print(f"{'concurrency':>12}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for step in steps:
+        print(f"{step['concurrency']:>12}{step['rps']:>10.0f}{step['p50_ms']:>9.1f}{step['p99_ms']:>9.1f}{step['errors']:>8}")
+    saturation = find_saturation(steps, args.saturation_gain)
+    if saturation:
+        print(f"Saturation at concurrency {saturation['concurrency']}: "
+              f"{saturation['rps']:.0f} req/s, p99 {saturation['p99_ms']:.1f}ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(steps, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Storage size and scan speed of dictionary-encoded service log partitions
+against the plain-string layout they replaced.
+
+    python -m benchmarks.log_encoding --rows 10000000
+
+Loads the same ``--rows`` synthetic logs, spread over three months, into two
+SQLite files: one with the old partition layout (string service_name, endpoint
+and status, text timestamps and JSON metadata) and one through
+``services.log_store``. Then it reports the file size and times three reads on
+each: a full scan counting rows per service, an indexed count for one service
+over 30 days, and fetching one service's rows for a single day.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, func, select, union_all
+
+from database import create_db_engine
+from services import log_store
+
+SERVICES = [f"cloud-service-{n}" for n in range(1, 7)]
+STATUSES = ["success"] * 19 + ["error"]
+BATCH_SIZE = 50_000
+DAYS = 90
+
+def legacy_partition(metadata: MetaData, key: int) -> Table:
+    """A partition as it was laid out before dictionary encoding"""
+    name = f"{log_store.TABLE_PREFIX}_{key}"
+    return Table(
+        name, metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer, nullable=False),
+        Column("service_name", String, nullable=False),
+        Column("endpoint", String, nullable=False),
+        Column("status", String, nullable=False),
+        Column("error_message", String, nullable=True),
+        Column("service_metadata", String, nullable=True),
+        Column("timestamp", DateTime, nullable=False),
+        Index(f"ix_{name}_user_id_timestamp", "user_id", "timestamp"),
+        Index(f"ix_{name}_service_name_timestamp", "service_name", "timestamp"),
+    )
+
+def generate(rows: int, now: datetime, seed: int = 7):
+    """Batches of log dicts, each with metadata and sorted by time like real traffic"""
+    rng = random.Random(seed)
+    start = now - timedelta(days=DAYS)
+    step = DAYS * 86400 / rows
+    for offset in range(0, rows, BATCH_SIZE):
+        batch = []
+        for n in range(offset, min(offset + BATCH_SIZE, rows)):
+            service = rng.choice(SERVICES)
+            status = rng.choice(STATUSES)
+            batch.append({
+                "user_id": rng.randint(1, 100_000),
+                "service_name": service,
+                "endpoint": f"{service}/logs",
+                "status": status,
+                "error_message": "upstream timeout" if status == "error" else None,
+                "service_metadata": json.dumps({"region": "us-east-1", "latency_ms": rng.randint(5, 500)}),
+                "timestamp": start + timedelta(seconds=n * step),
+            })
+        yield batch
+
+def load_legacy(engine, rows: int, now: datetime) -> dict:
+    metadata = MetaData()
+    tables = {}
+    for batch in generate(rows, now):
+        grouped = {}
+        for row in batch:
+            grouped.setdefault(log_store.month_key(row["timestamp"]), []).append(row)
+        with engine.begin() as connection:
+            for key, group in grouped.items():
+                if key not in tables:
+                    tables[key] = legacy_partition(metadata, key)
+                    tables[key].create(connection)
+                connection.execute(tables[key].insert(), group)
+    return tables
+
+def load_encoded(engine, rows: int, now: datetime):
+    for batch in generate(rows, now):
+        with engine.begin() as connection:
+            log_store.insert_logs(connection, batch)
+
+def file_size(engine, path: str) -> int:
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(path)
+
+def timed(func, repeat: int = 3) -> tuple:
+    """Best of ``repeat`` runs, and the last result"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def legacy_reads(engine, tables: dict, now: datetime) -> dict:
+    def per_service():
+        parts = [select(table.c.service_name) for table in tables.values()]
+        combined = union_all(*parts).subquery()
+        with engine.connect() as connection:
+            return dict(connection.execute(
+                select(combined.c.service_name, func.count()).group_by(combined.c.service_name)
+            ).all())
+
+    def service_month():
+        total = 0
+        with engine.connect() as connection:
+            for table in tables.values():
+                total += connection.execute(select(func.count()).select_from(table).where(
+                    table.c.service_name == SERVICES[0], table.c.timestamp >= now - timedelta(days=30)
+                )).scalar()
+        return total
+
+    def service_day():
+        start = now - timedelta(days=2)
+        with engine.connect() as connection:
+            return sum(
+                len(connection.execute(select(table).where(
+                    table.c.service_name == SERVICES[0], table.c.timestamp >= start,
+                    table.c.timestamp < start + timedelta(days=1)
+                ).order_by(table.c.timestamp)).all())
+                for table in tables.values()
+            )
+
+    return {"full scan": timed(per_service), "30-day count": timed(service_month), "1-day fetch": timed(service_day)}
+
+def encoded_reads(engine, now: datetime) -> dict:
+    keys = log_store.partitions.keys(engine, refresh=True)
+
+    def per_service():
+        with engine.connect() as connection:
+            parts = [select(log_store.partition_table(key).c.service_id) for key in keys]
+            combined = union_all(*parts).subquery()
+            counts = connection.execute(
+                select(combined.c.service_id, func.count()).group_by(combined.c.service_id)
+            ).all()
+            names = log_store.dictionary.values(connection, {service_id for service_id, _ in counts})
+            return {names[service_id]: count for service_id, count in counts}
+
+    def service_month():
+        total = 0
+        with engine.connect() as connection:
+            service_id = log_store.dictionary.lookup(connection, SERVICES[0])
+            for key in keys:
+                table = log_store.partition_table(key)
+                total += connection.execute(select(func.count()).select_from(table).where(
+                    table.c.service_id == service_id, table.c.timestamp >= now - timedelta(days=30)
+                )).scalar()
+        return total
+
+    def service_day():
+        start = now - timedelta(days=2)
+        with engine.connect() as connection:
+            return len(log_store.query_logs(
+                connection, service_name=SERVICES[0], start=start, end=start + timedelta(days=1)
+            ))
+
+    return {"full scan": timed(per_service), "30-day count": timed(service_month), "1-day fetch": timed(service_day)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--directory", default=None, help="where to keep the two database files (default: a temp dir)")
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = args.directory or scratch
+        results = {}
+        for layout in ("legacy", "encoded"):
+            path = os.path.join(directory, f"log_encoding_{layout}.db")
+            if os.path.exists(path):
+                os.remove(path)
+            engine = create_db_engine(f"sqlite:///{path}", "default")
+            started = time.perf_counter()
+            if layout == "legacy":
+                tables = load_legacy(engine, args.rows, now)
+            else:
+                load_encoded(engine, args.rows, now)
+            load_elapsed = time.perf_counter() - started
+            size = file_size(engine, path)
+            reads = legacy_reads(engine, tables, now) if layout == "legacy" else encoded_reads(engine, now)
+            results[layout] = (size, load_elapsed, reads)
+            engine.dispose()
+
+            print(f"{layout:>8}: {size / 2**20:8.1f} MiB ({size / args.rows:.1f} bytes/row), "
+                  f"loaded in {load_elapsed:.1f}s")
+            for name, (elapsed, result) in reads.items():
+                rows = sum(result.values()) if isinstance(result, dict) else result
+                print(f"{'':>10}{name:<14}{elapsed * 1000:10.1f} ms  ({rows} rows)")
+
+        legacy, encoded = results["legacy"], results["encoded"]
+        print(f"size: {encoded[0] / legacy[0]:.0%} of legacy")
+        for name in legacy[2]:
+            print(f"{name}: {legacy[2][name][0] / encoded[2][name][0]:.2f}x faster")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Per-request cost of the metrics instrumentation.
+
+    python -m benchmarks.metrics_overhead --iterations 200000
+
+Measures MetricsMiddleware around a no-op ASGI app and the SQLAlchemy cursor
+hooks around ``SELECT 1``, each against an uninstrumented run, and prints the
+difference in microseconds.
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import create_engine, text
+
+from middleware.metrics import MetricsMiddleware
+from utils.metrics import instrument_engine, current_request_stats, RequestStats
+
+class _Route:
+    path = "/api/benchmark/{item_id}"
+
+async def noop_app(scope, receive, send):
+    scope["route"] = _Route
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+async def send(message):
+    pass
+
+async def time_asgi(app, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await app({"type": "http", "method": "GET", "path": "/api/benchmark/1"}, receive, send)
+    return (time.perf_counter() - started) / iterations
+
+def time_queries(engine, iterations: int) -> float:
+    statement = text("SELECT 1")
+    token = current_request_stats.set(RequestStats())
+    try:
+        with engine.connect() as connection:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                connection.execute(statement)
+            return (time.perf_counter() - started) / iterations
+    finally:
+        current_request_stats.reset(token)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200_000)
+    parser.add_argument("--queries-per-request", type=float, default=5.0)
+    args = parser.parse_args()
+
+    bare = asyncio.run(time_asgi(noop_app, args.iterations))
+    instrumented = asyncio.run(time_asgi(MetricsMiddleware(noop_app), args.iterations))
+    middleware_us = (instrumented - bare) * 1e6
+
+    plain_engine = create_engine("sqlite://")
+    hooked_engine = create_engine("sqlite://")
+    instrument_engine(hooked_engine)
+    query_iterations = max(args.iterations // 4, 1)
+    plain = time_queries(plain_engine, query_iterations)
+    hooked = time_queries(hooked_engine, query_iterations)
+    hook_us = (hooked - plain) * 1e6
+
+    print(f"middleware:      {bare * 1e6:7.2f}us -> {instrumented * 1e6:7.2f}us  (+{middleware_us:.2f}us per request)")
+    print(f"cursor hooks:    {plain * 1e6:7.2f}us -> {hooked * 1e6:7.2f}us  (+{hook_us:.2f}us per statement)")
+    print(f"estimated total: +{middleware_us + hook_us * args.queries_per_request:.2f}us per request "
+          f"at {args.queries_per_request:g} statements")
+
+if __name__ == "__main__":
+    main()
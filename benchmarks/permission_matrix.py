@@ -0,0 +1,101 @@
+"""
+Compiled permission matrix against the plan_permissions join it replaces.
+
+    python -m benchmarks.permission_matrix --plans 2000 --permissions 5000
+
+Seeds an in-memory database with many plans, each granted a random subset of
+permissions, then reports how long the matrix takes to build and what one
+authorization check costs through the matrix and through SQL. One permission
+in ten is a wildcard pattern, and the uncached trie lookup is timed on its own
+to show it tracks path depth rather than the number of patterns.
+"""
+import argparse
+import random
+import time
+
+from sqlalchemy import create_engine, select, insert
+from sqlalchemy.orm import sessionmaker
+
+from database import Base
+from models import Plan, Permission, plan_permissions
+from services.permission_matrix import load_permission_matrix
+
+def endpoint_pattern(i: int) -> str:
+    if i % 10 == 0:
+        return f"/api/service-{i % 97}/resource-{i // 10}*/*"
+    return f"/api/service-{i % 97}/resource-{i}"
+
+def seed(session, plans: int, permissions: int, grants_per_plan: int, rng: random.Random):
+    session.execute(insert(Permission), [
+        {"id": i, "name": f"permission-{i}", "endpoint": endpoint_pattern(i), "description": ""}
+        for i in range(1, permissions + 1)
+    ])
+    session.execute(insert(Plan), [
+        {"id": i, "name": f"plan-{i}", "description": "", "usage_limit": 1000}
+        for i in range(1, plans + 1)
+    ])
+    session.execute(insert(plan_permissions), [
+        {"plan_id": plan_id, "permission_id": permission_id}
+        for plan_id in range(1, plans + 1)
+        for permission_id in rng.sample(range(1, permissions + 1), min(grants_per_plan, permissions))
+    ])
+    session.commit()
+
+def sql_allows(session, plan_id: int, endpoint: str) -> bool:
+    statement = (
+        select(Permission.id)
+        .join(plan_permissions, plan_permissions.c.permission_id == Permission.id)
+        .where(plan_permissions.c.plan_id == plan_id, Permission.endpoint == endpoint)
+        .limit(1)
+    )
+    return session.execute(statement).first() is not None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plans", type=int, default=2000)
+    parser.add_argument("--permissions", type=int, default=5000)
+    parser.add_argument("--grants-per-plan", type=int, default=50)
+    parser.add_argument("--checks", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    seed(session, args.plans, args.permissions, args.grants_per_plan, rng)
+
+    started = time.perf_counter()
+    matrix = load_permission_matrix(session)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    endpoints = [f"service-{i % 97}/resource-{i}" for i in range(1, args.permissions + 1)]
+    queries = [(rng.randint(1, args.plans), rng.choice(endpoints)) for _ in range(1000)]
+
+    started = time.perf_counter()
+    for i in range(args.checks):
+        plan_id, endpoint = queries[i % 1000]
+        matrix.allows(plan_id, endpoint)
+    matrix_ns = (time.perf_counter() - started) / args.checks * 1e9
+
+    trie_checks = max(args.checks // 10, 1)
+    started = time.perf_counter()
+    for i in range(trie_checks):
+        matrix.trie.match(queries[i % 1000][1])
+    trie_ns = (time.perf_counter() - started) / trie_checks * 1e9
+
+    sql_checks = max(args.checks // 100, 1)
+    started = time.perf_counter()
+    for i in range(sql_checks):
+        plan_id, endpoint = queries[i % 1000]
+        sql_allows(session, plan_id, "/api/" + endpoint)
+    sql_ns = (time.perf_counter() - started) / sql_checks * 1e9
+
+    print(f"{args.plans} plans x {args.permissions} permissions, {args.grants_per_plan} grants per plan")
+    print(f"matrix build:  {build_ms:9.1f}ms")
+    print(f"matrix check:  {matrix_ns:9.0f}ns")
+    print(f"trie match:    {trie_ns:9.0f}ns  (uncached path)")
+    print(f"SQL join:      {sql_ns:9.0f}ns  ({sql_ns / matrix_ns:.0f}x slower, exact endpoints only)")
+
+if __name__ == "__main__":
+    main()
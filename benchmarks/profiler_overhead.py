@@ -0,0 +1,71 @@
+"""
+Cost of the sampling profiler to the worker it profiles.
+
+    python -m benchmarks.profiler_overhead --seconds 5 --interval-ms 10 --check
+
+Runs a CPU-bound loop on a worker thread twice, alone and while
+utils/sampling_profiler.py samples the process. ``--idle-threads`` parked
+threads stand in for the threadpool. Prints how much the profiler slowed
+the loop, and the overhead the profiler reported for itself. ``--check``
+exits 1 when the slowdown exceeds PROFILER_MAX_OVERHEAD plus ``--slack``.
+"""
+import argparse
+import asyncio
+import sys
+import threading
+import time
+
+def spin(seconds: float) -> float:
+    """Iterations per second of a pure Python loop"""
+    iterations = 0
+    total = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for value in range(1000):
+            total += value * value
+        iterations += 1
+    return iterations / seconds
+
+async def run(args) -> tuple:
+    from utils.sampling_profiler import profiler
+
+    baseline = await asyncio.to_thread(spin, args.seconds)
+    profiled, result = await asyncio.gather(
+        asyncio.to_thread(spin, args.seconds),
+        profiler.profile(args.seconds, args.interval_ms / 1000, args.mode)
+    )
+    return baseline, profiled, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--interval-ms", type=float, default=10.0)
+    parser.add_argument("--mode", choices=["cpu", "wall"], default="cpu")
+    parser.add_argument("--idle-threads", type=int, default=40)
+    parser.add_argument("--check", action="store_true", help="Exit 1 if the slowdown exceeds the configured bound")
+    parser.add_argument("--slack", type=float, default=0.03, help="Allowed on top of PROFILER_MAX_OVERHEAD for noise")
+    args = parser.parse_args()
+
+    from config import get_settings
+    settings = get_settings()
+
+    parked = threading.Event()
+    for _ in range(args.idle_threads):
+        threading.Thread(target=parked.wait, daemon=True).start()
+    try:
+        baseline, profiled, result = asyncio.run(run(args))
+    finally:
+        parked.set()
+
+    slowdown = 1 - profiled / baseline
+    print(f"loop alone:     {baseline:10.0f} it/s")
+    print(f"while profiled: {profiled:10.0f} it/s  ({slowdown * 100:+.2f}% slower)")
+    print(f"profiler:       {result['samples']} samples, {result['thread_samples']} thread samples, "
+          f"reported overhead {result['overhead_pct']:.2f}%")
+    bound = settings.PROFILER_MAX_OVERHEAD + args.slack
+    if args.check and slowdown > bound:
+        print(f"REGRESSION: slowdown above {bound * 100:.1f}%", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
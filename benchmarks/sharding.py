@@ -0,0 +1,123 @@
+"""
+Write throughput of the access-check path as the number of shards grows.
+
+    python -m benchmarks.sharding --shards 1 2 4 8 --processes 8 --seconds 10
+
+For each shard count a fresh catalog file and shard files are created and
+seeded with one subscription per user. Then ``--processes`` worker processes
+(standing in for uvicorn workers) call the real ``check_access`` decorator for
+random users as fast as they can. Every call reads the subscription, consumes
+quota, inserts a service log row and commits on the user's shard.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from fastapi import HTTPException
+from sqlalchemy.exc import OperationalError
+
+from database import Base, ShardSet, catalog_tables, create_db_engine, sharded_tables
+from middleware.access_control import check_access
+from models import Plan, UserSubscription
+from services import log_store
+
+@check_access("cloud-service-1")
+async def access_checked_endpoint(user_id: int, db=None):
+    return None
+
+def open_shards(directory: str, count: int, profile: str) -> ShardSet:
+    catalog = create_db_engine(f"sqlite:///{os.path.join(directory, 'catalog.db')}", profile)
+    urls = [f"sqlite:///{os.path.join(directory, f'shard{shard}.db')}" for shard in range(count)]
+    return ShardSet(urls, catalog, catalog, profile)
+
+def setup(directory: str, count: int, users: int, profile: str):
+    shards = open_shards(directory, count, profile)
+    Base.metadata.create_all(bind=shards.catalog_engine, tables=catalog_tables())
+    with shards.catalog_engine.begin() as connection:
+        connection.execute(Plan.__table__.insert(), [
+            {"id": 1, "name": "Benchmark Plan", "description": "benchmark", "usage_limit": 10**9}
+        ])
+    by_shard = {}
+    for user_id in range(1, users + 1):
+        by_shard.setdefault(shards.shard_for(user_id), []).append(user_id)
+    for shard, shard_engine in enumerate(shards.engines):
+        Base.metadata.create_all(bind=shard_engine, tables=sharded_tables())
+        log_store.prepare_partitions(shard_engine)
+        with shard_engine.begin() as connection:
+            connection.execute(UserSubscription.__table__.insert(), [
+                {"id": shard + count * (n + 1), "user_id": user_id, "plan_id": 1, "usage_count": 0}
+                for n, user_id in enumerate(by_shard.get(shard, []))
+            ])
+        shard_engine.dispose()
+    shards.catalog_engine.dispose()
+
+def worker(directory: str, count: int, users: int, profile: str, start_at: float, deadline: float, results):
+    shards = open_shards(directory, count, profile)
+    rng = random.Random()
+    writes = errors = 0
+
+    async def run():
+        nonlocal writes, errors
+        while time.time() < start_at:
+            await asyncio.sleep(0.001)
+        while time.time() < deadline:
+            user_id = rng.randint(1, users)
+            db = shards.user_session(user_id)
+            try:
+                await access_checked_endpoint(user_id=user_id, db=db)
+                writes += 1
+            except (HTTPException, OperationalError):
+                errors += 1
+            finally:
+                db.close()
+
+    asyncio.run(run())
+    results.put((writes, errors))
+
+def run_case(count: int, processes: int, seconds: float, users: int, profile: str) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        setup(directory, count, users, profile)
+        results = multiprocessing.Queue()
+        start_at = time.time() + 1.0
+        deadline = start_at + seconds
+        pool = [
+            multiprocessing.Process(
+                target=worker, args=(directory, count, users, profile, start_at, deadline, results)
+            )
+            for _ in range(processes)
+        ]
+        for process in pool:
+            process.start()
+        totals = [results.get() for _ in pool]
+        for process in pool:
+            process.join()
+    writes = sum(writes for writes, _ in totals)
+    return {
+        "shards": count,
+        "writes_per_sec": writes / seconds,
+        "errors": sum(errors for _, errors in totals),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--profile", default="durable", help="SQLite profile; durable fsyncs every commit")
+    args = parser.parse_args()
+
+    print(f"{'shards':>6} {'writes/s':>10} {'speedup':>8} {'errors':>7}")
+    baseline = None
+    for count in args.shards:
+        result = run_case(count, args.processes, args.seconds, args.users, args.profile)
+        baseline = baseline or result["writes_per_sec"]
+        print(f"{result['shards']:>6} {result['writes_per_sec']:>10.0f} "
+              f"{result['writes_per_sec'] / baseline:>7.2f}x {result['errors']:>7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Mixed read/write throughput of the access-check path for each SQLite profile.
+
+Run from the repository root:
+
+    python -m benchmarks.sqlite_profiles --threads 8 --seconds 10 --write-ratio 0.5
+
+Every writer goes through the real ``check_access`` decorator (subscription
+lookup, usage increment, service log insert, commit); every reader fetches a
+subscription and the user's most recent service logs.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
+from fastapi import HTTPException
+
+from database import Base, create_db_engine, get_sqlite_pragmas
+from middleware.access_control import check_access
+from models import Plan, UserSubscription
+from services import log_store
+
+PROFILES = ["default", "durable", "production"]
+
+@check_access("cloud-service-1")
+async def access_checked_endpoint(user_id: int, db=None):
+    return None
+
+def seed(Session, users: int):
+    db = Session()
+    db.add(Plan(id=1, name="Benchmark Plan", description="benchmark", usage_limit=10**9))
+    db.add_all(UserSubscription(user_id=user_id, plan_id=1, usage_count=0) for user_id in range(1, users + 1))
+    db.commit()
+    db.close()
+
+def read_path(db, user_id: int):
+    db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
+    log_store.query_logs(db, user_id=user_id, newest_first=True, limit=5)
+
+def worker(Session, users: int, write_ratio: float, deadline: float, counts: dict, lock: threading.Lock):
+    rng = random.Random()
+    local = {"reads": 0, "writes": 0, "errors": 0}
+
+    async def run():
+        while time.perf_counter() < deadline:
+            db = Session()
+            user_id = rng.randint(1, users)
+            try:
+                if rng.random() < write_ratio:
+                    await access_checked_endpoint(user_id=user_id, db=db)
+                    local["writes"] += 1
+                else:
+                    read_path(db, user_id)
+                    local["reads"] += 1
+            except (HTTPException, OperationalError):
+                local["errors"] += 1
+            finally:
+                db.close()
+
+    asyncio.run(run())
+    with lock:
+        for key, value in local.items():
+            counts[key] += value
+
+def run_profile(profile: str, threads: int, seconds: float, users: int, write_ratio: float) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}", profile)
+        Base.metadata.create_all(bind=engine)
+        log_store.prepare_partitions(engine)
+        Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        seed(Session, users)
+
+        counts = {"reads": 0, "writes": 0, "errors": 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+        pool = [
+            threading.Thread(target=worker, args=(Session, users, write_ratio, deadline, counts, lock))
+            for _ in range(threads)
+        ]
+        started = time.perf_counter()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        engine.dispose()
+
+    return {
+        "profile": profile,
+        "ops_per_sec": (counts["reads"] + counts["writes"]) / elapsed,
+        "reads_per_sec": counts["reads"] / elapsed,
+        "writes_per_sec": counts["writes"] / elapsed,
+        "errors": counts["errors"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=PROFILES, choices=PROFILES)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(f"{'profile':<12}{'ops/s':>10}{'reads/s':>10}{'writes/s':>10}{'errors':>8}  pragmas")
+    for profile in args.profiles:
+        result = run_profile(profile, args.threads, args.seconds, args.users, args.write_ratio)
+        print(
+            f"{profile:<12}{result['ops_per_sec']:>10.0f}{result['reads_per_sec']:>10.0f}"
+            f"{result['writes_per_sec']:>10.0f}{result['errors']:>8}  {get_sqlite_pragmas(profile)}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,167 @@
-from pydantic_settings import BaseSettings
-from functools import lru_cache
-
-class Settings(BaseSettings):
-    # Stripe
-    STRIPE_SECRET_KEY: str
-    STRIPE_PUBLISHABLE_KEY: str
-    
-    # Auth0
-    AUTH0_DOMAIN: str
-    AUTH0_CLIENT_ID: str
-    AUTH0_CLIENT_SECRET: str
-    
-    # AWS
-    AWS_BUCKET_NAME: str
-    AWS_REGION: str
-    AWS_ACCESS_KEY_ID: str
-    AWS_SECRET_ACCESS_KEY: str
-    
-    # Elasticsearch
-    ELASTICSEARCH_HOST: str
-    ELASTICSEARCH_PORT: int
-    
-    # RabbitMQ
-    RABBITMQ_URL: str
-    
-    # Redis
-    REDIS_URL: str
-    
-    class Config:
-        env_file = ".env"
-
-@lru_cache()
-def get_settings():
+from pydantic_settings import BaseSettings
+from functools import lru_cache
+from typing import Optional, Dict, List
+
+class Settings(BaseSettings):
+    # Stripe
+    STRIPE_SECRET_KEY: str
+    STRIPE_PUBLISHABLE_KEY: str
+    
+    # Auth0
+    AUTH0_DOMAIN: str
+    AUTH0_CLIENT_ID: str
+    AUTH0_CLIENT_SECRET: str
+    
+    # AWS
+    AWS_BUCKET_NAME: str
+    AWS_REGION: str
+    AWS_ACCESS_KEY_ID: str
+    AWS_SECRET_ACCESS_KEY: str
+    
+    # Elasticsearch
+    ELASTICSEARCH_HOST: str
+    ELASTICSEARCH_PORT: int
+    
+    # RabbitMQ
+    RABBITMQ_URL: str
+    
+    # Redis
+    REDIS_URL: str
+
+    # Database
+    DATABASE_URL: str = "sqlite:///./cloud_access.db"
+    DATABASE_READ_REPLICA_URL: Optional[str] = None
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 10
+    DATABASE_POOL_RECYCLE_SECONDS: int = 1800
+    DATABASE_POOL_PRE_PING: bool = True
+    DATABASE_RESET_ON_STARTUP: bool = True
+
+    # Optional sharding: per-user tables (subscriptions, usage, payment and service
+    # logs) are spread over DATABASE_SHARDS files by user id, while plans and
+    # permissions stay in DATABASE_URL. 0 keeps everything in DATABASE_URL.
+    DATABASE_SHARDS: int = 0
+    DATABASE_SHARD_URL: str = "sqlite:///./cloud_access_shard{shard}.db"
+
+    # Cloud backends: "real" or "fake" (in-process fakes for load testing)
+    CLOUD_BACKEND_MODE: str = "real"
+    FAKE_BACKEND_LATENCY_MS: float = 20.0
+    FAKE_BACKEND_JITTER_MS: float = 10.0
+    FAKE_BACKEND_ERROR_RATE: float = 0.0
+    FAKE_BACKEND_OVERRIDES: Dict[str, Dict[str, float]] = {}
+
+    # Debug-mode SQL profiling and N+1 detection
+    DEBUG_QUERY_PROFILER: bool = False
+    N_PLUS_ONE_THRESHOLD: int = 5
+
+    # Plans/permissions catalog: longest time another worker's edits can go unseen
+    CATALOG_MAX_AGE_SECONDS: float = 5.0
+
+    # SQLite tuning
+    SQLITE_PROFILE: str = "production"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_CACHE_SIZE_KB: int = 65536
+    SQLITE_MMAP_SIZE: int = 268435456
+    SQLITE_MAINTENANCE_INTERVAL_SECONDS: int = 300
+
+    # POST /access/batch: most items accepted in one request
+    ACCESS_BATCH_MAX_ITEMS: int = 1000
+
+    # Quota leases: lifetime when the client does not ask for one, the longest
+    # allowed, and how often expired leases hand their unused units back
+    LEASE_DEFAULT_TTL_SECONDS: int = 60
+    LEASE_MAX_TTL_SECONDS: int = 3600
+    LEASE_RECLAIM_INTERVAL_SECONDS: int = 30
+
+    # Quota event stream: default thresholds (percent of the plan's limit),
+    # events buffered per client before it is dropped as too slow, and the
+    # seconds between keepalive comments on an idle stream
+    QUOTA_EVENT_THRESHOLDS: List[int] = [50, 80, 100]
+    QUOTA_EVENT_BUFFER_SIZE: int = 100
+    QUOTA_EVENT_KEEPALIVE_SECONDS: float = 15.0
+
+    # Outbox for external calls: worker threads, how often idle workers look
+    # for due jobs, attempts before a job fails, the retry backoff (doubling
+    # from the base up to the max), how long a claimed job may run before
+    # another worker may take it over, and how long finished jobs are kept
+    OUTBOX_WORKERS: int = 4
+    OUTBOX_POLL_INTERVAL_SECONDS: float = 1.0
+    OUTBOX_MAX_ATTEMPTS: int = 5
+    OUTBOX_BACKOFF_BASE_SECONDS: float = 1.0
+    OUTBOX_BACKOFF_MAX_SECONDS: float = 300.0
+    OUTBOX_CLAIM_TIMEOUT_SECONDS: int = 300
+    OUTBOX_RETENTION_HOURS: int = 168
+
+    # Admission control: most concurrent requests per route class (see
+    # middleware/admission.py; "reads" is sized like the threadpool the log
+    # endpoints run in), requests allowed to queue per class, and the
+    # longest a request may queue before it is shed with 503. With
+    # ADMISSION_ADAPTIVE the limits shrink below the maximum while latency
+    # exceeds ADMISSION_TOLERANCE times its usual level, re-evaluated every
+    # ADMISSION_WINDOW requests
+    ADMISSION_CONTROL_ENABLED: bool = True
+    ADMISSION_LIMITS: Dict[str, int] = {"access": 64, "cloud": 32, "reads": 40}
+    ADMISSION_QUEUE_SIZE: int = 128
+    ADMISSION_TARGET_DELAY_MS: float = 100.0
+    ADMISSION_ADAPTIVE: bool = True
+    ADMISSION_WINDOW: int = 50
+    ADMISSION_TOLERANCE: float = 2.0
+
+    # Health probes: dependencies pinged in the background ("database" covers
+    # the primary, a read replica and every shard), seconds between rounds,
+    # how long a probe may take before it counts as failed, probes kept for
+    # the rolling percentiles, and how many of the latest are held against
+    # the latency thresholds. Only HEALTH_READINESS_DEPENDENCIES gate
+    # /health/ready; the rest are reported
+    HEALTH_PROBE_DEPENDENCIES: List[str] = ["database", "redis", "elasticsearch", "rabbitmq", "s3", "stripe"]
+    HEALTH_READINESS_DEPENDENCIES: List[str] = ["database", "redis", "elasticsearch", "rabbitmq"]
+    HEALTH_PROBE_INTERVAL_SECONDS: float = 5.0
+    HEALTH_PROBE_TIMEOUT_SECONDS: float = 2.0
+    HEALTH_PROBE_WINDOW: int = 60
+    HEALTH_PROBE_RECENT: int = 3
+    HEALTH_LATENCY_THRESHOLDS_MS: Dict[str, float] = {
+        "database": 100, "redis": 50, "elasticsearch": 500, "rabbitmq": 500, "s3": 1000, "stripe": 2000
+    }
+
+    # Tracing (see utils/tracing.py): share of new traces sampled (a caller's
+    # traceparent decides for its own), "file" to append OTLP/JSON lines to
+    # TRACING_FILE or "memory" for tests, traces queued for the file writer
+    # before new ones are dropped, and how much of each SQL statement to keep
+    TRACING_ENABLED: bool = False
+    TRACING_SAMPLE_RATE: float = 0.01
+    TRACING_EXPORTER: str = "file"
+    TRACING_FILE: str = "./traces.jsonl"
+    TRACING_EXPORT_QUEUE_SIZE: int = 1000
+    TRACING_SERVICE_NAME: str = "cloud-service-access-management"
+    TRACING_MAX_STATEMENT_LENGTH: int = 1000
+
+    # Sampling profiler (POST /api/admin/profile), retention runs and archive
+    # reads: callers must send X-Admin-Token equal to ADMIN_API_TOKEN, and the
+    # endpoints stay disabled while it is unset. Then the profiler's default
+    # and shortest sampling interval, the longest profile, the deepest stack
+    # kept, and the share of wall time the sampler may spend before it spaces
+    # samples further apart
+    ADMIN_API_TOKEN: Optional[str] = None
+    PROFILER_INTERVAL_MS: float = 10.0
+    PROFILER_MIN_INTERVAL_MS: float = 1.0
+    PROFILER_MAX_SECONDS: float = 60.0
+    PROFILER_MAX_DEPTH: int = 128
+    PROFILER_MAX_OVERHEAD: float = 0.05
+
+    # Background jobs (cascade deletes)
+    JOB_WORKERS: int = 2
+    DELETE_CHUNK_SIZE: int = 1000
+    JOB_HISTORY_SIZE: int = 1000
+
+    # Log retention: days to keep per table, e.g. {"service_logs": 90}; unlisted tables keep everything
+    LOG_RETENTION_DAYS: Dict[str, int] = {}
+    ARCHIVE_DIR: str = "./archive"
+    ARCHIVE_CHUNK_SIZE: int = 5000
+    RETENTION_INTERVAL_SECONDS: int = 3600
+    
+    class Config:
+        env_file = ".env"
+
+@lru_cache()
+def get_settings():
     return Settings() 
\ No newline at end of file
@@ -1,15 +1,273 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
-
-DATABASE_URL = "sqlite:///./cloud_access.db"
-
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.orm import sessionmaker, declarative_base
+from fastapi import Request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from config import get_settings
+import logging
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+DATABASE_URL = settings.DATABASE_URL
+DATABASE_READ_REPLICA_URL = settings.DATABASE_READ_REPLICA_URL
+
+def get_sqlite_pragmas(profile: str) -> dict:
+    """PRAGMAs applied to every new SQLite connection for the given profile"""
+    profiles = {
+        # SQLite defaults: rollback journal, synchronous=FULL
+        "default": {},
+        # WAL so readers never block the writer, but still fsync every commit
+        "durable": {
+            # Only takes effect on a new file (or after VACUUM); lets retention
+            # hand freed pages back with PRAGMA incremental_vacuum
+            "auto_vacuum": "INCREMENTAL",
+            "journal_mode": "WAL",
+            "synchronous": "FULL",
+            "busy_timeout": settings.SQLITE_BUSY_TIMEOUT_MS,
+        },
+        # WAL with fsync only at checkpoints; a power loss can drop the last
+        # few commits but never corrupts the database
+        "production": {
+            "auto_vacuum": "INCREMENTAL",
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": settings.SQLITE_BUSY_TIMEOUT_MS,
+            "cache_size": -settings.SQLITE_CACHE_SIZE_KB,
+            "mmap_size": settings.SQLITE_MMAP_SIZE,
+            "temp_store": "MEMORY",
+        },
+    }
+    if profile not in profiles:
+        raise ValueError(f"Unknown SQLite profile '{profile}'. Choose one of: {', '.join(profiles)}")
+    return profiles[profile]
+
+def get_pool_options(url: str) -> dict:
+    # In-memory SQLite uses a single shared connection, so there is no pool to size
+    if url.startswith("sqlite") and (url.endswith(":memory:") or "mode=memory" in url or url == "sqlite://"):
+        return {}
+    return {
+        "pool_size": settings.DATABASE_POOL_SIZE,
+        "max_overflow": settings.DATABASE_MAX_OVERFLOW,
+        "pool_recycle": settings.DATABASE_POOL_RECYCLE_SECONDS,
+        "pool_pre_ping": settings.DATABASE_POOL_PRE_PING,
+    }
+
+def create_db_engine(url: str, profile: str = settings.SQLITE_PROFILE):
+    if not url.startswith("sqlite"):
+        return create_engine(url, **get_pool_options(url))
+
+    engine = create_engine(url, connect_args={"check_same_thread": False}, **get_pool_options(url))
+    pragmas = get_sqlite_pragmas(profile)
+
+    @event.listens_for(engine, "connect")
+    def apply_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in sorted(pragmas.items(), key=lambda item: item[0] != "busy_timeout"):
+            # Setting auto_vacuum takes the write lock, so a new connection would
+            # fail while another one writes; it only has an effect on an empty file
+            if name == "auto_vacuum" and cursor.execute("PRAGMA page_count").fetchone()[0] > 0:
+                continue
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+def run_sqlite_maintenance(bind=None):
+    """Truncate the WAL file and refresh query planner statistics"""
+    bind = bind or engine
+    if bind.dialect.name != "sqlite":
+        return
+    with bind.connect() as connection:
+        busy, wal_pages, checkpointed = connection.exec_driver_sql(
+            "PRAGMA wal_checkpoint(TRUNCATE)"
+        ).one()
+        connection.exec_driver_sql("PRAGMA optimize")
+    logger.info(f"SQLite maintenance: checkpointed {checkpointed}/{wal_pages} WAL pages (busy={busy})")
+
+def enable_incremental_vacuum(bind=None):
+    """
+    Convert an existing SQLite file to auto_vacuum=INCREMENTAL. This rewrites the
+    whole file with VACUUM, so it is only cheap on a small or empty database.
+    """
+    bind = bind or engine
+    if bind.dialect.name != "sqlite":
+        return
+    with bind.connect() as connection:
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+            return
+        connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+    logger.info("Switched SQLite database to incremental auto-vacuum")
+
+def run_incremental_vacuum(bind=None) -> int:
+    """Release free pages to the filesystem; returns how many pages were freed"""
+    bind = bind or engine
+    if bind.dialect.name != "sqlite":
+        return 0
+    connection = bind.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.warning("auto_vacuum is not INCREMENTAL; run VACUUM once to reclaim space from deleted rows")
+            return 0
+        free_pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        # incremental_vacuum frees one page per step; executescript steps it to completion
+        cursor.executescript("PRAGMA incremental_vacuum")
+        cursor.close()
+    finally:
+        connection.close()
+    return free_pages
+
+engine = create_db_engine(DATABASE_URL)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Read-only endpoints go to the replica when one is configured, otherwise to the primary
+read_engine = create_db_engine(DATABASE_READ_REPLICA_URL) if DATABASE_READ_REPLICA_URL else engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+Base = declarative_base()
+
+# Shared catalog tables; in sharded mode they stay on the primary and every
+# other table is created in each shard
+CATALOG_TABLES = ("plans", "permissions", "plan_permissions")
+
+def catalog_tables() -> list:
+    return [Base.metadata.tables[name] for name in CATALOG_TABLES]
+
+def sharded_tables() -> list:
+    return [table for name, table in Base.metadata.tables.items() if name not in CATALOG_TABLES]
+
+class ShardSet:
+    """
+    Per-user data split over several databases by a hash of the user id.
+
+    A shard session is bound to its shard, except for the catalog tables, which
+    it reads and writes on the primary. Queries on a single user therefore need
+    no changes. Subscription ids are allocated so that ``id % shard count`` is
+    the shard, which lets an id alone find its row.
+    """
+
+    def __init__(self, urls: list, catalog_engine, catalog_read_engine, profile: str = settings.SQLITE_PROFILE):
+        self.engines = [create_db_engine(url, profile) for url in urls]
+        self.catalog_engine = catalog_engine
+        self.catalog_read_engine = catalog_read_engine
+        self._factories = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="shard") if urls else None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.engines)
+
+    def shard_for(self, user_id: int) -> int:
+        return zlib.crc32(user_id.to_bytes(8, "little", signed=True)) % len(self.engines)
+
+    def shard_of_id(self, row_id: int) -> int:
+        return row_id % len(self.engines)
+
+    def session(self, shard: int, read: bool = False):
+        key = (shard, read)
+        factory = self._factories.get(key)
+        if factory is None:
+            with self._lock:
+                catalog = self.catalog_read_engine if read else self.catalog_engine
+                factory = self._factories.setdefault(key, sessionmaker(
+                    autocommit=False, autoflush=False, bind=self.engines[shard],
+                    binds={table: catalog for table in catalog_tables()}
+                ))
+        return factory()
+
+    def user_session(self, user_id: int, read: bool = False):
+        return self.session(self.shard_for(user_id), read)
+
+    def next_id(self, model, shard: int):
+        """SQL for the next free id of ``model`` in ``shard``, evaluated by the INSERT itself"""
+        count = len(self.engines)
+        return select(func.coalesce(func.max(model.id), shard) + count).scalar_subquery()
+
+    def fan_out(self, func, read: bool = True) -> list:
+        """Call ``func(session)`` on every shard in parallel; results come back in shard order"""
+        def run(shard):
+            db = self.session(shard, read)
+            try:
+                return func(db)
+            finally:
+                db.close()
+        return list(self._executor.map(run, range(len(self.engines))))
+
+shards = ShardSet(
+    [settings.DATABASE_SHARD_URL.format(shard=shard) for shard in range(settings.DATABASE_SHARDS)],
+    engine, read_engine
+)
+
+def storage_engines() -> list:
+    """Every engine that holds per-user tables"""
+    return shards.engines if shards.enabled else [engine]
+
+def _request_user_id(request: Request):
+    value = request.path_params.get("user_id") or request.query_params.get("user_id")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _open_session(request: Request, factory, read: bool):
+    """The user's shard session when sharding is on and the request names a user"""
+    if shards.enabled:
+        user_id = _request_user_id(request)
+        if user_id is not None:
+            return shards.user_session(user_id, read)
+    return factory()
+
+def get_db(request: Request):
+    db = _open_session(request, SessionLocal, read=False)
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_read_db(request: Request):
+    db = _open_session(request, ReadSessionLocal, read=True)
+    try:
+        yield db
+    finally:
+        db.close()
+
+@contextmanager
+def shard_db(db, shard: int):
+    """``db`` itself when sharding is off, otherwise a session on ``shard``"""
+    if not shards.enabled:
+        yield db
+        return
+    session = shards.session(shard)
+    try:
+        yield session
+    finally:
+        session.close()
+
+def user_db(db, user_id: int):
+    """``db`` itself, or a session on the user's shard when sharding is on"""
+    return shard_db(db, shards.shard_for(user_id) if shards.enabled else None)
+
+def subscription_db(db, subscription_id: int):
+    """``db`` itself, or a session on the shard that owns the subscription id"""
+    return shard_db(db, shards.shard_of_id(subscription_id) if shards.enabled else None)
+
+def shard_sessions(db, read: bool = False):
+    """Yield ``db``, or a session on each shard in turn when sharding is on"""
+    if not shards.enabled:
+        yield db
+        return
+    for shard in range(len(shards.engines)):
+        shard_db = shards.session(shard, read)
+        try:
+            yield shard_db
+        finally:
+            shard_db.close()
+
+def each_shard(db, func, read: bool = True) -> list:
+    """``[func(db)]``, or ``func`` run on every shard in parallel when sharding is on"""
+    return shards.fan_out(func, read) if shards.enabled else [func(db)]
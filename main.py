@@ -1,49 +1,181 @@
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
-from routers import plans_router, permissions_router, subscriptions_router, access_control_router, cloud_services_router, users_router
-from database import Base, engine
-import logging
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Drop all tables and recreate them
-def init_db():
-    try:
-        # Drop all tables
-        Base.metadata.drop_all(bind=engine)
-        logger.info("Dropped all existing tables")
-        
-        # Create all tables
-        Base.metadata.create_all(bind=engine)
-        logger.info("Created all database tables successfully")
-    except Exception as e:
-        logger.error(f"Error initializing database: {e}")
-        raise e
-
-# Initialize database
-init_db()
-
-app = FastAPI(title="Cloud Service Access Management System")
-
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-# Redirect favicon.ico requests to the static file
-@app.get("/favicon.ico")
-async def favicon():
-    return RedirectResponse(url="/static/favicon.ico")
-
-# Include routers
-app.include_router(plans_router, prefix="/api")
-app.include_router(permissions_router, prefix="/api")
-app.include_router(subscriptions_router, prefix="/api")
-app.include_router(access_control_router, prefix="/api")
-app.include_router(cloud_services_router, prefix="/api")
-app.include_router(users_router, prefix="/api")
-
-@app.get("/")
-def root():
+from fastapi import FastAPI
+from fastapi.staticfiles import StaticFiles
+from fastapi.responses import RedirectResponse
+from fastapi.concurrency import run_in_threadpool
+from routers import plans_router, permissions_router, subscriptions_router, access_control_router, cloud_services_router, users_router, admin_router, metrics_router, debug_router, jobs_router, leases_router, outbox_router, health_router
+from services.usage_tracker import router as usage_router
+from middleware.metrics import MetricsMiddleware
+from middleware.admission import AdmissionControlMiddleware
+from utils.metrics import instrument_engine
+from utils import query_profiler, tracing
+from utils.sampling_profiler import ProfilerMiddleware
+from database import (
+    Base, engine, read_engine, shards, storage_engines, catalog_tables, sharded_tables,
+    run_sqlite_maintenance, enable_incremental_vacuum
+)
+from services.retention import run_retention
+from services.quota_leases import reclaim_all_expired
+from services.outbox import dispatcher as outbox_dispatcher
+from services.health import prober as health_prober
+from services import log_store
+from config import get_settings
+from sqlalchemy.exc import OperationalError
+import asyncio
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+def create_tables(bind, tables=None):
+    try:
+        Base.metadata.create_all(bind=bind, tables=tables)
+    except OperationalError:
+        # Another worker created the tables between our existence check and CREATE TABLE
+        Base.metadata.create_all(bind=bind, tables=tables)
+
+# Drop all tables and recreate them
+def init_db():
+    try:
+        if settings.DATABASE_RESET_ON_STARTUP:
+            # Drop all tables
+            for bind in [engine, *shards.engines]:
+                Base.metadata.drop_all(bind=bind)
+                log_store.drop_all_partitions(bind)
+                # Cheap while the file is empty; lets retention shrink it later
+                enable_incremental_vacuum(bind)
+            logger.info("Dropped all existing tables")
+
+        # Create all tables; when sharded the primary only keeps the catalog
+        primary_tables = catalog_tables() if shards.enabled else None
+        create_tables(engine, primary_tables)
+        for shard_engine in shards.engines:
+            create_tables(shard_engine, sharded_tables())
+        logger.info("Created all database tables successfully")
+
+        # Service logs live in monthly partitions outside Base.metadata
+        for bind in storage_engines():
+            log_store.migrate_legacy_table(bind)
+            log_store.prepare_partitions(bind)
+
+        # Make sure a separately configured read replica has the schema too
+        if read_engine is not engine:
+            Base.metadata.create_all(bind=read_engine, tables=primary_tables)
+            logger.info("Verified database tables on the read replica")
+    except Exception as e:
+        logger.error(f"Error initializing database: {e}")
+        raise e
+
+# Initialize database
+init_db()
+
+app = FastAPI(title="Cloud Service Access Management System")
+
+# Per route class concurrency limits; added first so that metrics and
+# profiling wrap it and see the requests it sheds
+if settings.ADMISSION_CONTROL_ENABLED:
+    app.add_middleware(AdmissionControlMiddleware)
+
+# Tells the sampling profiler which request each task serves; idle otherwise
+app.add_middleware(ProfilerMiddleware)
+
+# Request latency and per-request SQL count/time, exposed at /metrics
+app.add_middleware(MetricsMiddleware)
+for bind in {engine, read_engine, *shards.engines}:
+    instrument_engine(bind)
+
+# Per-request SQL profiling and N+1 detection, only in debug mode
+if settings.DEBUG_QUERY_PROFILER:
+    app.add_middleware(query_profiler.QueryProfilerMiddleware)
+    for bind in {engine, read_engine, *shards.engines}:
+        query_profiler.instrument_engine(bind)
+
+# Spans per request, SQL statement and external call; added last so that the
+# server span covers everything, admission queueing included
+if settings.TRACING_ENABLED:
+    app.add_middleware(tracing.TracingMiddleware)
+    for bind in {engine, read_engine, *shards.engines}:
+        tracing.instrument_engine(bind)
+
+# Periodically checkpoint the WAL, refresh planner statistics and create
+# next month's service log partition before it is needed
+async def sqlite_maintenance_loop():
+    while True:
+        await asyncio.sleep(settings.SQLITE_MAINTENANCE_INTERVAL_SECONDS)
+        try:
+            for bind in storage_engines():
+                await run_in_threadpool(log_store.prepare_partitions, bind)
+            for bind in {engine, read_engine, *shards.engines}:
+                await run_in_threadpool(run_sqlite_maintenance, bind)
+        except Exception as e:
+            logger.error(f"Error running SQLite maintenance: {e}")
+
+# Archive and delete logs past their retention period
+async def retention_loop():
+    while True:
+        await asyncio.sleep(settings.RETENTION_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(run_retention)
+        except Exception as e:
+            logger.error(f"Error running log retention: {e}")
+
+# Give the unused units of expired quota leases back to their subscriptions
+async def lease_reclaim_loop():
+    while True:
+        await asyncio.sleep(settings.LEASE_RECLAIM_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(reclaim_all_expired)
+        except Exception as e:
+            logger.error(f"Error reclaiming quota leases: {e}")
+
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.maintenance_task = asyncio.create_task(sqlite_maintenance_loop())
+    app.state.lease_reclaim_task = asyncio.create_task(lease_reclaim_loop())
+    # Make the external calls queued in the outbox
+    outbox_dispatcher.start()
+    # Probe dependency latency for /health/ready
+    health_prober.start()
+    app.state.retention_task = (
+        asyncio.create_task(retention_loop()) if settings.LOG_RETENTION_DAYS else None
+    )
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    app.state.maintenance_task.cancel()
+    app.state.lease_reclaim_task.cancel()
+    await run_in_threadpool(outbox_dispatcher.stop)
+    await run_in_threadpool(health_prober.stop)
+    await run_in_threadpool(tracing.exporter.shutdown)
+    if app.state.retention_task:
+        app.state.retention_task.cancel()
+
+# Mount static files
+app.mount("/static", StaticFiles(directory="static"), name="static")
+
+# Redirect favicon.ico requests to the static file
+@app.get("/favicon.ico")
+async def favicon():
+    return RedirectResponse(url="/static/favicon.ico")
+
+# Include routers
+app.include_router(plans_router, prefix="/api")
+app.include_router(permissions_router, prefix="/api")
+app.include_router(subscriptions_router, prefix="/api")
+app.include_router(access_control_router, prefix="/api")
+app.include_router(cloud_services_router, prefix="/api")
+app.include_router(users_router, prefix="/api")
+app.include_router(admin_router, prefix="/api")
+app.include_router(usage_router, prefix="/api")
+app.include_router(jobs_router, prefix="/api")
+app.include_router(leases_router, prefix="/api")
+app.include_router(outbox_router, prefix="/api")
+app.include_router(metrics_router)
+app.include_router(health_router)
+if settings.DEBUG_QUERY_PROFILER:
+    app.include_router(debug_router, prefix="/api")
+
+@app.get("/")
+def root():
     return {"message": "Welcome to Cloud Service Access Management System"}
\ No newline at end of file
@@ -1,83 +1,128 @@
-from functools import wraps
-from fastapi import Depends, HTTPException
-from sqlalchemy.orm import Session
-from database import get_db
-from models import UserSubscription, ServiceLog
-import logging
-
-logger = logging.getLogger(__name__)
-
-def check_access(endpoint: str):
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, user_id: int, db: Session = Depends(get_db), **kwargs):
-            try:
-                logger.info(f"Checking access for user {user_id} to endpoint {endpoint}")
-                
-                # Get user subscription with plan
-                subscription = db.query(UserSubscription).filter(
-                    UserSubscription.user_id == user_id
-                ).first()
-                
-                if not subscription:
-                    logger.warning(f"No subscription found for user {user_id}")
-                    raise HTTPException(
-                        status_code=404,
-                        detail=f"No subscription found for user {user_id}. Please subscribe to a plan first."
-                    )
-                
-                if not subscription.plan:
-                    logger.warning(f"No plan found for subscription {subscription.id}")
-                    raise HTTPException(
-                        status_code=404,
-                        detail=f"No plan found for subscription. Please contact support."
-                    )
-
-                logger.info(f"User {user_id} has plan: {subscription.plan.name}")
-                logger.info(f"Current usage: {subscription.usage_count}/{subscription.plan.usage_limit}")
-
-                # Check usage limits
-                if subscription.usage_count >= subscription.plan.usage_limit:
-                    logger.warning(f"Usage limit exceeded for user {user_id}")
-                    raise HTTPException(
-                        status_code=429,
-                        detail=f"Usage limit exceeded. Current: {subscription.usage_count}, Limit: {subscription.plan.usage_limit}"
-                    )
-                
-                # Track usage
-                subscription.usage_count += 1
-                
-                # Log service usage
-                service_log = ServiceLog(
-                    user_id=user_id,
-                    service_name=endpoint,
-                    endpoint=endpoint,
-                    status="success"
-                )
-                db.add(service_log)
-                
-                try:
-                    db.commit()
-                except Exception as commit_error:
-                    logger.error(f"Error committing changes: {commit_error}")
-                    db.rollback()
-                    raise HTTPException(
-                        status_code=500,
-                        detail="Error updating usage tracking"
-                    )
-                
-                # Execute the endpoint function
-                result = await func(user_id=user_id, db=db, *args, **kwargs)
-                return result
-                
-            except HTTPException as he:
-                raise he
-            except Exception as e:
-                logger.error(f"Error in access control: {str(e)}", exc_info=True)
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Internal server error: {str(e)}"
-                )
-                
-        return wrapper
+from functools import wraps
+from fastapi import Depends, HTTPException, Request
+from sqlalchemy.orm import Session
+from database import get_db
+from services import log_store, quota_events
+from services.access_check import consume, find_subscription, plan_limits, usage_in_period
+from services.permission_matrix import get_permission_matrix, normalize_endpoint
+from utils.metrics import record_quota_rejection
+from utils import tracing
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+def check_access(endpoint: str, atomic: bool = False, replay=None):
+    """
+    Check the user's plan and quota and count the call before running the
+    endpoint. With ``atomic``, the count is committed together with whatever
+    the endpoint writes (such as an outbox job), and not at all if it raises.
+    ``replay(db, user_id, kwargs)`` may return the response of a request the
+    user already made; it is returned before the quota check, uncounted.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        passes_request = "request" in signature.parameters
+
+        @wraps(func)
+        async def wrapper(*args, user_id: int, db: Session = Depends(get_db), **kwargs):
+            request = kwargs.get("request") if passes_request else kwargs.pop("request", None)
+            try:
+                with tracing.span("check_access", **{"app.endpoint": endpoint, "enduser.id": user_id}):
+                    # Plain Core statements on the session's connection; see services/access_check.py
+                    connection = db.connection()
+                    subscription = find_subscription(connection, user_id)
+
+                    if not subscription:
+                        logger.warning(f"No subscription found for user {user_id}")
+                        raise HTTPException(
+                            status_code=404,
+                            detail=f"No subscription found for user {user_id}. Please subscribe to a plan first."
+                        )
+
+                    plan = plan_limits.get(db, subscription.plan_id)
+                    if not plan:
+                        logger.warning(f"No plan found for subscription {subscription.id}")
+                        raise HTTPException(
+                            status_code=404,
+                            detail=f"No plan found for subscription. Please contact support."
+                        )
+
+                    # Check the plan grants this service or this specific route
+                    route = request.scope.get("route") if request is not None else None
+                    route_endpoint = normalize_endpoint(route.path) if route is not None else endpoint
+                    if not get_permission_matrix(db).allows(subscription.plan_id, endpoint, route_endpoint):
+                        logger.warning(f"Plan {subscription.plan_id} does not grant {route_endpoint} to user {user_id}")
+                        raise HTTPException(
+                            status_code=403,
+                            detail=f"Your plan does not include access to {route_endpoint}"
+                        )
+
+                    # A repeated request is answered even when the user is now at the limit
+                    if replay is not None:
+                        replayed = replay(db, user_id, kwargs)
+                        if replayed is not None:
+                            db.rollback()
+                            return replayed
+
+                    # Check usage limits and track usage, resetting the counter if its period rolled over
+                    usage = consume(connection, plan, subscription)
+                    if usage is None:
+                        logger.warning(f"Usage limit exceeded for user {user_id}")
+                        record_quota_rejection(endpoint)
+                        raise HTTPException(
+                            status_code=429,
+                            detail=f"Usage limit exceeded. Current: {usage_in_period(plan, subscription)}, Limit: {plan.usage_limit}"
+                        )
+                    quota_events.record_usage(db, user_id, subscription.id, usage - 1, usage, plan.usage_limit)
+                
+                    # Log service usage
+                    log_store.add_log(
+                        connection,
+                        user_id=user_id,
+                        service_name=endpoint,
+                        endpoint=endpoint,
+                        status="success"
+                    )
+                
+                    if atomic:
+                        try:
+                            result = await func(user_id=user_id, db=db, *args, **kwargs)
+                        except Exception:
+                            db.rollback()
+                            raise
+
+                    try:
+                        with tracing.span("commit"):
+                            db.commit()
+                    except Exception as commit_error:
+                        logger.error(f"Error committing changes: {commit_error}")
+                        db.rollback()
+                        raise HTTPException(
+                            status_code=500,
+                            detail="Error updating usage tracking"
+                        )
+                
+                # Execute the endpoint function
+                if not atomic:
+                    result = await func(user_id=user_id, db=db, *args, **kwargs)
+                return result
+                
+            except HTTPException as he:
+                raise he
+            except Exception as e:
+                logger.error(f"Error in access control: {str(e)}", exc_info=True)
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Internal server error: {str(e)}"
+                )
+                
+        # FastAPI builds the route's parameters from this signature; append a
+        # Request so it is injected along with the endpoint's own parameters
+        if not passes_request:
+            wrapper.__signature__ = signature.replace(parameters=[
+                *signature.parameters.values(),
+                inspect.Parameter("request", inspect.Parameter.KEYWORD_ONLY, annotation=Request)
+            ])
+        return wrapper
     return decorator
\ No newline at end of file
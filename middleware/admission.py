@@ -0,0 +1,202 @@
+"""
+Admission control: per route class concurrency limits with bounded queues.
+
+Requests are sorted into classes by path (ROUTE_CLASSES). Each class admits a
+limited number of requests at a time; the rest wait in a FIFO queue of at most
+ADMISSION_QUEUE_SIZE. A request is shed with 503 and Retry-After when the
+queue is full, or when it has waited ADMISSION_TARGET_DELAY_MS without getting
+a slot. Slow log scans can therefore only ever occupy their own slots, and
+access checks keep their latency while reads are flooded. Paths outside every
+class, and long-lived streams, are not limited.
+
+With ADMISSION_ADAPTIVE, each class's limit follows its observed latency, as
+in a gradient concurrency limiter. Every ADMISSION_WINDOW completed requests,
+the limit is scaled by long-term average latency * ADMISSION_TOLERANCE /
+recent latency, clamped to [0.5, 1], and then sqrt(limit) of headroom is
+added. While latency stays near its usual level the limit grows by the
+headroom. When it climbs, the limit shrinks until queueing stops. The limit
+stays between 1 and the configured maximum in ADMISSION_LIMITS.
+
+All state lives on the event loop of the worker process, so no locks are
+needed, and each worker enforces its own limits.
+"""
+from collections import deque
+import asyncio
+import math
+import re
+import time
+
+from config import get_settings
+from utils.metrics import record_admission
+
+settings = get_settings()
+
+# First match wins; paths matching none of them are admitted without limits
+ROUTE_CLASSES = [
+    (re.compile(r"^/api/usage/\d+/events$"), None),
+    (re.compile(r"^/api/(services/logs|cloud-service-\d+/logs|admin/logs/)"), "reads"),
+    (re.compile(r"^/api/(access|leases)/"), "access"),
+    (re.compile(r"^/api/cloud-service-\d+"), "cloud"),
+]
+
+def route_class(path: str):
+    for pattern, name in ROUTE_CLASSES:
+        if pattern.match(path):
+            return name
+    return None
+
+class Shed(Exception):
+    """The request was not admitted; ``reason`` is "queue_full" or "timeout\""""
+
+    def __init__(self, reason: str, retry_after: int):
+        self.reason = reason
+        self.retry_after = retry_after
+
+class ConcurrencyLimiter:
+    """Admits up to ``limit`` requests at once; waiters queue FIFO with a deadline"""
+
+    def __init__(self, name: str, max_limit: int, queue_size: int, target_delay: float,
+                 adaptive: bool = True, window: int = 50, tolerance: float = 2.0):
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.queue_size = queue_size
+        self.target_delay = target_delay
+        self.adaptive = adaptive
+        self.window = window
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self._waiters = deque()
+        self._samples = 0
+        self._recent = None
+        self._baseline = None
+
+    async def acquire(self):
+        """Wait for a slot; raises ``Shed`` if none frees up in time"""
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise Shed("queue_full", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.target_delay)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed over just as the deadline passed
+                return
+            self._remove(waiter)
+            raise Shed("timeout", self.retry_after())
+        except BaseException:
+            # The client went away; give back a slot it may have been handed
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self._remove(waiter)
+            raise
+
+    def release(self, latency: float = None):
+        self.in_flight -= 1
+        if latency is not None and self.adaptive:
+            self._observe(latency)
+        # Hand freed slots straight to the oldest waiters
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.in_flight += 1
+
+    def _remove(self, waiter):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _observe(self, latency: float):
+        if self._recent is None:
+            self._recent = self._baseline = latency
+        # Recent latency reacts within a window, the baseline over many
+        self._recent += (latency - self._recent) * min(1.0, 2.0 / self.window)
+        self._baseline += (latency - self._baseline) * min(1.0, 0.1 / self.window)
+        self._samples += 1
+        if self._samples % self.window:
+            return
+        if self._baseline > self._recent:
+            # Latency dropped below its usual level; let the baseline follow
+            self._baseline = self._recent
+        gradient = max(0.5, min(1.0, self.tolerance * self._baseline / self._recent))
+        self.limit = max(1.0, min(float(self.max_limit), self.limit * gradient + math.sqrt(self.limit)))
+
+    def retry_after(self) -> int:
+        """Seconds until the queue ahead has likely drained"""
+        latency = self._recent or self.target_delay
+        return max(1, math.ceil(len(self._waiters) * latency / max(int(self.limit), 1)))
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "recent_latency_ms": round((self._recent or 0) * 1000, 2),
+            "baseline_latency_ms": round((self._baseline or 0) * 1000, 2),
+        }
+
+def build_limiters() -> dict:
+    return {
+        name: ConcurrencyLimiter(
+            name, limit,
+            queue_size=settings.ADMISSION_QUEUE_SIZE,
+            target_delay=settings.ADMISSION_TARGET_DELAY_MS / 1000,
+            adaptive=settings.ADMISSION_ADAPTIVE,
+            window=settings.ADMISSION_WINDOW,
+            tolerance=settings.ADMISSION_TOLERANCE
+        )
+        for name, limit in settings.ADMISSION_LIMITS.items()
+    }
+
+# The limiters of this process, by route class
+limiters = build_limiters()
+
+class AdmissionControlMiddleware:
+    """Limits concurrent requests per route class and sheds the excess with 503"""
+
+    def __init__(self, app, limiters: dict = limiters):
+        self.app = app
+        self.limiters = limiters
+
+    async def __call__(self, scope, receive, send):
+        limiter = self.limiters.get(route_class(scope["path"])) if scope["type"] == "http" else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        queued_at = time.perf_counter()
+        try:
+            await limiter.acquire()
+        except Shed as shed:
+            record_admission(limiter.name, shed.reason)
+            await _reject(send, shed.retry_after)
+            return
+
+        started = time.perf_counter()
+        record_admission(limiter.name, "admitted", started - queued_at)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(time.perf_counter() - started)
+
+async def _reject(send, retry_after: int):
+    body = b'{"detail":"Server is overloaded; retry later"}'
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,40 @@
+import time
+
+from utils.metrics import (
+    RequestStats, current_request_stats,
+    http_request_duration, db_queries_per_request, db_time_per_request
+)
+
+class MetricsMiddleware:
+    """Records latency, status and SQL count/time for every HTTP request, keyed by route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request_stats.reset(token)
+            # The router stores the matched route in the scope; unmatched paths share one label
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            http_request_duration.observe(elapsed, scope["method"], route_path, status_code)
+            db_queries_per_request.observe(stats.sql_count, route_path)
+            db_time_per_request.observe(stats.sql_time, route_path)
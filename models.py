@@ -1,65 +1,107 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Table, Float, DateTime, Boolean
-from sqlalchemy.orm import relationship
-from database import Base
-from datetime import datetime
-
-plan_permissions = Table(
-    'plan_permissions',
-    Base.metadata,
-    Column('plan_id', Integer, ForeignKey('plans.id')),
-    Column('permission_id', Integer, ForeignKey('permissions.id'))
-)
-
-class Plan(Base):
-    __tablename__ = "plans"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, unique=True, nullable=False)
-    description = Column(String)
-    usage_limit = Column(Integer, nullable=False)
-    permissions = relationship("Permission", secondary=plan_permissions)
-    subscriptions = relationship("UserSubscription", back_populates="plan")
-
-class Permission(Base):
-    __tablename__ = "permissions"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, unique=True, nullable=False)
-    endpoint = Column(String, nullable=False)
-    description = Column(String, nullable=True)
-
-class UserSubscription(Base):
-    __tablename__ = "user_subscriptions"
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, nullable=False)
-    plan_id = Column(Integer, ForeignKey("plans.id"), nullable=False)
-    start_date = Column(DateTime, default=datetime.utcnow)
-    end_date = Column(DateTime, nullable=True)
-    is_active = Column(Boolean, default=True)
-    usage_count = Column(Integer, default=0)
-    plan = relationship("Plan", back_populates="subscriptions")
-
-class UsageLog(Base):
-    __tablename__ = "usage_logs"
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, nullable=False)
-    api_endpoint = Column(String, nullable=False)
-
-class ServiceLog(Base):
-    __tablename__ = "service_logs"
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("user_subscriptions.user_id"), nullable=False)
-    service_name = Column(String, nullable=False)
-    endpoint = Column(String, nullable=False)
-    status = Column(String, nullable=False)
-    error_message = Column(String, nullable=True)
-    service_metadata = Column(String, nullable=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-
-class PaymentLog(Base):
-    __tablename__ = "payment_logs"
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("user_subscriptions.user_id"), nullable=False)
-    amount = Column(Float, nullable=False)
-    currency = Column(String, nullable=False)
-    status = Column(String, nullable=False)
-    stripe_payment_id = Column(String, nullable=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+from sqlalchemy import Column, Integer, String, ForeignKey, Table, Float, DateTime, Boolean, JSON, Text, Index, UniqueConstraint
+from sqlalchemy.orm import relationship
+from database import Base
+from datetime import datetime
+
+plan_permissions = Table(
+    'plan_permissions',
+    Base.metadata,
+    Column('plan_id', Integer, ForeignKey('plans.id', ondelete="CASCADE")),
+    Column('permission_id', Integer, ForeignKey('permissions.id', ondelete="CASCADE"))
+)
+
+class Plan(Base):
+    __tablename__ = "plans"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    description = Column(String)
+    usage_limit = Column(Integer, nullable=False)
+    # none, daily, monthly or rolling (every quota_period_days days); see services/quota.py
+    quota_period = Column(String, nullable=False, default="none")
+    quota_period_days = Column(Integer, nullable=True)
+    # Set once the plan is given permissions; a restricted plan whose grants were
+    # all deleted reaches nothing, instead of falling back to unrestricted
+    restricted = Column(Boolean, nullable=False, default=False)
+    permissions = relationship("Permission", secondary=plan_permissions)
+    # Subscriptions are removed before their plan; don't load them on delete
+    # (with sharding they are not even in the same database)
+    subscriptions = relationship("UserSubscription", back_populates="plan", passive_deletes=True)
+
+class Permission(Base):
+    __tablename__ = "permissions"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    endpoint = Column(String, nullable=False)
+    description = Column(String, nullable=True)
+
+class UserSubscription(Base):
+    __tablename__ = "user_subscriptions"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False)
+    plan_id = Column(Integer, ForeignKey("plans.id"), nullable=False)
+    start_date = Column(DateTime, default=datetime.utcnow)
+    end_date = Column(DateTime, nullable=True)
+    is_active = Column(Boolean, default=True)
+    usage_count = Column(Integer, default=0)
+    # Quota period usage_count belongs to; an older epoch means the count is stale
+    period_epoch = Column(Integer, default=0)
+    plan = relationship("Plan", back_populates="subscriptions")
+
+# Units reserved from a subscription's quota for a client to consume locally;
+# see services/quota_leases.py
+class QuotaLease(Base):
+    __tablename__ = "quota_leases"
+    id = Column(String, primary_key=True)
+    subscription_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    # Quota period the units were taken from; a later period has reset the counter
+    period_epoch = Column(Integer, nullable=False)
+    granted = Column(Integer, nullable=False)
+    used = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class UsageLog(Base):
+    __tablename__ = "usage_logs"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False)
+    api_endpoint = Column(String, nullable=False)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+# Service logs are stored in monthly partition tables; see services/log_store.py
+
+class PaymentLog(Base):
+    __tablename__ = "payment_logs"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("user_subscriptions.user_id"), nullable=False)
+    amount = Column(Float, nullable=False)
+    currency = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    stripe_payment_id = Column(String, nullable=True)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+# External calls (payments, queue messages) waiting to be made by the outbox
+# workers; written in the same transaction as the call's quota count. See
+# services/outbox.py
+class OutboxJob(Base):
+    __tablename__ = "outbox_jobs"
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    # Sent to the upstream API too, so a retried call is not carried out twice
+    idempotency_key = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    # pending, running, succeeded or failed
+    status = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    # When a pending job is due, or when a running job's claim runs out
+    next_attempt_at = Column(DateTime, nullable=False)
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "idempotency_key", name="uq_outbox_jobs_user_key"),
+        Index("ix_outbox_jobs_due", "status", "next_attempt_at"),
+    )
@@ -1,15 +1,29 @@
-from .plans import router as plans_router
-from .permissions import router as permissions_router
-from .subscriptions import router as subscriptions_router
-from .access_control import router as access_control_router
-from .cloud_services import router as cloud_services_router
-from .users import router as users_router
-
-__all__ = [
-    'plans_router',
-    'permissions_router',
-    'subscriptions_router',
-    'access_control_router',
-    'cloud_services_router',
-    'users_router'
+from .plans import router as plans_router
+from .permissions import router as permissions_router
+from .subscriptions import router as subscriptions_router
+from .access_control import router as access_control_router
+from .cloud_services import router as cloud_services_router
+from .users import router as users_router
+from .admin import router as admin_router
+from .metrics import router as metrics_router
+from .debug import router as debug_router
+from .jobs import router as jobs_router
+from .leases import router as leases_router
+from .outbox import router as outbox_router
+from .health import router as health_router
+
+__all__ = [
+    'plans_router',
+    'permissions_router',
+    'subscriptions_router',
+    'access_control_router',
+    'cloud_services_router',
+    'users_router',
+    'admin_router',
+    'metrics_router',
+    'debug_router',
+    'jobs_router',
+    'leases_router',
+    'outbox_router',
+    'health_router'
 ] 
\ No newline at end of file
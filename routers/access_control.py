@@ -1,75 +1,144 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from database import get_db
-from models import UserSubscription, Plan
-from typing import Optional
-
-router = APIRouter(tags=["Access Control"])
-
-@router.get("/access/{user_id}/{api_request}")
-async def check_access(
-    user_id: int,
-    api_request: str,
-    db: Session = Depends(get_db)
-):
-    # Validate user_id
-    if not isinstance(user_id, int) or user_id <= 0:
-        raise HTTPException(
-            status_code=400,
-            detail="Invalid user ID. Must be a positive integer."
-        )
-
-    # Get user subscription
-    subscription = db.query(UserSubscription).filter_by(user_id=user_id).first()
-    if not subscription:
-        raise HTTPException(
-            status_code=404,
-            detail=f"No subscription found for user {user_id}"
-        )
-
-    # Get plan details
-    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
-    if not plan:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Plan not found for subscription"
-        )
-
-    # Check usage limit
-    if subscription.usage_count >= plan.usage_limit:
-        raise HTTPException(
-            status_code=403,
-            detail=f"Usage limit exceeded. Current usage: {subscription.usage_count}, Limit: {plan.usage_limit}"
-        )
-    
-    # Increment usage count
-    subscription.usage_count += 1
-    db.commit()
-
-    return {
-        "message": f"Access granted to {api_request}",
-        "user_id": user_id,
-        "current_usage": subscription.usage_count,
-        "usage_limit": plan.usage_limit
-    }
-
-# Add a helper endpoint to check usage
-@router.get("/access/{user_id}/usage")
-async def check_usage(
-    user_id: int,
-    db: Session = Depends(get_db)
-):
-    subscription = db.query(UserSubscription).filter_by(user_id=user_id).first()
-    if not subscription:
-        raise HTTPException(
-            status_code=404,
-            detail=f"No subscription found for user {user_id}"
-        )
-
-    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
-    return {
-        "user_id": user_id,
-        "current_usage": subscription.usage_count,
-        "usage_limit": plan.usage_limit if plan else None,
-        "remaining_calls": (plan.usage_limit - subscription.usage_count) if plan else 0
-    }
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from database import get_db, shards, shard_db
+from models import UserSubscription, Plan
+from typing import Optional
+from schemas import AccessBatchRequest, AccessBatchResult, AccessBatchDecision
+from services.access_check import resolve_batch
+from services.permission_matrix import get_permission_matrix, normalize_endpoint
+from services.quota import consume_quota, effective_usage
+from utils.metrics import record_quota_rejection
+from config import get_settings
+import logging
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+router = APIRouter(tags=["Access Control"])
+
+# Plain def: FastAPI runs it in the threadpool, so a large batch does not block
+# the event loop
+@router.post("/access/batch", response_model=AccessBatchResult)
+def check_access_batch(
+    payload: AccessBatchRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Decide many (user_id, endpoint, cost) checks in one call and count the
+    allowed ones, in order, in one transaction (one per shard when sharded)
+    """
+    items = payload.items
+    if len(items) > settings.ACCESS_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {settings.ACCESS_BATCH_MAX_ITEMS} items per batch"
+        )
+
+    groups = {}
+    for index, item in enumerate(items):
+        shard = shards.shard_for(item.user_id) if shards.enabled else None
+        groups.setdefault(shard, []).append(index)
+
+    try:
+        decisions = [None] * len(items)
+        for shard, indexes in groups.items():
+            with shard_db(db, shard) as target:
+                resolved = resolve_batch(
+                    target, [(items[index].user_id, items[index].endpoint, items[index].cost) for index in indexes]
+                )
+                target.commit()
+            for index, decision in zip(indexes, resolved):
+                decisions[index] = decision
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error resolving access batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    results = []
+    for item, decision in zip(items, decisions):
+        if decision.reason == "quota_exceeded":
+            record_quota_rejection("access_batch")
+        results.append(AccessBatchDecision(
+            user_id=item.user_id,
+            endpoint=item.endpoint,
+            allowed=decision.allowed,
+            reason=decision.reason,
+            current_usage=decision.usage,
+            usage_limit=decision.usage_limit,
+            remaining=max(decision.usage_limit - decision.usage, 0) if decision.usage_limit is not None else None
+        ))
+    allowed = sum(result.allowed for result in results)
+    return AccessBatchResult(allowed=allowed, denied=len(results) - allowed, results=results)
+
+@router.get("/access/{user_id}/{api_request}")
+async def check_access(
+    user_id: int,
+    api_request: str,
+    db: Session = Depends(get_db)
+):
+    # Validate user_id
+    if not isinstance(user_id, int) or user_id <= 0:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid user ID. Must be a positive integer."
+        )
+
+    # Get user subscription
+    subscription = db.query(UserSubscription).filter_by(user_id=user_id).first()
+    if not subscription:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No subscription found for user {user_id}"
+        )
+
+    # Get plan details
+    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+    if not plan:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Plan not found for subscription"
+        )
+
+    # Check the plan grants the requested endpoint
+    if not get_permission_matrix(db).allows(plan.id, normalize_endpoint(api_request)):
+        raise HTTPException(
+            status_code=403,
+            detail=f"Plan '{plan.name}' does not include access to {api_request}"
+        )
+
+    # Check usage limit and increment usage count, resetting it if the period rolled over
+    if consume_quota(db, plan, subscription) is None:
+        record_quota_rejection("access")
+        raise HTTPException(
+            status_code=403,
+            detail=f"Usage limit exceeded. Current usage: {effective_usage(plan, subscription)}, Limit: {plan.usage_limit}"
+        )
+    db.commit()
+
+    return {
+        "message": f"Access granted to {api_request}",
+        "user_id": user_id,
+        "current_usage": subscription.usage_count,
+        "usage_limit": plan.usage_limit
+    }
+
+# Add a helper endpoint to check usage
+@router.get("/access/{user_id}/usage")
+async def check_usage(
+    user_id: int,
+    db: Session = Depends(get_db)
+):
+    subscription = db.query(UserSubscription).filter_by(user_id=user_id).first()
+    if not subscription:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No subscription found for user {user_id}"
+        )
+
+    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+    usage = effective_usage(plan, subscription) if plan else subscription.usage_count
+    return {
+        "user_id": user_id,
+        "current_usage": usage,
+        "usage_limit": plan.usage_limit if plan else None,
+        "remaining_calls": (plan.usage_limit - usage) if plan else 0
+    }
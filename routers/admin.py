@@ -1,18 +1,80 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from database import get_db
-from models import ServiceLog, PaymentLog
-from typing import List
-from schemas import ServiceLogResponse, PaymentLogResponse
-
-router = APIRouter(tags=["Admin"])
-
-@router.get("/admin/logs/services/{user_id}", response_model=List[ServiceLogResponse])
-async def get_service_logs(user_id: int, db: Session = Depends(get_db)):
-    logs = db.query(ServiceLog).filter(ServiceLog.user_id == user_id).all()
-    return logs
-
-@router.get("/admin/logs/payments/{user_id}", response_model=List[PaymentLogResponse])
-async def get_payment_logs(user_id: int, db: Session = Depends(get_db)):
-    logs = db.query(PaymentLog).filter(PaymentLog.user_id == user_id).all()
-    return logs 
\ No newline at end of file
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.orm import Session
+from database import get_read_db
+from models import PaymentLog
+from services import log_store
+from typing import List, Literal, Optional
+from datetime import datetime
+from schemas import ServiceLogResponse, PaymentLogResponse
+from services.jobs import submit_job
+from services.retention import run_retention, read_archive, ARCHIVED_TABLES
+from utils.sampling_profiler import profiler, route_codes, ProfilerBusy
+from config import get_settings
+import hmac
+
+router = APIRouter(tags=["Admin"])
+settings = get_settings()
+
+def require_admin_token(x_admin_token: Optional[str] = Header(default=None)):
+    """Let the request through only with X-Admin-Token equal to ADMIN_API_TOKEN"""
+    if not settings.ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Set ADMIN_API_TOKEN to enable this endpoint")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, settings.ADMIN_API_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid or missing X-Admin-Token")
+
+@router.get("/admin/logs/services/{user_id}", response_model=List[ServiceLogResponse])
+def get_service_logs(user_id: int, db: Session = Depends(get_read_db)):
+    logs = log_store.query_logs(db, user_id=user_id)
+    return logs
+
+@router.get("/admin/logs/payments/{user_id}", response_model=List[PaymentLogResponse])
+def get_payment_logs(user_id: int, db: Session = Depends(get_read_db)):
+    logs = db.query(PaymentLog).filter(PaymentLog.user_id == user_id).all()
+    return logs
+
+@router.post("/admin/retention/run", status_code=202, dependencies=[Depends(require_admin_token)])
+async def start_retention(response: Response):
+    """Archive and delete logs past LOG_RETENTION_DAYS now instead of waiting for the next scheduled run"""
+    job = submit_job("retention", 0, lambda job, db: run_retention(progress=job.progress))
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return {"message": "Retention run started", "job": job.to_dict()}
+
+@router.get("/admin/archive/{table}", dependencies=[Depends(require_admin_token)])
+def get_archived_logs(
+    table: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user_id: Optional[int] = None,
+    limit: int = 1000
+):
+    """Rows moved to the archive by the retention policy, oldest first"""
+    if table not in ARCHIVED_TABLES:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No archive for table '{table}'. Choose one of: {', '.join(ARCHIVED_TABLES)}"
+        )
+    return read_archive(table, start, end, user_id, limit)
+
+@router.post("/admin/profile", dependencies=[Depends(require_admin_token)])
+async def run_profile(
+    request: Request,
+    seconds: float = Query(10.0, gt=0, le=settings.PROFILER_MAX_SECONDS),
+    interval_ms: float = Query(settings.PROFILER_INTERVAL_MS, ge=settings.PROFILER_MIN_INTERVAL_MS),
+    mode: Literal["cpu", "wall"] = "cpu",
+    format: Literal["json", "collapsed"] = "json",
+    by_route: bool = False
+):
+    """
+    Sample every thread of the worker that serves this request for ``seconds``.
+    ``format=collapsed`` returns only the stacks, for flamegraph tools.
+    """
+    try:
+        result = await profiler.profile(seconds, interval_ms / 1000, mode, route_codes(request.app))
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="A profile is already running in this worker")
+    if format == "collapsed":
+        return PlainTextResponse(result["collapsed"])
+    if not by_route:
+        del result["routes"]
+    return result
@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+from utils.query_profiler import recent_profiles
+
+router = APIRouter(prefix="/debug", tags=["Debug"])
+
+@router.get("/queries")
+async def get_query_profiles(n_plus_one_only: bool = False, limit: int = 20):
+    """SQL profiles of the most recent requests, newest first"""
+    profiles = list(recent_profiles)[::-1]
+    if n_plus_one_only:
+        profiles = [profile for profile in profiles if profile["n_plus_one_suspects"]]
+    return profiles[:limit]
@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Response
+from services.health import prober
+
+router = APIRouter(prefix="/health", tags=["Health"])
+
+_ALIVE = b'{"status":"alive"}'
+
+@router.get("/live")
+async def live():
+    """Liveness: the process is serving; dependencies are not consulted"""
+    return Response(content=_ALIVE, media_type="application/json")
+
+@router.get("/ready")
+async def ready():
+    """Readiness as of the prober's last round; 503 while a required dependency is unhealthy"""
+    is_ready, body = prober.readiness()
+    return Response(content=body, status_code=200 if is_ready else 503, media_type="application/json")
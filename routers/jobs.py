@@ -0,0 +1,22 @@
+from fastapi import APIRouter, HTTPException
+from services.jobs import get_job, list_jobs
+
+router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+@router.get("")
+async def get_jobs(status: str = None, limit: int = 50):
+    """Background jobs, newest first"""
+    jobs = list_jobs()[::-1]
+    if status:
+        jobs = [job for job in jobs if job.status == status]
+    return [job.to_dict() for job in jobs[:limit]]
+
+@router.get("/{job_id}")
+async def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Job {job_id} not found"
+        )
+    return job.to_dict()
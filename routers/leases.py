@@ -0,0 +1,68 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from typing import List
+from database import get_db
+from models import QuotaLease
+from schemas import LeaseCreate, LeaseRenew, LeaseReturn, LeaseResponse, LeaseReturnResult
+from services import quota_leases
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Every route names the user, so get_db opens the user's shard when sharded
+router = APIRouter(prefix="/leases", tags=["Quota Leases"])
+
+def _lease_response(lease: QuotaLease) -> LeaseResponse:
+    return LeaseResponse(
+        lease_id=lease.id,
+        user_id=lease.user_id,
+        subscription_id=lease.subscription_id,
+        granted=lease.granted,
+        used=lease.used,
+        remaining=lease.granted - lease.used,
+        expires_at=lease.expires_at
+    )
+
+@router.post("/{user_id}", response_model=LeaseResponse)
+def reserve_lease(user_id: int, payload: LeaseCreate, db: Session = Depends(get_db)):
+    """Reserve up to ``units`` of the user's remaining quota to consume locally"""
+    try:
+        return _lease_response(quota_leases.reserve(db, user_id, payload.units, payload.ttl_seconds))
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error leasing quota to user {user_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/{user_id}", response_model=List[LeaseResponse])
+def get_leases(user_id: int, db: Session = Depends(get_db)):
+    """The user's leases, including expired ones not reclaimed yet"""
+    return [_lease_response(lease) for lease in quota_leases.list_leases(db, user_id)]
+
+@router.post("/{user_id}/{lease_id}/renew", response_model=LeaseResponse)
+def renew_lease(user_id: int, lease_id: str, payload: LeaseRenew, db: Session = Depends(get_db)):
+    """Report usage so far, extend the lease and optionally reserve ``units`` more"""
+    try:
+        return _lease_response(quota_leases.renew(
+            db, user_id, lease_id, payload.used, payload.units, payload.ttl_seconds
+        ))
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error renewing lease {lease_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/{user_id}/{lease_id}/return", response_model=LeaseReturnResult)
+def return_lease(user_id: int, lease_id: str, payload: LeaseReturn, db: Session = Depends(get_db)):
+    """Close the lease with its final usage and give the unused units back"""
+    try:
+        returned = quota_leases.settle(db, user_id, lease_id, payload.used)
+        return LeaseReturnResult(lease_id=lease_id, used=payload.used, returned=returned)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error returning lease {lease_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from typing import List
+from database import get_db
+from schemas import OutboxJobResponse
+from services import outbox
+
+# Jobs live with the user's other data, so get_db opens the user's shard when sharded
+router = APIRouter(prefix="/outbox", tags=["Outbox"])
+
+@router.get("/{user_id}", response_model=List[OutboxJobResponse])
+def get_outbox_jobs(user_id: int, status: str = None, limit: int = 50, db: Session = Depends(get_db)):
+    """The user's queued external calls, newest first"""
+    return outbox.list_jobs(db, user_id, status, limit)
+
+@router.get("/{user_id}/{job_id}", response_model=OutboxJobResponse)
+def get_outbox_job(user_id: int, job_id: str, db: Session = Depends(get_db)):
+    job = outbox.get_job(db, user_id, job_id)
+    if not job:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Job {job_id} not found"
+        )
+    return job
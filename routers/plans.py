@@ -1,146 +1,208 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy.exc import IntegrityError
-from database import get_db
-from models import Plan, UserSubscription
-from schemas import PlanCreate, PlanResponse
-from typing import List
-import logging
-
-# Configure logging
-logger = logging.getLogger(__name__)
-
-router = APIRouter(tags=["Plans"])
-
-# Debug endpoint to check if plan exists
-@router.get("/plans/debug/{plan_id}")
-async def debug_plan(plan_id: int, db: Session = Depends(get_db)):
-    plan = db.query(Plan).filter(Plan.id == plan_id).first()
-    return {
-        "exists": plan is not None,
-        "plan_id": plan_id,
-        "plan_details": plan.__dict__ if plan else None
-    }
-
-@router.get("/plans", response_model=List[PlanResponse])
-async def get_plans(db: Session = Depends(get_db)):
-    try:
-        plans = db.query(Plan).all()
-        logger.info(f"Found {len(plans)} plans")
-        return plans
-    except Exception as e:
-        logger.error(f"Error fetching plans: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@router.post("/plans", response_model=PlanResponse)
-async def create_plan(plan: PlanCreate, db: Session = Depends(get_db)):
-    try:
-        db_plan = Plan(
-            name=plan.name,
-            description=plan.description,
-            usage_limit=plan.usage_limit
-        )
-        db.add(db_plan)
-        db.commit()
-        db.refresh(db_plan)
-        logger.info(f"Created new plan with ID: {db_plan.id}")
-        return db_plan
-    except IntegrityError:
-        db.rollback()
-        raise HTTPException(
-            status_code=400,
-            detail=f"Plan with name '{plan.name}' already exists"
-        )
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error creating plan: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@router.put("/plans/{plan_id}", response_model=PlanResponse)
-async def update_plan(plan_id: int, plan: PlanCreate, db: Session = Depends(get_db)):
-    try:
-        # Log the update attempt
-        logger.info(f"Attempting to update plan {plan_id}")
-        
-        # Query the plan and log the result
-        db_plan = db.query(Plan).filter(Plan.id == plan_id).first()
-        logger.info(f"Plan query result: {db_plan}")
-        
-        if not db_plan:
-            logger.warning(f"Plan {plan_id} not found")
-            raise HTTPException(
-                status_code=404,
-                detail=f"Plan with id {plan_id} not found"
-            )
-
-        # Update the plan fields
-        db_plan.name = plan.name
-        db_plan.description = plan.description
-        db_plan.usage_limit = plan.usage_limit
-
-        try:
-            db.commit()
-            db.refresh(db_plan)
-            logger.info(f"Successfully updated plan {plan_id}")
-            return db_plan
-        except IntegrityError as e:
-            db.rollback()
-            logger.error(f"IntegrityError while updating plan: {e}")
-            raise HTTPException(
-                status_code=400,
-                detail=f"Plan with name '{plan.name}' already exists"
-            )
-            
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error updating plan {plan_id}: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@router.delete("/plans/{plan_id}")
-async def delete_plan(
-    plan_id: int, 
-    force: bool = False,
-    db: Session = Depends(get_db)
-):
-    try:
-        # Check if plan exists
-        db_plan = db.query(Plan).filter(Plan.id == plan_id).first()
-        if not db_plan:
-            raise HTTPException(
-                status_code=404, 
-                detail=f"Plan with id {plan_id} not found"
-            )
-
-        # Check for existing subscriptions
-        existing_subscriptions = db.query(UserSubscription).filter(
-            UserSubscription.plan_id == plan_id
-        ).all()
-
-        if existing_subscriptions:
-            if not force:
-                # If force=false, prevent deletion
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Cannot delete plan {plan_id} because it has active subscriptions. Use force=true to delete anyway."
-                )
-            else:
-                # If force=true, delete subscriptions first
-                logger.warning(f"Force deleting plan {plan_id} and its subscriptions")
-                for subscription in existing_subscriptions:
-                    db.delete(subscription)
-
-        # Now delete the plan
-        db.delete(db_plan)
-        db.commit()
-        logger.info(f"Successfully deleted plan {plan_id}")
-        
-        return {"message": f"Plan {plan_id} deleted successfully"}
-        
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error deleting plan {plan_id}: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+from fastapi import APIRouter, Depends, HTTPException, Header, Response
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from database import get_db, get_read_db, shard_sessions, each_shard
+from models import Plan, UserSubscription, Permission
+from schemas import PlanCreate, PlanUpdate, PlanResponse
+from services.catalog import plans_catalog, catalog_response
+from services.jobs import submit_job, delete_in_chunks
+from typing import List, Optional
+import logging
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+router = APIRouter(tags=["Plans"])
+
+def get_permissions_by_id(permission_ids: List[int], db: Session) -> List[Permission]:
+    if not permission_ids:
+        return []
+    permissions = db.query(Permission).filter(Permission.id.in_(permission_ids)).all()
+    missing = set(permission_ids) - {permission.id for permission in permissions}
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Permissions not found: {sorted(missing)}"
+        )
+    return permissions
+
+# Debug endpoint to check if plan exists
+@router.get("/plans/debug/{plan_id}")
+async def debug_plan(plan_id: int, db: Session = Depends(get_db)):
+    plan = db.query(Plan).filter(Plan.id == plan_id).first()
+    return {
+        "exists": plan is not None,
+        "plan_id": plan_id,
+        "plan_details": plan.__dict__ if plan else None
+    }
+
+@router.get("/plans", response_model=List[PlanResponse])
+async def get_plans(
+    db: Session = Depends(get_read_db),
+    if_none_match: Optional[str] = Header(None)
+):
+    try:
+        return catalog_response(plans_catalog, db, if_none_match)
+    except Exception as e:
+        logger.error(f"Error fetching plans: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/plans", response_model=PlanResponse)
+async def create_plan(plan: PlanCreate, db: Session = Depends(get_db)):
+    try:
+        db_plan = Plan(
+            name=plan.name,
+            description=plan.description,
+            usage_limit=plan.usage_limit,
+            quota_period=plan.quota_period,
+            quota_period_days=plan.quota_period_days,
+            permissions=get_permissions_by_id(plan.permissions, db),
+            restricted=bool(plan.permissions)
+        )
+        db.add(db_plan)
+        db.commit()
+        db.refresh(db_plan)
+        plans_catalog.invalidate()
+        logger.info(f"Created new plan with ID: {db_plan.id}")
+        return db_plan
+    except HTTPException as he:
+        raise he
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail=f"Plan with name '{plan.name}' already exists"
+        )
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error creating plan: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.put("/plans/{plan_id}", response_model=PlanResponse)
+async def update_plan(plan_id: int, plan: PlanUpdate, db: Session = Depends(get_db)):
+    try:
+        # Log the update attempt
+        logger.info(f"Attempting to update plan {plan_id}")
+        
+        # Query the plan and log the result
+        db_plan = db.query(Plan).filter(Plan.id == plan_id).first()
+        logger.info(f"Plan query result: {db_plan}")
+        
+        if not db_plan:
+            logger.warning(f"Plan {plan_id} not found")
+            raise HTTPException(
+                status_code=404,
+                detail=f"Plan with id {plan_id} not found"
+            )
+
+        # Update the plan fields; omitted optional ones keep their value
+        db_plan.name = plan.name
+        db_plan.description = plan.description
+        db_plan.usage_limit = plan.usage_limit
+        if plan.quota_period is not None:
+            db_plan.quota_period = plan.quota_period
+        if plan.quota_period_days is not None:
+            db_plan.quota_period_days = plan.quota_period_days
+        if db_plan.quota_period == "rolling" and not db_plan.quota_period_days:
+            raise HTTPException(
+                status_code=422,
+                detail="quota_period_days is required for a rolling quota period"
+            )
+        if plan.permissions is not None:
+            db_plan.permissions = get_permissions_by_id(plan.permissions, db)
+            # An explicit empty list lifts the restriction
+            db_plan.restricted = bool(plan.permissions)
+
+        try:
+            db.commit()
+            db.refresh(db_plan)
+            plans_catalog.invalidate()
+            logger.info(f"Successfully updated plan {plan_id}")
+            return db_plan
+        except IntegrityError as e:
+            db.rollback()
+            logger.error(f"IntegrityError while updating plan: {e}")
+            raise HTTPException(
+                status_code=400,
+                detail=f"Plan with name '{plan.name}' already exists"
+            )
+            
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error updating plan {plan_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def delete_plan_cascade(plan_id: int):
+    """Background job: delete the plan's subscriptions in chunks, then the plan"""
+    def run(job, db: Session):
+        for shard_db in shard_sessions(db):
+            delete_in_chunks(shard_db, job, UserSubscription, UserSubscription.plan_id == plan_id)
+        db_plan = db.query(Plan).filter(Plan.id == plan_id).first()
+        if db_plan:
+            # Subscriptions created while the chunks ran go in the same transaction
+            # as the plan (when sharded, just before it)
+            for shard_db in shard_sessions(db):
+                stragglers = shard_db.query(UserSubscription).filter(
+                    UserSubscription.plan_id == plan_id
+                ).delete(synchronize_session=False)
+                job.progress[UserSubscription.__tablename__] += stragglers
+                if shard_db is not db:
+                    shard_db.commit()
+            db.delete(db_plan)
+            db.commit()
+            job.progress[Plan.__tablename__] = 1
+        plans_catalog.invalidate()
+    return run
+
+@router.delete("/plans/{plan_id}")
+async def delete_plan(
+    plan_id: int, 
+    response: Response,
+    force: bool = False,
+    db: Session = Depends(get_db)
+):
+    try:
+        # Check if plan exists
+        db_plan = db.query(Plan).filter(Plan.id == plan_id).first()
+        if not db_plan:
+            raise HTTPException(
+                status_code=404, 
+                detail=f"Plan with id {plan_id} not found"
+            )
+
+        # Check for existing subscriptions
+        has_subscriptions = any(each_shard(db, lambda shard_db: shard_db.query(UserSubscription.id).filter(
+            UserSubscription.plan_id == plan_id
+        ).first() is not None))
+
+        if has_subscriptions:
+            if not force:
+                # If force=false, prevent deletion
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Cannot delete plan {plan_id} because it has active subscriptions. Use force=true to delete anyway."
+                )
+            else:
+                # If force=true, delete subscriptions and then the plan in the background
+                logger.warning(f"Force deleting plan {plan_id} and its subscriptions")
+                job = submit_job("delete_plan", plan_id, delete_plan_cascade(plan_id))
+                response.status_code = 202
+                response.headers["Location"] = f"/api/jobs/{job.id}"
+                return {"message": f"Deletion of plan {plan_id} started", "job": job.to_dict()}
+
+        # Now delete the plan
+        db.delete(db_plan)
+        db.commit()
+        plans_catalog.invalidate()
+        logger.info(f"Successfully deleted plan {plan_id}")
+        
+        return {"message": f"Plan {plan_id} deleted successfully"}
+        
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error deleting plan {plan_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,233 +1,424 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from database import get_db
-from models import UserSubscription, Plan, ServiceLog
-from schemas import SubscriptionCreate, UserSubscriptionResponse, SubscriptionUpdate
-from datetime import datetime
-import logging
-
-logger = logging.getLogger(__name__)
-router = APIRouter(prefix="/subscriptions", tags=["Subscriptions"])
-
-@router.post("", response_model=UserSubscriptionResponse)
-async def create_subscription(
-    subscription: SubscriptionCreate,
-    db: Session = Depends(get_db)
-):
-    try:
-        # Check if plan exists
-        plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
-        if not plan:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Plan with id {subscription.plan_id} not found"
-            )
-
-        # Check if user already has an active subscription
-        existing_subscription = db.query(UserSubscription).filter(
-            UserSubscription.user_id == subscription.user_id,
-            UserSubscription.is_active == True
-        ).first()
-
-        if existing_subscription:
-            raise HTTPException(
-                status_code=400,
-                detail="User already has an active subscription"
-            )
-
-        # Create new subscription
-        db_subscription = UserSubscription(
-            user_id=subscription.user_id,
-            plan_id=subscription.plan_id,
-            start_date=datetime.utcnow(),
-            is_active=True,
-            usage_count=0
-        )
-
-        db.add(db_subscription)
-        db.commit()
-        db.refresh(db_subscription)
-        logger.info(f"Created subscription for user {subscription.user_id} with plan {subscription.plan_id}")
-        
-        return db_subscription
-
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error creating subscription: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@router.get("/{user_id}", response_model=UserSubscriptionResponse)
-async def get_subscription(user_id: int, db: Session = Depends(get_db)):
-    subscription = db.query(UserSubscription).filter(
-        UserSubscription.user_id == user_id,
-        UserSubscription.is_active == True
-    ).first()
-    
-    if not subscription:
-        raise HTTPException(
-            status_code=404,
-            detail="Subscription not found"
-        )
-    
-    return subscription
-
-@router.get("/debug/all")
-async def list_all_subscriptions(db: Session = Depends(get_db)):
-    """Debug endpoint to list all subscriptions"""
-    subscriptions = db.query(UserSubscription).all()
-    return [{
-        "id": sub.id,
-        "user_id": sub.user_id,
-        "plan_id": sub.plan_id,
-        "is_active": sub.is_active,
-        "usage_count": sub.usage_count,
-        "start_date": sub.start_date,
-        "end_date": sub.end_date
-    } for sub in subscriptions]
-
-@router.put("/{subscription_id}", response_model=UserSubscriptionResponse)
-async def update_subscription(
-    subscription_id: int,
-    subscription: SubscriptionUpdate,
-    db: Session = Depends(get_db)
-):
-    try:
-        # Check if subscription exists
-        db_subscription = db.query(UserSubscription).filter(
-            UserSubscription.id == subscription_id
-        ).first()
-        
-        if not db_subscription:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Subscription with id {subscription_id} not found"
-            )
-
-        # If plan_id is being updated, verify the new plan exists
-        if subscription.plan_id:
-            plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
-            if not plan:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"Plan with id {subscription.plan_id} not found"
-                )
-            db_subscription.plan_id = subscription.plan_id
-
-        # Update other fields if provided
-        if subscription.is_active is not None:
-            db_subscription.is_active = subscription.is_active
-            if not subscription.is_active:
-                db_subscription.end_date = datetime.utcnow()
-
-        if subscription.usage_count is not None:
-            db_subscription.usage_count = subscription.usage_count
-
-        db.commit()
-        db.refresh(db_subscription)
-        logger.info(f"Updated subscription {subscription_id}")
-        
-        return db_subscription
-
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error updating subscription: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@router.get("/{user_id}/usage")
-async def get_subscription_usage(user_id: int, db: Session = Depends(get_db)):
-    try:
-        # Get active subscription
-        subscription = db.query(UserSubscription).filter(
-            UserSubscription.user_id == user_id,
-            UserSubscription.is_active == True
-        ).first()
-        
-        if not subscription:
-            raise HTTPException(
-                status_code=404,
-                detail="No active subscription found"
-            )
-
-        # Get plan details
-        plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
-        
-        # Get service usage logs
-        service_logs = db.query(ServiceLog).filter(
-            ServiceLog.user_id == user_id
-        ).all()
-
-        return {
-            "subscription_id": subscription.id,
-            "plan_name": plan.name,
-            "usage_count": subscription.usage_count,
-            "usage_limit": plan.usage_limit,
-            "remaining_calls": plan.usage_limit - subscription.usage_count,
-            "is_limit_exceeded": subscription.usage_count >= plan.usage_limit,
-            "recent_calls": [
-                {
-                    "service": log.service_name,
-                    "endpoint": log.endpoint,
-                    "status": log.status,
-                    "timestamp": log.timestamp
-                } for log in service_logs[-5:]  # Last 5 calls
-            ]
-        }
-
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        logger.error(f"Error getting subscription usage: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@router.delete("/{subscription_id}")
-async def delete_subscription(
-    subscription_id: int,
-    force: bool = False,
-    db: Session = Depends(get_db)
-):
-    try:
-        # Check if subscription exists
-        subscription = db.query(UserSubscription).filter(
-            UserSubscription.id == subscription_id
-        ).first()
-        
-        if not subscription:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Subscription with id {subscription_id} not found"
-            )
-
-        # Check for active service logs
-        service_logs = db.query(ServiceLog).filter(
-            ServiceLog.user_id == subscription.user_id
-        ).all()
-
-        if service_logs and not force:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Cannot delete subscription {subscription_id} because it has service logs. Use force=true to delete anyway."
-            )
-
-        if force:
-            # Delete associated service logs
-            for log in service_logs:
-                db.delete(log)
-            logger.warning(f"Force deleting subscription {subscription_id} and its {len(service_logs)} service logs")
-
-        # Delete the subscription
-        db.delete(subscription)
-        db.commit()
-        logger.info(f"Successfully deleted subscription {subscription_id}")
-        
-        return {"message": f"Subscription {subscription_id} deleted successfully"}
-        
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error deleting subscription {subscription_id}: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy import select, insert, update
+from sqlalchemy.orm import Session
+from database import get_db, shards, shard_db, user_db, subscription_db, each_shard
+from models import UserSubscription, Plan
+from services import log_store, quota_events
+from services.quota import RESET_EPOCH, effective_usage
+from services.jobs import submit_job
+from schemas import (
+    SubscriptionCreate, UserSubscriptionResponse, SubscriptionUpdate,
+    SubscriptionBulkCreate, SubscriptionBulkUpdate, BulkSubscriptionResult, BulkRowError
+)
+from datetime import datetime
+from config import get_settings
+import logging
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+router = APIRouter(prefix="/subscriptions", tags=["Subscriptions"])
+
+# Rows per INSERT/UPDATE batch and ids per IN (...) lookup; keeps every
+# statement well under SQLite's bound-parameter limit
+BULK_CHUNK_SIZE = 1000
+
+def _chunks(items: list, size: int = BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _existing_ids(db: Session, column, ids: set, *criteria) -> set:
+    """Which of ``ids`` appear in ``column``, looked up BULK_CHUNK_SIZE at a time"""
+    found = set()
+    for chunk in _chunks(list(ids)):
+        found.update(db.execute(select(column).where(column.in_(chunk), *criteria)).scalars())
+    return found
+
+@router.post("", response_model=UserSubscriptionResponse)
+async def create_subscription(
+    subscription: SubscriptionCreate,
+    db: Session = Depends(get_db)
+):
+    try:
+        with user_db(db, subscription.user_id) as shard:
+            # Check if plan exists
+            plan = shard.query(Plan).filter(Plan.id == subscription.plan_id).first()
+            if not plan:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Plan with id {subscription.plan_id} not found"
+                )
+
+            # Check if user already has an active subscription
+            existing_subscription = shard.query(UserSubscription).filter(
+                UserSubscription.user_id == subscription.user_id,
+                UserSubscription.is_active == True
+            ).first()
+
+            if existing_subscription:
+                raise HTTPException(
+                    status_code=400,
+                    detail="User already has an active subscription"
+                )
+
+            # Create new subscription
+            db_subscription = UserSubscription(
+                user_id=subscription.user_id,
+                plan_id=subscription.plan_id,
+                start_date=datetime.utcnow(),
+                is_active=True,
+                usage_count=0
+            )
+            if shards.enabled:
+                db_subscription.id = shards.next_id(UserSubscription, shards.shard_for(subscription.user_id))
+
+            shard.add(db_subscription)
+            shard.commit()
+            shard.refresh(db_subscription)
+            logger.info(f"Created subscription for user {subscription.user_id} with plan {subscription.plan_id}")
+        
+            return db_subscription
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error creating subscription: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _rows_by_shard(rows: list, shard_of) -> dict:
+    """Row indexes grouped by shard; a single group when sharding is off"""
+    if not shards.enabled:
+        return {None: list(range(len(rows)))}
+    groups = {}
+    for index, row in enumerate(rows):
+        groups.setdefault(shard_of(row), []).append(index)
+    return groups
+
+# Declared before the /{subscription_id} routes so "bulk" is not parsed as an id.
+# Plain def: FastAPI runs these in the threadpool, so a large import does not
+# block the event loop.
+@router.post("/bulk", response_model=BulkSubscriptionResult)
+def bulk_create_subscriptions(
+    payload: SubscriptionBulkCreate,
+    db: Session = Depends(get_db)
+):
+    """
+    Create many subscriptions in one transaction (one per shard when sharded);
+    invalid rows are skipped and reported
+    """
+    rows = payload.subscriptions
+    try:
+        known_plans = _existing_ids(db, Plan.id, {row.plan_id for row in rows})
+        errors = []
+        created = 0
+        now = datetime.utcnow()
+        for shard, indexes in _rows_by_shard(rows, lambda row: shards.shard_for(row.user_id)).items():
+            with shard_db(db, shard) as target:
+                subscribed_users = _existing_ids(
+                    target, UserSubscription.user_id, {rows[index].user_id for index in indexes},
+                    UserSubscription.is_active == True
+                )
+
+                values = []
+                for index in indexes:
+                    row = rows[index]
+                    if row.plan_id not in known_plans:
+                        errors.append(BulkRowError(index=index, detail=f"Plan with id {row.plan_id} not found"))
+                    elif row.user_id in subscribed_users:
+                        errors.append(BulkRowError(index=index, detail=f"User {row.user_id} already has an active subscription"))
+                    else:
+                        # Later rows for the same user collide with this one
+                        subscribed_users.add(row.user_id)
+                        values.append({
+                            "user_id": row.user_id,
+                            "plan_id": row.plan_id,
+                            "start_date": now,
+                            "is_active": True,
+                            "usage_count": 0
+                        })
+
+                statement = insert(UserSubscription)
+                if shard is not None:
+                    statement = statement.values(id=shards.next_id(UserSubscription, shard))
+                for chunk in _chunks(values):
+                    target.execute(statement, chunk)
+                target.commit()
+                created += len(values)
+
+        errors.sort(key=lambda error: error.index)
+        logger.info(f"Bulk created {created} subscriptions, rejected {len(errors)} rows")
+
+        return BulkSubscriptionResult(created=created, errors=errors)
+
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error bulk creating subscriptions: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.put("/bulk", response_model=BulkSubscriptionResult)
+def bulk_update_subscriptions(
+    payload: SubscriptionBulkUpdate,
+    db: Session = Depends(get_db)
+):
+    """
+    Update many subscriptions by id in one transaction (one per shard when
+    sharded); invalid rows are skipped and reported
+    """
+    rows = payload.subscriptions
+    try:
+        known_plans = _existing_ids(db, Plan.id, {row.plan_id for row in rows if row.plan_id})
+        errors = []
+        updated = 0
+        now = datetime.utcnow()
+        for shard, indexes in _rows_by_shard(rows, lambda row: shards.shard_of_id(row.id)).items():
+            with shard_db(db, shard) as target:
+                known_subscriptions = _existing_ids(target, UserSubscription.id, {rows[index].id for index in indexes})
+
+                values = []
+                for index in indexes:
+                    row = rows[index]
+                    if row.id not in known_subscriptions:
+                        errors.append(BulkRowError(index=index, detail=f"Subscription with id {row.id} not found"))
+                        continue
+                    if row.plan_id and row.plan_id not in known_plans:
+                        errors.append(BulkRowError(index=index, detail=f"Plan with id {row.plan_id} not found"))
+                        continue
+
+                    value = {"id": row.id}
+                    if row.plan_id:
+                        value["plan_id"] = row.plan_id
+                    if row.is_active is not None:
+                        value["is_active"] = row.is_active
+                        if not row.is_active:
+                            value["end_date"] = now
+                    if row.usage_count is not None:
+                        value["usage_count"] = row.usage_count
+                    if len(value) > 1:
+                        values.append(value)
+
+                # ORM bulk UPDATE by primary key, batched into executemany calls
+                for chunk in _chunks(values):
+                    target.execute(update(UserSubscription), chunk)
+                deactivated = [value["id"] for value in values if value.get("is_active") is False]
+                if deactivated and quota_events.bus.has_subscribers():
+                    for chunk in _chunks(deactivated):
+                        owners = target.execute(
+                            select(UserSubscription.id, UserSubscription.user_id).where(UserSubscription.id.in_(chunk))
+                        )
+                        for subscription_id, user_id in owners:
+                            quota_events.record_deactivated(target, user_id, subscription_id)
+                target.commit()
+                updated += len(values)
+
+        errors.sort(key=lambda error: error.index)
+        logger.info(f"Bulk updated {updated} subscriptions, rejected {len(errors)} rows")
+
+        return BulkSubscriptionResult(updated=updated, errors=errors)
+
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error bulk updating subscriptions: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/{user_id}", response_model=UserSubscriptionResponse)
+async def get_subscription(user_id: int, db: Session = Depends(get_db)):
+    subscription = db.query(UserSubscription).filter(
+        UserSubscription.user_id == user_id,
+        UserSubscription.is_active == True
+    ).first()
+    
+    if not subscription:
+        raise HTTPException(
+            status_code=404,
+            detail="Subscription not found"
+        )
+    
+    return subscription
+
+@router.get("/debug/all")
+async def list_all_subscriptions(db: Session = Depends(get_db)):
+    """Debug endpoint to list all subscriptions"""
+    subscriptions = [
+        subscription
+        for part in each_shard(db, lambda shard_db: shard_db.query(UserSubscription).all())
+        for subscription in part
+    ]
+    return [{
+        "id": sub.id,
+        "user_id": sub.user_id,
+        "plan_id": sub.plan_id,
+        "is_active": sub.is_active,
+        "usage_count": sub.usage_count,
+        "start_date": sub.start_date,
+        "end_date": sub.end_date
+    } for sub in subscriptions]
+
+@router.put("/{subscription_id}", response_model=UserSubscriptionResponse)
+async def update_subscription(
+    subscription_id: int,
+    subscription: SubscriptionUpdate,
+    db: Session = Depends(get_db)
+):
+    try:
+        with subscription_db(db, subscription_id) as shard:
+            # Check if subscription exists
+            db_subscription = shard.query(UserSubscription).filter(
+                UserSubscription.id == subscription_id
+            ).first()
+        
+            if not db_subscription:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Subscription with id {subscription_id} not found"
+                )
+
+            # If plan_id is being updated, verify the new plan exists
+            if subscription.plan_id:
+                plan = shard.query(Plan).filter(Plan.id == subscription.plan_id).first()
+                if not plan:
+                    raise HTTPException(
+                        status_code=404,
+                        detail=f"Plan with id {subscription.plan_id} not found"
+                    )
+                if subscription.plan_id != db_subscription.plan_id:
+                    # Usage counted under the old plan does not carry over
+                    db_subscription.usage_count = 0
+                    db_subscription.period_epoch = RESET_EPOCH
+                db_subscription.plan_id = subscription.plan_id
+
+            # Update other fields if provided
+            if subscription.is_active is not None:
+                db_subscription.is_active = subscription.is_active
+                if not subscription.is_active:
+                    db_subscription.end_date = datetime.utcnow()
+                    quota_events.record_deactivated(shard, db_subscription.user_id, subscription_id)
+
+            if subscription.usage_count is not None:
+                db_subscription.usage_count = subscription.usage_count
+
+            shard.commit()
+            shard.refresh(db_subscription)
+            logger.info(f"Updated subscription {subscription_id}")
+        
+            return db_subscription
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error updating subscription: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/{user_id}/usage")
+async def get_subscription_usage(user_id: int, db: Session = Depends(get_db)):
+    try:
+        # Get active subscription
+        subscription = db.query(UserSubscription).filter(
+            UserSubscription.user_id == user_id,
+            UserSubscription.is_active == True
+        ).first()
+        
+        if not subscription:
+            raise HTTPException(
+                status_code=404,
+                detail="No active subscription found"
+            )
+
+        # Get plan details
+        plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+        
+        # Get the most recent service usage logs
+        service_logs = log_store.query_logs(db, user_id=user_id, newest_first=True, limit=5)[::-1]
+
+        usage_count = effective_usage(plan, subscription)
+        return {
+            "subscription_id": subscription.id,
+            "plan_name": plan.name,
+            "usage_count": usage_count,
+            "usage_limit": plan.usage_limit,
+            "remaining_calls": plan.usage_limit - usage_count,
+            "is_limit_exceeded": usage_count >= plan.usage_limit,
+            "recent_calls": [
+                {
+                    "service": log.service_name,
+                    "endpoint": log.endpoint,
+                    "status": log.status,
+                    "timestamp": log.timestamp
+                } for log in service_logs
+            ]
+        }
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error getting subscription usage: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def delete_subscription_cascade(subscription_id: int, user_id: int):
+    """Background job: delete the user's service logs in chunks, then the subscription"""
+    def run(job, db: Session):
+        def record_progress(deleted):
+            job.progress[log_store.TABLE_PREFIX] = deleted
+        with user_db(db, user_id) as shard:
+            log_store.delete_user_logs(shard, user_id, settings.DELETE_CHUNK_SIZE, record_progress)
+            deleted = shard.query(UserSubscription).filter(
+                UserSubscription.id == subscription_id
+            ).delete(synchronize_session=False)
+            shard.commit()
+        job.progress[UserSubscription.__tablename__] = deleted
+    return run
+
+@router.delete("/{subscription_id}")
+async def delete_subscription(
+    subscription_id: int,
+    response: Response,
+    force: bool = False,
+    db: Session = Depends(get_db)
+):
+    try:
+        with subscription_db(db, subscription_id) as shard:
+            # Check if subscription exists
+            subscription = shard.query(UserSubscription).filter(
+                UserSubscription.id == subscription_id
+            ).first()
+        
+            if not subscription:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Subscription with id {subscription_id} not found"
+                )
+
+            # Check for active service logs
+            has_service_logs = log_store.has_logs(shard, subscription.user_id)
+
+            if has_service_logs and not force:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Cannot delete subscription {subscription_id} because it has service logs. Use force=true to delete anyway."
+                )
+
+            if has_service_logs:
+                # Delete associated service logs and then the subscription in the background
+                logger.warning(f"Force deleting subscription {subscription_id} and its service logs")
+                job = submit_job(
+                    "delete_subscription", subscription_id,
+                    delete_subscription_cascade(subscription_id, subscription.user_id)
+                )
+                response.status_code = 202
+                response.headers["Location"] = f"/api/jobs/{job.id}"
+                return {"message": f"Deletion of subscription {subscription_id} started", "job": job.to_dict()}
+
+            # Delete the subscription
+            shard.delete(subscription)
+            shard.commit()
+            logger.info(f"Successfully deleted subscription {subscription_id}")
+        
+            return {"message": f"Subscription {subscription_id} deleted successfully"}
+        
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error deleting subscription {subscription_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
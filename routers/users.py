@@ -1,109 +1,111 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from database import get_db
-from models import UserSubscription, Plan, ServiceLog
-from typing import List
-import logging
-
-logger = logging.getLogger(__name__)
-router = APIRouter(prefix="/users", tags=["Users"])
-
-@router.get("")
-async def get_users(db: Session = Depends(get_db)):
-    """Get all users with their subscription status"""
-    try:
-        # Get unique users from subscriptions
-        users = db.query(UserSubscription.user_id).distinct().all()
-        user_list = []
-        
-        for (user_id,) in users:
-            # Get active subscription for user
-            active_subscription = db.query(UserSubscription).filter(
-                UserSubscription.user_id == user_id,
-                UserSubscription.is_active == True
-            ).first()
-            
-            # Get plan details if subscription exists
-            plan_details = None
-            if active_subscription:
-                plan = db.query(Plan).filter(Plan.id == active_subscription.plan_id).first()
-                plan_details = {
-                    "plan_id": plan.id,
-                    "plan_name": plan.name,
-                    "usage_count": active_subscription.usage_count,
-                    "usage_limit": plan.usage_limit
-                }
-            
-            # Get recent service logs
-            recent_logs = db.query(ServiceLog).filter(
-                ServiceLog.user_id == user_id
-            ).order_by(ServiceLog.timestamp.desc()).limit(5).all()
-            
-            user_list.append({
-                "user_id": user_id,
-                "has_active_subscription": active_subscription is not None,
-                "subscription_details": plan_details,
-                "recent_activity": [
-                    {
-                        "service": log.service_name,
-                        "endpoint": log.endpoint,
-                        "status": log.status,
-                        "timestamp": log.timestamp
-                    } for log in recent_logs
-                ]
-            })
-        
-        return user_list
-
-    except Exception as e:
-        logger.error(f"Error fetching users: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@router.get("/{user_id}")
-async def get_user(user_id: int, db: Session = Depends(get_db)):
-    """Get details for a specific user"""
-    try:
-        # Get active subscription
-        active_subscription = db.query(UserSubscription).filter(
-            UserSubscription.user_id == user_id,
-            UserSubscription.is_active == True
-        ).first()
-        
-        if not active_subscription:
-            return {
-                "user_id": user_id,
-                "has_active_subscription": False,
-                "subscription_details": None,
-                "recent_activity": []
-            }
-        
-        # Get plan details
-        plan = db.query(Plan).filter(Plan.id == active_subscription.plan_id).first()
-        
-        # Get recent service logs
-        recent_logs = db.query(ServiceLog).filter(
-            ServiceLog.user_id == user_id
-        ).order_by(ServiceLog.timestamp.desc()).limit(5).all()
-        
-        return {
-            "user_id": user_id,
-            "has_active_subscription": True,
-            "subscription_details": {
-                "plan_id": plan.id,
-                "plan_name": plan.name,
-                "usage_count": active_subscription.usage_count,
-                "usage_limit": plan.usage_limit
-            },
-            "recent_activity": [
-                {
-                    "service": log.service_name,
-                    "endpoint": log.endpoint,
-                    "status": log.status,
-                    "timestamp": log.timestamp
-                } for log in recent_logs
-            ]
-        }
-
-    except Exception as e:
-        logger.error(f"Error fetching user {user_id}: {e}")
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from database import get_read_db, each_shard
+from models import UserSubscription, Plan
+from services import log_store
+from services.quota import effective_usage
+from typing import List
+import logging
+
+logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/users", tags=["Users"])
+
+def _list_users(db: Session) -> list:
+    """Subscription status and recent activity of every user stored in ``db``"""
+    # Get unique users from subscriptions
+    users = db.query(UserSubscription.user_id).distinct().all()
+    user_list = []
+    
+    for (user_id,) in users:
+        # Get active subscription for user
+        active_subscription = db.query(UserSubscription).filter(
+            UserSubscription.user_id == user_id,
+            UserSubscription.is_active == True
+        ).first()
+        
+        # Get plan details if subscription exists
+        plan_details = None
+        if active_subscription:
+            plan = db.query(Plan).filter(Plan.id == active_subscription.plan_id).first()
+            plan_details = {
+                "plan_id": plan.id,
+                "plan_name": plan.name,
+                "usage_count": effective_usage(plan, active_subscription),
+                "usage_limit": plan.usage_limit
+            }
+        
+        # Get recent service logs
+        recent_logs = log_store.query_logs(db, user_id=user_id, newest_first=True, limit=5)
+        
+        user_list.append({
+            "user_id": user_id,
+            "has_active_subscription": active_subscription is not None,
+            "subscription_details": plan_details,
+            "recent_activity": [
+                {
+                    "service": log.service_name,
+                    "endpoint": log.endpoint,
+                    "status": log.status,
+                    "timestamp": log.timestamp
+                } for log in recent_logs
+            ]
+        })
+
+    return user_list
+
+@router.get("")
+async def get_users(db: Session = Depends(get_read_db)):
+    """Get all users with their subscription status"""
+    try:
+        return [user for part in each_shard(db, _list_users) for user in part]
+
+    except Exception as e:
+        logger.error(f"Error fetching users: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/{user_id}")
+async def get_user(user_id: int, db: Session = Depends(get_read_db)):
+    """Get details for a specific user"""
+    try:
+        # Get active subscription
+        active_subscription = db.query(UserSubscription).filter(
+            UserSubscription.user_id == user_id,
+            UserSubscription.is_active == True
+        ).first()
+        
+        if not active_subscription:
+            return {
+                "user_id": user_id,
+                "has_active_subscription": False,
+                "subscription_details": None,
+                "recent_activity": []
+            }
+        
+        # Get plan details
+        plan = db.query(Plan).filter(Plan.id == active_subscription.plan_id).first()
+        
+        # Get recent service logs
+        recent_logs = log_store.query_logs(db, user_id=user_id, newest_first=True, limit=5)
+        
+        return {
+            "user_id": user_id,
+            "has_active_subscription": True,
+            "subscription_details": {
+                "plan_id": plan.id,
+                "plan_name": plan.name,
+                "usage_count": effective_usage(plan, active_subscription),
+                "usage_limit": plan.usage_limit
+            },
+            "recent_activity": [
+                {
+                    "service": log.service_name,
+                    "endpoint": log.endpoint,
+                    "status": log.status,
+                    "timestamp": log.timestamp
+                } for log in recent_logs
+            ]
+        }
+
+    except Exception as e:
+        logger.error(f"Error fetching user {user_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
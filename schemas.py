@@ -1,77 +1,188 @@
-from pydantic import BaseModel
-from typing import List, Optional, Dict
-from datetime import datetime
-
-class PlanBase(BaseModel):
-    name: str
-    description: str
-    usage_limit: int
-
-class PlanCreate(PlanBase):
-    permissions: List[int] = []
-
-class PlanResponse(PlanBase):
-    id: int
-    
-    class Config:
-        from_attributes = True
-
-class PermissionCreate(BaseModel):
-    name: str
-    endpoint: str
-    description: Optional[str] = None
-
-class SubscriptionCreate(BaseModel):
-    user_id: int
-    plan_id: int
-
-class UsageResponse(BaseModel):
-    user_id: int
-    usage_count: int
-
-class ServiceLogCreate(BaseModel):
-    user_id: int
-    service_name: str
-    endpoint: str
-    status: str
-    error_message: Optional[str] = None
-    service_metadata: Optional[Dict] = None
-
-class ServiceLogResponse(BaseModel):
-    service_name: str
-    status: str
-    timestamp: datetime
-
-    class Config:
-        from_attributes = True
-
-class PaymentLogCreate(BaseModel):
-    user_id: int
-    amount: float
-    currency: str
-    status: str
-    stripe_payment_id: Optional[str] = None
-
-class PaymentLogResponse(PaymentLogCreate):
-    id: int
-    timestamp: datetime
-
-    class Config:
-        from_attributes = True
-
-class UserSubscriptionResponse(BaseModel):
-    id: int
-    user_id: int
-    plan_id: int
-    start_date: datetime
-    end_date: Optional[datetime] = None
-    is_active: bool
-    usage_count: int
-
-    class Config:
-        from_attributes = True
-
-class SubscriptionUpdate(BaseModel):
-    plan_id: Optional[int] = None
-    is_active: Optional[bool] = None
-    usage_count: Optional[int] = None
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Optional, Dict, Literal
+from datetime import datetime
+
+class PlanBase(BaseModel):
+    name: str
+    description: str
+    usage_limit: int
+    quota_period: Literal["none", "daily", "monthly", "rolling"] = "none"
+    # At most services.quota.MAX_ROLLING_DAYS
+    quota_period_days: Optional[int] = Field(default=None, gt=0, le=1000)
+
+    @model_validator(mode="after")
+    def check_rolling_period(self):
+        if self.quota_period == "rolling" and not self.quota_period_days:
+            raise ValueError("quota_period_days is required for a rolling quota period")
+        return self
+
+class PlanCreate(PlanBase):
+    permissions: List[int] = []
+
+class PlanUpdate(BaseModel):
+    """PUT /plans/{id}: the quota period and permissions stay as they are when omitted"""
+    name: str
+    description: str
+    usage_limit: int
+    quota_period: Optional[Literal["none", "daily", "monthly", "rolling"]] = None
+    quota_period_days: Optional[int] = Field(default=None, gt=0, le=1000)
+    permissions: Optional[List[int]] = None
+
+class PlanResponse(PlanBase):
+    id: int
+    restricted: bool = False
+    
+    class Config:
+        from_attributes = True
+
+class PermissionCreate(BaseModel):
+    name: str
+    endpoint: str
+    description: Optional[str] = None
+
+class PermissionResponse(PermissionCreate):
+    id: int
+
+    class Config:
+        from_attributes = True
+
+class SubscriptionCreate(BaseModel):
+    user_id: int
+    plan_id: int
+
+class UsageResponse(BaseModel):
+    user_id: int
+    usage_count: int
+
+class ServiceLogCreate(BaseModel):
+    user_id: int
+    service_name: str
+    endpoint: str
+    status: str
+    error_message: Optional[str] = None
+    service_metadata: Optional[Dict] = None
+
+class ServiceLogResponse(BaseModel):
+    service_name: str
+    status: str
+    timestamp: datetime
+
+    class Config:
+        from_attributes = True
+
+class PaymentLogCreate(BaseModel):
+    user_id: int
+    amount: float
+    currency: str
+    status: str
+    stripe_payment_id: Optional[str] = None
+
+class PaymentLogResponse(PaymentLogCreate):
+    id: int
+    timestamp: datetime
+
+    class Config:
+        from_attributes = True
+
+class UserSubscriptionResponse(BaseModel):
+    id: int
+    user_id: int
+    plan_id: int
+    start_date: datetime
+    end_date: Optional[datetime] = None
+    is_active: bool
+    usage_count: int
+
+    class Config:
+        from_attributes = True
+
+class SubscriptionUpdate(BaseModel):
+    plan_id: Optional[int] = None
+    is_active: Optional[bool] = None
+    usage_count: Optional[int] = None
+
+class SubscriptionBulkCreate(BaseModel):
+    subscriptions: List[SubscriptionCreate]
+
+class SubscriptionBulkUpdateItem(SubscriptionUpdate):
+    id: int
+
+class SubscriptionBulkUpdate(BaseModel):
+    subscriptions: List[SubscriptionBulkUpdateItem]
+
+class BulkRowError(BaseModel):
+    index: int
+    detail: str
+
+class BulkSubscriptionResult(BaseModel):
+    created: int = 0
+    updated: int = 0
+    errors: List[BulkRowError] = []
+
+class AccessBatchItem(BaseModel):
+    user_id: int
+    endpoint: str
+    cost: int = Field(default=1, ge=1)
+
+class AccessBatchRequest(BaseModel):
+    items: List[AccessBatchItem]
+
+class AccessBatchDecision(BaseModel):
+    user_id: int
+    endpoint: str
+    allowed: bool
+    reason: Optional[Literal["no_subscription", "no_plan", "forbidden", "quota_exceeded", "conflict"]] = None
+    current_usage: Optional[int] = None
+    usage_limit: Optional[int] = None
+    remaining: Optional[int] = None
+
+class AccessBatchResult(BaseModel):
+    allowed: int = 0
+    denied: int = 0
+    results: List[AccessBatchDecision] = []
+
+class LeaseCreate(BaseModel):
+    units: int = Field(gt=0)
+    ttl_seconds: Optional[int] = Field(default=None, gt=0)
+
+class LeaseRenew(BaseModel):
+    used: int = Field(ge=0)
+    units: int = Field(default=0, ge=0)
+    ttl_seconds: Optional[int] = Field(default=None, gt=0)
+
+class LeaseReturn(BaseModel):
+    used: int = Field(ge=0)
+
+class LeaseResponse(BaseModel):
+    lease_id: str
+    user_id: int
+    subscription_id: int
+    granted: int
+    used: int
+    remaining: int
+    expires_at: datetime
+
+class LeaseReturnResult(BaseModel):
+    lease_id: str
+    used: int
+    returned: int
+
+class OutboxJobResponse(BaseModel):
+    job_id: str = Field(validation_alias="id")
+    kind: str
+    user_id: int
+    status: str
+    attempts: int
+    next_attempt_at: Optional[datetime] = None
+    result: Optional[Dict] = None
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class OutboxJobAccepted(BaseModel):
+    job_id: str
+    status: str
+    status_url: str
@@ -0,0 +1,249 @@
+"""
+ORM-free fast path for the per-request access check.
+
+Deciding whether a call goes through needs a handful of plain values: the
+subscription's id, plan and counter, and the plan's limit and quota period.
+They are read with statements built once at import time, so every request
+reuses SQLAlchemy's cached compilation, executes on the session's Connection
+and gets plain tuples back. No ORM objects, identity map or unit of work are
+involved.
+
+Plans change rarely and are small, so their limits are kept in memory. The
+table is reloaded when the plans catalog version moves, or after
+CATALOG_MAX_AGE_SECONDS, the same staleness bound as the permission matrix.
+A plan id missing from the table is looked up once before being reported as
+missing, so a plan created by another worker is usable immediately.
+
+``resolve_batch`` decides many (user, endpoint, cost) items at once, for API
+gateways. It reads every subscription involved with one SELECT and decides
+the items in memory, in request order. Then it writes the new counters with
+one compare-and-set UPDATE that only matches rows still holding the counter
+values that were read. Subscriptions changed in between by a concurrent
+request are read again and their items decided again, up to
+BATCH_ATTEMPTS times.
+"""
+from collections import namedtuple
+from datetime import datetime
+import threading
+import time
+
+from sqlalchemy import bindparam, case, func, select, update
+from sqlalchemy.orm import Session
+
+from config import get_settings
+from models import Plan, UserSubscription
+from services import quota_events
+from services.catalog import plans_catalog
+from services.permission_matrix import get_permission_matrix, normalize_endpoint
+from services.quota import CONSUME_STATEMENT, period_epoch
+
+settings = get_settings()
+
+SubscriptionState = namedtuple(
+    "SubscriptionState", ("id", "plan_id", "usage_count", "period_epoch", "start_date")
+)
+PlanLimits = namedtuple(
+    "PlanLimits", ("id", "name", "usage_limit", "quota_period", "quota_period_days")
+)
+Decision = namedtuple("Decision", ("allowed", "reason", "usage", "usage_limit"))
+
+BATCH_ATTEMPTS = 3
+# Subscriptions per compare-and-set UPDATE; each one binds five parameters
+BATCH_CHUNK_SIZE = 500
+
+_subscriptions = UserSubscription.__table__
+
+SUBSCRIPTION_LOOKUP = (
+    select(
+        _subscriptions.c.id, _subscriptions.c.plan_id, _subscriptions.c.usage_count,
+        _subscriptions.c.period_epoch, _subscriptions.c.start_date
+    )
+    .where(_subscriptions.c.user_id == bindparam("user_id"))
+    .limit(1)
+)
+
+# The IN list is an expanding parameter, so batches of any size share one cached statement
+BATCH_LOOKUP = (
+    select(
+        _subscriptions.c.user_id, _subscriptions.c.id, _subscriptions.c.plan_id,
+        _subscriptions.c.usage_count, _subscriptions.c.period_epoch, _subscriptions.c.start_date
+    )
+    .where(_subscriptions.c.user_id.in_(bindparam("user_ids", expanding=True)))
+    .order_by(_subscriptions.c.id)
+)
+
+_PLAN_COLUMNS = (Plan.id, Plan.name, Plan.usage_limit, Plan.quota_period, Plan.quota_period_days)
+PLAN_LOOKUP = select(*_PLAN_COLUMNS).where(Plan.id == bindparam("plan_id"))
+
+class _PlanTable:
+    """Plan limits by id for the current plans catalog version"""
+
+    def __init__(self):
+        self._plans = None
+        self._version = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, plan_id: int):
+        plans = self._plans
+        if (
+            plans is None
+            or self._version != plans_catalog.version
+            or time.monotonic() - self._built_at >= settings.CATALOG_MAX_AGE_SECONDS
+        ):
+            plans = self._reload(db)
+        limits = plans.get(plan_id)
+        if limits is None:
+            # Plans live on the primary even when the session is a shard's
+            row = db.execute(PLAN_LOOKUP, {"plan_id": plan_id}).first()
+            if row is not None:
+                limits = PlanLimits(*row)
+                with self._lock:
+                    self._plans = {**self._plans, plan_id: limits}
+        return limits
+
+    def _reload(self, db: Session) -> dict:
+        # Read the version first so a write racing with the reload leaves it stale
+        version = plans_catalog.version
+        plans = {row[0]: PlanLimits(*row) for row in db.execute(select(*_PLAN_COLUMNS))}
+        with self._lock:
+            self._plans, self._version, self._built_at = plans, version, time.monotonic()
+        return plans
+
+plan_limits = _PlanTable()
+
+def find_subscription(connection, user_id: int):
+    """The user's ``SubscriptionState``, or None without a subscription"""
+    row = connection.execute(SUBSCRIPTION_LOOKUP, {"user_id": user_id}).first()
+    return SubscriptionState(*row) if row is not None else None
+
+def current_epoch(plan: PlanLimits, subscription: SubscriptionState, now: datetime = None) -> int:
+    return period_epoch(plan.quota_period, plan.quota_period_days, subscription.start_date, now)
+
+def usage_in_period(plan: PlanLimits, subscription: SubscriptionState, now: datetime = None) -> int:
+    """Usage in the current period; a counter from any other period reads as zero"""
+    if (subscription.period_epoch or 0) != current_epoch(plan, subscription, now):
+        return 0
+    return subscription.usage_count or 0
+
+def consume(connection, plan: PlanLimits, subscription: SubscriptionState, now: datetime = None):
+    """
+    Count one call against the plan's limit, resetting a counter from an earlier
+    period. Does not commit.
+
+    Returns:
+        The new usage count, or None if the limit was already reached.
+    """
+    row = connection.execute(CONSUME_STATEMENT, {
+        "subscription_id": subscription.id,
+        "usage_limit": plan.usage_limit,
+        "epoch": current_epoch(plan, subscription, now),
+    }).first()
+    return row[0] if row is not None else None
+
+def _states_of(connection, user_ids: set) -> dict:
+    """user id -> ``SubscriptionState`` of the user's first subscription"""
+    states = {}
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), BATCH_CHUNK_SIZE):
+        rows = connection.execute(BATCH_LOOKUP, {"user_ids": user_ids[start:start + BATCH_CHUNK_SIZE]})
+        for row in rows:
+            states.setdefault(row[0], SubscriptionState(*row[1:]))
+    return states
+
+def compare_and_set(connection, changes: list) -> set:
+    """
+    Apply (state, new usage, new epoch) counter changes to the rows that still
+    hold the values in ``state``; returns the ids that were updated.
+    """
+    applied = set()
+    column = _subscriptions.c
+    for start in range(0, len(changes), BATCH_CHUNK_SIZE):
+        chunk = changes[start:start + BATCH_CHUNK_SIZE]
+        ids = [state.id for state, _, _ in chunk]
+        read_usage = case({state.id: state.usage_count or 0 for state, _, _ in chunk}, value=column.id)
+        read_epoch = case({state.id: state.period_epoch or 0 for state, _, _ in chunk}, value=column.id)
+        statement = (
+            update(_subscriptions)
+            .where(
+                column.id.in_(ids),
+                func.coalesce(column.usage_count, 0) == read_usage,
+                func.coalesce(column.period_epoch, 0) == read_epoch
+            )
+            .values(
+                usage_count=case({state.id: usage for state, usage, _ in chunk}, value=column.id),
+                period_epoch=case({state.id: epoch for state, _, epoch in chunk}, value=column.id)
+            )
+            .returning(column.id)
+        )
+        applied.update(connection.execute(statement).scalars())
+    return applied
+
+def resolve_batch(db: Session, items: list, now: datetime = None) -> list:
+    """
+    Decide and count (user_id, endpoint, cost) items in one transaction, in
+    order: an item only gets the quota the items before it left. Does not commit.
+
+    Returns:
+        One ``Decision`` per item. ``reason`` is None when allowed, otherwise
+        "no_subscription", "no_plan", "forbidden", "quota_exceeded" or
+        "conflict" (the counter kept changing under concurrent requests).
+    """
+    now = now or datetime.utcnow()
+    connection = db.connection()
+    matrix = get_permission_matrix(db)
+    decisions = [None] * len(items)
+    pending = range(len(items))
+    for _ in range(BATCH_ATTEMPTS):
+        states = _states_of(connection, {items[index][0] for index in pending})
+        usage = {}
+        owners = {}
+        decided = {}
+        for index in pending:
+            user_id, endpoint, cost = items[index]
+            state = states.get(user_id)
+            if state is None:
+                decided[index] = (None, Decision(False, "no_subscription", None, None))
+                continue
+            plan = plan_limits.get(db, state.plan_id)
+            if plan is None:
+                decided[index] = (None, Decision(False, "no_plan", None, None))
+                continue
+            if state.id not in usage:
+                usage[state.id] = [state, plan, usage_in_period(plan, state, now), 0]
+                owners[state.id] = user_id
+            counter = usage[state.id]
+            used = counter[2]
+            if not matrix.allows(plan.id, normalize_endpoint(endpoint)):
+                decision = Decision(False, "forbidden", used, plan.usage_limit)
+            elif used + cost > plan.usage_limit:
+                decision = Decision(False, "quota_exceeded", used, plan.usage_limit)
+            else:
+                counter[2] += cost
+                counter[3] += cost
+                decision = Decision(True, None, counter[2], plan.usage_limit)
+            decided[index] = (state.id, decision)
+
+        changes = [
+            (state, used, current_epoch(plan, state, now))
+            for state, plan, used, consumed in usage.values() if consumed
+        ]
+        applied = compare_and_set(connection, changes)
+        conflicted = {state.id for state, _, _ in changes} - applied
+        for state, plan, used, consumed in usage.values():
+            if state.id in applied:
+                quota_events.record_usage(
+                    db, owners[state.id], state.id, used - consumed, used, plan.usage_limit
+                )
+        pending = []
+        for index, (subscription_id, decision) in decided.items():
+            if subscription_id in conflicted:
+                pending.append(index)
+            else:
+                decisions[index] = decision
+        if not pending:
+            return decisions
+
+    for index in pending:
+        decisions[index] = Decision(False, "conflict", None, None)
+    return decisions
@@ -0,0 +1,92 @@
+"""
+Versioned in-memory catalog of plans and permissions.
+
+Each catalog keeps one pre-serialized JSON snapshot with a strong ETag. Admin
+writes call ``invalidate()``, which bumps the version counter. The snapshot is
+only rebuilt from the database when its version is behind, or when it is older
+than CATALOG_MAX_AGE_SECONDS. The age limit bounds how stale other worker
+processes, which never see this process's version bumps, can get.
+"""
+from hashlib import sha256
+import json
+import threading
+import time
+
+from fastapi import Response
+from sqlalchemy.orm import Session
+
+from config import get_settings
+from models import Plan, Permission
+from schemas import PlanResponse, PermissionResponse
+from utils.metrics import record_cache_lookup
+
+settings = get_settings()
+
+class CatalogSnapshot:
+    __slots__ = ("version", "body", "etag", "built_at")
+
+    def __init__(self, version: int, body: bytes, etag: str, built_at: float):
+        self.version = version
+        self.body = body
+        self.etag = etag
+        self.built_at = built_at
+
+class Catalog:
+    def __init__(self, name: str, loader):
+        self.name = name
+        self.loader = loader
+        self.version = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Mark the current snapshot stale; call after every committed write"""
+        with self._lock:
+            self.version += 1
+
+    def snapshot(self, db: Session) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        if (
+            snapshot is not None
+            and snapshot.version == self.version
+            and time.monotonic() - snapshot.built_at < settings.CATALOG_MAX_AGE_SECONDS
+        ):
+            record_cache_lookup(f"catalog_{self.name}", True)
+            return snapshot
+
+        record_cache_lookup(f"catalog_{self.name}", False)
+        # Capture the version first so a write racing with the rebuild leaves it stale
+        version = self.version
+        body = json.dumps(self.loader(db), separators=(",", ":"), default=str).encode("utf-8")
+        etag = f'"{self.name}-{sha256(body).hexdigest()[:32]}"'
+        snapshot = CatalogSnapshot(version, body, etag, time.monotonic())
+        self._snapshot = snapshot
+        return snapshot
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """RFC 9110 weak comparison of an If-None-Match header against our ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (candidate.strip() for candidate in if_none_match.split(","))
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+def catalog_response(catalog: Catalog, db: Session, if_none_match: str = None) -> Response:
+    """Serve the catalog's pre-serialized body, or 304 when the client already has it"""
+    snapshot = catalog.snapshot(db)
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+def _load_plans(db: Session) -> list:
+    plans = db.query(Plan).order_by(Plan.id).all()
+    return [PlanResponse.model_validate(plan).model_dump(mode="json") for plan in plans]
+
+def _load_permissions(db: Session) -> list:
+    permissions = db.query(Permission).order_by(Permission.id).all()
+    return [PermissionResponse.model_validate(permission).model_dump(mode="json") for permission in permissions]
+
+plans_catalog = Catalog("plans", _load_plans)
+permissions_catalog = Catalog("permissions", _load_permissions)
@@ -0,0 +1,156 @@
+"""
+In-process stand-ins for the clients in services/clients.py, used for load
+testing. Set CLOUD_BACKEND_MODE=fake to swap them in.
+
+Every fake call blocks for the configured latency (plus uniform jitter), just
+like the synchronous SDKs it replaces, and fails with FakeBackendError at the
+configured error rate.
+"""
+import random
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+from config import get_settings
+
+settings = get_settings()
+
+BACKENDS = ["stripe", "auth0", "s3", "elasticsearch", "rabbitmq", "redis"]
+
+class FakeBackendError(Exception):
+    pass
+
+class FakeBackend:
+    def __init__(self, name: str, latency_ms: float, jitter_ms: float, error_rate: float):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        # Calls arrive from the threadpool and the outbox workers at once
+        self._lock = threading.Lock()
+
+    def call(self):
+        """Simulate one round trip: sleep, then maybe raise an injected error"""
+        with self._lock:
+            self.calls += 1
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise FakeBackendError(f"Injected {self.name} failure")
+
+def _build_backends() -> dict:
+    backends = {}
+    for name in BACKENDS:
+        override = settings.FAKE_BACKEND_OVERRIDES.get(name, {})
+        backends[name] = FakeBackend(
+            name,
+            latency_ms=override.get("latency_ms", settings.FAKE_BACKEND_LATENCY_MS),
+            jitter_ms=override.get("jitter_ms", settings.FAKE_BACKEND_JITTER_MS),
+            error_rate=override.get("error_rate", settings.FAKE_BACKEND_ERROR_RATE),
+        )
+    return backends
+
+backends = _build_backends()
+
+def configure(name: str = None, latency_ms: float = None, jitter_ms: float = None, error_rate: float = None):
+    """Change latency/error injection at runtime for one backend, or all when name is None"""
+    for backend in ([backends[name]] if name else backends.values()):
+        if latency_ms is not None:
+            backend.latency_ms = latency_ms
+        if jitter_ms is not None:
+            backend.jitter_ms = jitter_ms
+        if error_rate is not None:
+            backend.error_rate = error_rate
+
+# Stripe
+class FakePaymentIntent:
+    @staticmethod
+    def create(**kwargs):
+        backends["stripe"].call()
+        payment_id = f"pi_fake_{uuid.uuid4().hex[:24]}"
+        return SimpleNamespace(id=payment_id, client_secret=f"{payment_id}_secret", **kwargs)
+
+class FakeBalance:
+    @staticmethod
+    def retrieve(**kwargs):
+        backends["stripe"].call()
+        return SimpleNamespace(available=[], pending=[])
+
+stripe = SimpleNamespace(PaymentIntent=FakePaymentIntent, Balance=FakeBalance)
+
+# Elasticsearch
+class FakeElasticsearch:
+    def search(self, index: str = None, body: dict = None, **kwargs):
+        backends["elasticsearch"].call()
+        return {"hits": {"total": {"value": 0}, "hits": []}}
+
+    def ping(self):
+        backends["elasticsearch"].call()
+        return True
+
+es_client = FakeElasticsearch()
+
+# Redis
+class FakeRedis:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        backends["redis"].call()
+        with self._lock:
+            return self._data.get(key)
+
+    def set(self, key, value):
+        backends["redis"].call()
+        with self._lock:
+            self._data[key] = value.encode("utf-8") if isinstance(value, str) else value
+        return True
+
+    def ping(self):
+        backends["redis"].call()
+        return True
+
+redis_client = FakeRedis()
+
+# AWS S3
+class FakeS3Client:
+    def upload_fileobj(self, fileobj, bucket: str, key: str, **kwargs):
+        fileobj.read()
+        backends["s3"].call()
+
+    def head_bucket(self, Bucket: str):
+        backends["s3"].call()
+        return {}
+
+def get_s3_client():
+    return FakeS3Client()
+
+# Auth0
+def get_auth0_token():
+    backends["auth0"].call()
+    return {"access_token": f"fake-{uuid.uuid4().hex}", "token_type": "Bearer", "expires_in": 86400}
+
+# RabbitMQ
+class FakeConnection:
+    def close(self):
+        backends["rabbitmq"].call()
+
+class FakeChannel:
+    def __init__(self):
+        self.connection = FakeConnection()
+
+    def queue_declare(self, queue: str, **kwargs):
+        return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=0))
+
+    def basic_publish(self, exchange: str, routing_key: str, body, **kwargs):
+        backends["rabbitmq"].call()
+
+def get_rabbitmq_channel():
+    return FakeChannel()
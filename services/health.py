@@ -0,0 +1,226 @@
+"""
+Background latency probing of the database and the external services.
+
+A prober thread pings every dependency in HEALTH_PROBE_DEPENDENCIES once per
+HEALTH_PROBE_INTERVAL_SECONDS, all of them in parallel, and keeps the round
+trips of the last HEALTH_PROBE_WINDOW probes for rolling p50/p95/p99. After
+each round it renders the /health/ready response once, so serving it only
+reads a reference and never waits on a dependency.
+
+A dependency is unhealthy when its last probe failed, or did not answer within
+HEALTH_PROBE_TIMEOUT_SECONDS, or when the median of its last
+HEALTH_PROBE_RECENT probes exceeds its threshold in
+HEALTH_LATENCY_THRESHOLDS_MS. The service is ready while every dependency in
+HEALTH_READINESS_DEPENDENCIES is healthy; the others are only reported. A
+probe that hangs is not started again until it returns, so a dead dependency
+ties up one thread at most.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+import json
+import logging
+import statistics
+import threading
+import time
+
+from sqlalchemy import text
+
+from config import get_settings
+from database import engine, read_engine, shards
+from services import clients
+from utils.metrics import record_dependency_probe
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+def _probe_engine(bind):
+    def probe():
+        with bind.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    return probe
+
+def _probe_redis():
+    clients.redis_client.ping()
+
+def _probe_elasticsearch():
+    if not clients.es_client.ping():
+        raise ConnectionError("Elasticsearch did not answer the ping")
+
+def _probe_rabbitmq():
+    # Connecting is the round trip producers pay for every message
+    channel = clients.get_rabbitmq_channel()
+    channel.connection.close()
+
+def _probe_s3():
+    clients.get_s3_client().head_bucket(Bucket=settings.AWS_BUCKET_NAME)
+
+def _probe_stripe():
+    clients.stripe.Balance.retrieve()
+
+# Auth0 is left out: its client only issues tokens, which Auth0 meters
+PROBES = {
+    "redis": _probe_redis,
+    "elasticsearch": _probe_elasticsearch,
+    "rabbitmq": _probe_rabbitmq,
+    "s3": _probe_s3,
+    "stripe": _probe_stripe,
+}
+
+def _database_probes() -> dict:
+    """One probe per database: the primary, a separate read replica, each shard"""
+    probes = {"database": _probe_engine(engine)}
+    if read_engine is not engine:
+        probes["database_replica"] = _probe_engine(read_engine)
+    for shard, shard_engine in enumerate(shards.engines):
+        probes[f"database_shard_{shard}"] = _probe_engine(shard_engine)
+    return probes
+
+def _percentile(ordered: list, fraction: float):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+class Dependency:
+    """The rolling probe results of one dependency"""
+
+    def __init__(self, name: str, kind: str, probe, threshold_ms: float, required: bool):
+        self.name = name
+        self.kind = kind
+        self.probe = probe
+        self.threshold = threshold_ms / 1000 if threshold_ms is not None else None
+        self.required = required
+        # (round trip in seconds, error or None), oldest first
+        self.results = deque(maxlen=settings.HEALTH_PROBE_WINDOW)
+        self.pending = None
+        self.started = None
+
+    def run(self):
+        """Probe once; returns the round trip and the error, if any"""
+        started = time.perf_counter()
+        try:
+            self.probe()
+            error = None
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        return time.perf_counter() - started, error
+
+    def record(self, latency: float, error: str = None):
+        self.results.append((latency, error))
+        record_dependency_probe(self.name, latency, error is None)
+
+    def snapshot(self) -> dict:
+        latencies = sorted(latency for latency, error in self.results if error is None)
+        recent = [latency for latency, _ in list(self.results)[-settings.HEALTH_PROBE_RECENT:]]
+        last_latency, last_error = self.results[-1]
+        recent_latency = statistics.median(recent)
+        healthy = last_error is None and (self.threshold is None or recent_latency <= self.threshold)
+        return {
+            "healthy": healthy,
+            "required": self.required,
+            "latency_ms": _ms(last_latency),
+            "recent_ms": _ms(recent_latency),
+            "threshold_ms": _ms(self.threshold),
+            "p50_ms": _ms(_percentile(latencies, 0.50)),
+            "p95_ms": _ms(_percentile(latencies, 0.95)),
+            "p99_ms": _ms(_percentile(latencies, 0.99)),
+            "probes": len(self.results),
+            "failures": len(self.results) - len(latencies),
+            "error": last_error,
+        }
+
+def build_dependencies() -> list:
+    dependencies = []
+    for kind in settings.HEALTH_PROBE_DEPENDENCIES:
+        if kind == "database":
+            probes = _database_probes()
+        elif kind in PROBES:
+            probes = {kind: PROBES[kind]}
+        else:
+            raise ValueError(f"Unknown dependency in HEALTH_PROBE_DEPENDENCIES: {kind}")
+        for name, probe in probes.items():
+            dependencies.append(Dependency(
+                name, kind, probe,
+                threshold_ms=settings.HEALTH_LATENCY_THRESHOLDS_MS.get(kind),
+                required=kind in settings.HEALTH_READINESS_DEPENDENCIES
+            ))
+    return dependencies
+
+class Prober:
+    """Probes the dependencies on a background thread and caches readiness"""
+
+    def __init__(self, dependencies: list):
+        self.dependencies = dependencies
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+        # (ready, encoded body, monotonic time of the round), replaced whole
+        self._readiness = (False, self._render(False, "starting", {}), None)
+
+    def start(self):
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=max(len(self.dependencies), 1), thread_name_prefix="health")
+        self._thread = threading.Thread(target=self._loop, name="health-prober", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop probing; does not wait for probes stuck on a dependency"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.error(f"Error probing dependencies: {e}")
+            self._stop.wait(settings.HEALTH_PROBE_INTERVAL_SECONDS)
+
+    def probe_all(self) -> dict:
+        """Run one round of probes and cache the result; returns it"""
+        for dependency in self.dependencies:
+            if dependency.pending is None:
+                dependency.pending = self._executor.submit(dependency.run)
+                dependency.started = time.perf_counter()
+        wait([dependency.pending for dependency in self.dependencies], timeout=settings.HEALTH_PROBE_TIMEOUT_SECONDS)
+
+        for dependency in self.dependencies:
+            if dependency.pending.done():
+                dependency.record(*dependency.pending.result())
+                dependency.pending = None
+            else:
+                waited = time.perf_counter() - dependency.started
+                dependency.record(waited, f"No answer after {waited:.1f}s")
+
+        results = {dependency.name: dependency.snapshot() for dependency in self.dependencies}
+        unhealthy = [name for name, result in results.items() if result["required"] and not result["healthy"]]
+        for name in unhealthy:
+            logger.warning(f"Dependency {name} is unhealthy: {results[name]['error'] or 'slow'}")
+        ready = not unhealthy
+        self._readiness = (ready, self._render(ready, "ready" if ready else "not_ready", results), time.monotonic())
+        return results
+
+    def readiness(self) -> tuple:
+        """(ready, JSON body) from the last round; not ready once rounds stop coming"""
+        ready, body, rendered_at = self._readiness
+        stale_after = 2 * settings.HEALTH_PROBE_INTERVAL_SECONDS + settings.HEALTH_PROBE_TIMEOUT_SECONDS
+        if rendered_at is not None and time.monotonic() - rendered_at > stale_after:
+            return False, self._render(False, "stale", {})
+        return ready, body
+
+    @staticmethod
+    def _render(ready: bool, status: str, dependencies: dict) -> bytes:
+        return json.dumps({
+            "ready": ready,
+            "status": status,
+            "checked_at": datetime.utcnow().isoformat(),
+            "dependencies": dependencies,
+        }).encode()
+
+prober = Prober(build_dependencies())
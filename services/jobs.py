@@ -0,0 +1,125 @@
+"""
+In-process background jobs for long-running cascade deletes.
+
+A job runs on a small thread pool with its own database session and reports
+progress in a ``Job`` record served by GET /api/jobs/{job_id}. Jobs live in
+process memory: with several workers, poll the worker that answered the
+request, and expect unfinished jobs to be lost on restart. Every delete commits
+one chunk at a time, so a restarted delete simply resumes where it stopped.
+
+Deletes run as ``DELETE ... WHERE id IN (SELECT id ... LIMIT n)`` and commit
+after every chunk. That releases SQLite's write lock between chunks, so request
+traffic interleaves with a large cascade instead of waiting for all of it.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import logging
+import threading
+import time
+import uuid
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from config import get_settings
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+class Job:
+    def __init__(self, kind: str, target: int):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.target = target
+        self.status = "pending"
+        self.progress = {}
+        self.error = None
+        self.created_at = datetime.utcnow()
+        self.finished_at = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "target": self.target,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix="job")
+
+def get_job(job_id: str):
+    return _jobs.get(job_id)
+
+def list_jobs() -> list:
+    with _jobs_lock:
+        return list(_jobs.values())
+
+def submit_job(kind: str, target: int, func) -> Job:
+    """
+    Run ``func(job, db)`` in the background, or return the unfinished job that is
+    already working on the same target.
+    """
+    with _jobs_lock:
+        for job in _jobs.values():
+            if job.kind == kind and job.target == target and not job.done:
+                return job
+        job = Job(kind, target)
+        _jobs[job.id] = job
+        # Forget the oldest finished jobs beyond JOB_HISTORY_SIZE
+        while len(_jobs) > settings.JOB_HISTORY_SIZE:
+            oldest_id, oldest = next(iter(_jobs.items()))
+            if not oldest.done:
+                break
+            del _jobs[oldest_id]
+
+    _executor.submit(_run, job, func)
+    return job
+
+def _run(job: Job, func):
+    job.status = "running"
+    db = SessionLocal()
+    try:
+        func(job, db)
+        job.status = "succeeded"
+        logger.info(f"Job {job.id} ({job.kind} {job.target}) finished: {job.progress}")
+    except Exception as e:
+        db.rollback()
+        job.status = "failed"
+        job.error = str(e)
+        logger.error(f"Job {job.id} ({job.kind} {job.target}) failed: {e}")
+    finally:
+        job.finished_at = datetime.utcnow()
+        db.close()
+
+def delete_in_chunks(db: Session, job: Job, model, *criteria, chunk_size: int = None) -> int:
+    """
+    Delete the rows of ``model`` matching ``criteria`` in chunks, committing after
+    each one, and count them in ``job.progress`` under the model's table name.
+    """
+    chunk_size = chunk_size or settings.DELETE_CHUNK_SIZE
+    table = model.__tablename__
+    deleted = job.progress.setdefault(table, 0)
+    while True:
+        chunk = select(model.id).where(*criteria).limit(chunk_size).scalar_subquery()
+        result = db.execute(
+            delete(model).where(model.id.in_(chunk)).execution_options(synchronize_session=False)
+        )
+        db.commit()
+        deleted += result.rowcount
+        job.progress[table] = deleted
+        if result.rowcount < chunk_size:
+            return deleted
+        # Give waiting writers a chance at the lock before the next chunk
+        time.sleep(0)
@@ -0,0 +1,589 @@
+"""
+Month-partitioned storage for service logs.
+
+Service logs live in one table per UTC month, ``service_logs_YYYYMM``, and
+every read and write goes through this module. Because of that:
+
+- inserts only touch the current month's table and indexes;
+- time-bounded reads only open the partitions that overlap the range;
+- retention drops a whole month with DROP TABLE instead of deleting rows.
+
+Rows are dictionary encoded. ``service_name``, ``endpoint`` and ``status`` take
+a handful of distinct values, so each is interned once in
+``service_log_dictionary`` and rows store its small integer id. Timestamps are
+stored as integer microseconds since the Unix epoch, and metadata as compact
+JSON bytes, zlib-compressed when that is shorter. The dictionary is cached in
+process in both directions, so steady-state writes and reads do no extra
+lookups. A string interned by a transaction is cached only once that
+transaction commits, so a rollback can never leave a dangling id in the cache.
+
+Reads decode rows back into ``LogRow`` tuples with the attribute names the
+``service_logs`` table used to have (``log.service_name``, ``log.timestamp``...).
+The log endpoints do not need to know about the layout. Row ids are only
+unique within their partition.
+
+The partitions that exist are cached per engine. A partition created by
+another worker shows up on the next cache refresh, after at most
+CATALOG_MAX_AGE_SECONDS. A partition dropped by another worker is noticed
+the first time a query trips over it.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+import json
+import logging
+import re
+import threading
+import time
+import zlib
+
+from sqlalchemy import (
+    Column, Index, Integer, LargeBinary, MetaData, String, Table, event, inspect, insert, select, delete,
+    union_all, literal, func
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex, CreateTable, DropTable
+from sqlalchemy.types import TypeDecorator
+
+from config import get_settings
+from utils import tracing
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+TABLE_PREFIX = "service_logs"
+_PARTITION_NAME = re.compile(rf"^{TABLE_PREFIX}_(\d{{6}})$")
+_UNENCODED_NAME = re.compile(rf"^{TABLE_PREFIX}_\d{{6}}_unencoded$")
+
+# Partition tables are kept out of Base.metadata so create_all/drop_all leave them alone
+partition_metadata = MetaData()
+_tables = {}
+# One INSERT per partition, built once so writes reuse its cached compilation
+_inserts = {}
+_tables_lock = threading.Lock()
+
+LOG_COLUMNS = ("id", "user_id", "service_name", "endpoint", "status", "error_message", "service_metadata", "timestamp")
+LogRow = namedtuple("LogRow", LOG_COLUMNS)
+
+# Metadata longer than this is compressed if that makes it shorter
+_COMPRESS_METADATA_OVER = 64
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+class EpochMicroseconds(TypeDecorator):
+    """A naive UTC datetime stored as integer microseconds since the Unix epoch"""
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, int):
+            return value
+        return (value - _UNIX_EPOCH) // _MICROSECOND
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return _UNIX_EPOCH + value * _MICROSECOND
+
+def encode_metadata(value):
+    """Compact JSON bytes for a metadata dict (or JSON string), zlib-compressed when that is shorter"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    raw = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    if len(raw) > _COMPRESS_METADATA_OVER:
+        compressed = zlib.compress(raw)
+        # zlib output starts with 0x78 ("x"), which no JSON text can start with
+        if len(compressed) < len(raw):
+            return compressed
+    return raw
+
+def decode_metadata(value):
+    """The JSON string ``encode_metadata`` was given"""
+    if value is None:
+        return None
+    if value[:1] == b"x":
+        value = zlib.decompress(value)
+    return value.decode("utf-8")
+
+dictionary_table = Table(
+    "service_log_dictionary", partition_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("value", String, nullable=False, unique=True),
+)
+
+_PENDING_KEY = "service_log_dictionary_pending"
+
+class _Dictionary:
+    """
+    Interned strings of the low-cardinality log columns, cached per engine in
+    both directions. Ids interned by a transaction wait in the connection's
+    ``info`` until it commits.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._values = {}
+        self._watched = set()
+        self._lock = threading.Lock()
+
+    def _remember(self, bind, pairs):
+        with self._lock:
+            ids = self._ids.setdefault(bind, {})
+            values = self._values.setdefault(bind, {})
+            for id, value in pairs:
+                ids[value] = id
+                values[id] = value
+
+    def _watch(self, bind):
+        with self._lock:
+            if bind in self._watched:
+                return
+            event.listen(bind, "commit", self._on_commit)
+            event.listen(bind, "rollback", self._on_rollback)
+            self._watched.add(bind)
+
+    def _on_commit(self, connection):
+        pending = connection.info.pop(_PENDING_KEY, None)
+        if pending:
+            self._remember(connection.engine, ((id, value) for value, id in pending.items()))
+
+    def _on_rollback(self, connection):
+        connection.info.pop(_PENDING_KEY, None)
+
+    def intern(self, connection, value: str) -> int:
+        """The id of ``value``, added to the dictionary in the caller's transaction if it is new"""
+        bind = connection.engine
+        id = self._ids.get(bind, {}).get(value)
+        if id is not None:
+            return id
+        pending = connection.info.get(_PENDING_KEY, {})
+        if value in pending:
+            return pending[value]
+
+        self._watch(bind)
+        statement = insert(dictionary_table).values(value=value)
+        if connection.dialect.name == "sqlite":
+            # Another worker may intern the same string first
+            statement = statement.prefix_with("OR IGNORE")
+        created = connection.execute(statement).rowcount == 1
+        id = connection.execute(select(dictionary_table.c.id).where(dictionary_table.c.value == value)).scalar_one()
+        if created:
+            connection.info.setdefault(_PENDING_KEY, {})[value] = id
+        else:
+            self._remember(bind, [(id, value)])
+        return id
+
+    def lookup(self, connection, value: str):
+        """The id of ``value``, or None if it was never interned"""
+        bind = connection.engine
+        id = self._ids.get(bind, {}).get(value)
+        if id is None:
+            id = connection.execute(
+                select(dictionary_table.c.id).where(dictionary_table.c.value == value)
+            ).scalar_one_or_none()
+            if id is not None:
+                self._remember(bind, [(id, value)])
+        return id
+
+    def values(self, connection, ids: set) -> dict:
+        """Id -> string for every id in ``ids``"""
+        bind = connection.engine
+        known = self._values.get(bind, {})
+        missing = [id for id in ids if id not in known]
+        if missing:
+            self._remember(bind, connection.execute(
+                select(dictionary_table.c.id, dictionary_table.c.value).where(dictionary_table.c.id.in_(missing))
+            ).all())
+            known = self._values[bind]
+        return known
+
+    def forget(self, bind):
+        with self._lock:
+            self._ids.pop(bind, None)
+            self._values.pop(bind, None)
+
+dictionary = _Dictionary()
+
+def month_key(timestamp: datetime) -> int:
+    """202406 for any time in June 2024"""
+    return timestamp.year * 100 + timestamp.month
+
+def month_bounds(key: int) -> tuple:
+    """[start, end) of the month a partition key names"""
+    year, month = divmod(key, 100)
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+def partition_table(key: int) -> Table:
+    table = _tables.get(key)
+    if table is not None:
+        return table
+    with _tables_lock:
+        table = _tables.get(key)
+        if table is None:
+            name = f"{TABLE_PREFIX}_{key}"
+            table = Table(
+                name, partition_metadata,
+                Column("id", Integer, primary_key=True),
+                Column("user_id", Integer, nullable=False),
+                Column("service_id", Integer, nullable=False),
+                Column("endpoint_id", Integer, nullable=False),
+                Column("status_id", Integer, nullable=False),
+                Column("error_message", String, nullable=True),
+                Column("service_metadata", LargeBinary, nullable=True),
+                Column("timestamp", EpochMicroseconds, nullable=False),
+                Index(f"ix_{name}_user_id_timestamp", "user_id", "timestamp"),
+                Index(f"ix_{name}_service_id_timestamp", "service_id", "timestamp"),
+            )
+            _tables[key] = table
+            _inserts[key] = insert(table)
+    return table
+
+class _PartitionCache:
+    """Partition keys known to exist, per engine"""
+
+    def __init__(self):
+        self._keys = {}
+        self._loaded_at = {}
+        self._lock = threading.Lock()
+
+    def known(self, bind, refresh: bool = False) -> set:
+        keys = self._keys.get(bind)
+        if (
+            refresh or keys is None
+            or time.monotonic() - self._loaded_at[bind] >= settings.CATALOG_MAX_AGE_SECONDS
+        ):
+            with bind.connect() as connection:
+                names = inspect(connection).get_table_names()
+            keys = {int(match.group(1)) for match in map(_PARTITION_NAME.match, names) if match}
+            with self._lock:
+                self._keys[bind] = keys
+                self._loaded_at[bind] = time.monotonic()
+        return keys
+
+    def keys(self, bind, refresh: bool = False) -> list:
+        return sorted(self.known(bind, refresh))
+
+    def add(self, bind, key: int):
+        with self._lock:
+            if bind in self._keys:
+                self._keys[bind] = self._keys[bind] | {key}
+
+    def discard(self, bind, key: int):
+        with self._lock:
+            if bind in self._keys:
+                self._keys[bind] = self._keys[bind] - {key}
+
+partitions = _PartitionCache()
+
+def _bind_of(db):
+    return db.get_bind() if isinstance(db, Session) else db.engine
+
+def ensure_partition(connection, key: int) -> Table:
+    """
+    The partition table for ``key``, created with its indexes if it does not
+    exist yet. The DDL runs on the caller's connection: on SQLite a second
+    connection would wait for the write lock the caller may already hold.
+    """
+    table = partition_table(key)
+    if key not in partitions.known(connection.engine):
+        dictionary_table.create(connection, checkfirst=True)
+        connection.execute(CreateTable(table, if_not_exists=True))
+        for index in table.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
+        partitions.add(connection.engine, key)
+    return table
+
+def _insert(connection, key: int, values):
+    """
+    Insert into a partition. If the cache wrongly believes the partition exists
+    (its creating transaction rolled back, or another worker dropped it), create
+    it and retry. A missing table fails at prepare time and leaves the
+    transaction usable.
+    """
+    ensure_partition(connection, key)
+    try:
+        return connection.execute(_inserts[key], values)
+    except OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+        partitions.discard(connection.engine, key)
+        ensure_partition(connection, key)
+        return connection.execute(_inserts[key], values)
+
+def prepare_partitions(bind, now: datetime = None):
+    """Create this month's and next month's partitions ahead of the writes that need them"""
+    now = now or datetime.utcnow()
+    this_month = month_key(now)
+    next_month = this_month + 89 if this_month % 100 == 12 else this_month + 1
+    with bind.begin() as connection:
+        for key in (this_month, next_month):
+            ensure_partition(connection, key)
+    for key in (this_month, next_month):
+        partitions.add(bind, key)
+
+def drop_partition(bind, key: int):
+    """Drop one month of logs at once"""
+    with bind.begin() as connection:
+        connection.execute(DropTable(partition_table(key), if_exists=True))
+    partitions.discard(bind, key)
+    logger.info(f"Dropped service log partition {TABLE_PREFIX}_{key}")
+
+def drop_all_partitions(bind):
+    """Drop every partition, the dictionary, and the pre-partitioning service_logs table if it is still around"""
+    for key in partitions.keys(bind, refresh=True):
+        drop_partition(bind, key)
+    with bind.begin() as connection:
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {TABLE_PREFIX}")
+        dictionary_table.drop(connection, checkfirst=True)
+    dictionary.forget(bind)
+
+def list_partitions(bind) -> list:
+    """Existing partitions with their month range, oldest first"""
+    result = []
+    for key in partitions.keys(bind, refresh=True):
+        start, end = month_bounds(key)
+        result.append({"partition": f"{TABLE_PREFIX}_{key}", "key": key, "start": start, "end": end})
+    return result
+
+def add_log(
+    db,
+    user_id: int,
+    service_name: str,
+    endpoint: str,
+    status: str,
+    error_message: str = None,
+    service_metadata: dict = None,
+    timestamp: datetime = None
+):
+    """
+    Insert one log row into its month's partition as part of the transaction of
+    ``db`` (a Session or a Connection). Returns the stored values as a ``LogRow``.
+    """
+    timestamp = timestamp or datetime.utcnow()
+    if isinstance(service_metadata, dict):
+        service_metadata = json.dumps(service_metadata)
+    values = {
+        "user_id": user_id,
+        "service_name": service_name,
+        "endpoint": endpoint,
+        "status": status,
+        "error_message": error_message,
+        "service_metadata": service_metadata,
+        "timestamp": timestamp,
+    }
+    connection = db.connection() if isinstance(db, Session) else db
+    key = month_key(timestamp)
+    with tracing.span("service_log.add", **{"app.service_name": service_name, "app.log_partition": key}):
+        # Creates the dictionary table too, before the first string is interned
+        ensure_partition(connection, key)
+        result = _insert(connection, key, _encode(connection, values))
+    return LogRow(id=result.inserted_primary_key[0], **values)
+
+def _encode(connection, row: dict) -> dict:
+    intern = dictionary.intern
+    return {
+        "user_id": row["user_id"],
+        "service_id": intern(connection, row["service_name"]),
+        "endpoint_id": intern(connection, row["endpoint"]),
+        "status_id": intern(connection, row["status"]),
+        "error_message": row.get("error_message"),
+        "service_metadata": encode_metadata(row.get("service_metadata")),
+        "timestamp": row["timestamp"],
+    }
+
+def _decode(connection, rows: list) -> list:
+    values = dictionary.values(connection, {id for row in rows for id in row[2:5]})
+    return [
+        LogRow(id, user_id, values[service_id], values[endpoint_id], values[status_id],
+               error_message, decode_metadata(service_metadata), timestamp)
+        for id, user_id, service_id, endpoint_id, status_id, error_message, service_metadata, timestamp in rows
+    ]
+
+def decode_rows(connection, rows: list) -> list:
+    """Rows selected from a partition table as dicts keyed by LOG_COLUMNS"""
+    return [row._asdict() for row in _decode(connection, rows)]
+
+def insert_logs(connection, rows: list):
+    """Bulk insert log dicts (with timestamps), grouped by partition"""
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(month_key(row["timestamp"]), []).append(row)
+    for key, batch in grouped.items():
+        ensure_partition(connection, key)
+        _insert(connection, key, [_encode(connection, row) for row in batch])
+
+def _partition_keys(bind, start: datetime = None, end: datetime = None, refresh: bool = False) -> list:
+    keys = partitions.keys(bind, refresh)
+    if start is not None:
+        keys = [key for key in keys if month_bounds(key)[1] > start]
+    if end is not None:
+        keys = [key for key in keys if month_bounds(key)[0] < end]
+    return keys
+
+def _filtered(table: Table, user_id, service_id, start, end):
+    statement = select(table)
+    if user_id is not None:
+        statement = statement.where(table.c.user_id == user_id)
+    if service_id is not None:
+        statement = statement.where(table.c.service_id == service_id)
+    if start is not None:
+        statement = statement.where(table.c.timestamp >= start)
+    if end is not None:
+        statement = statement.where(table.c.timestamp < end)
+    return statement
+
+def _with_retry(db, bind, run):
+    """Call ``run(refresh=False)``; if another worker dropped a partition meanwhile, refresh and retry once"""
+    try:
+        return run(False)
+    except OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+        db.rollback()
+        return run(True)
+
+def query_logs(
+    db: Session,
+    user_id: int = None,
+    service_name: str = None,
+    start: datetime = None,
+    end: datetime = None,
+    newest_first: bool = False,
+    limit: int = None
+) -> list:
+    """
+    Log rows matching every given filter as ``LogRow`` tuples, ordered by time.
+    Only partitions overlapping [start, end) are read. With a limit they are
+    read one at a time, in order, until enough rows are found.
+    """
+    bind = _bind_of(db)
+
+    def run(refresh: bool) -> list:
+        connection = db.connection() if isinstance(db, Session) else db
+        service_id = None
+        if service_name is not None:
+            service_id = dictionary.lookup(connection, service_name)
+            if service_id is None:
+                return []
+        keys = _partition_keys(bind, start, end, refresh)
+        if newest_first:
+            keys = keys[::-1]
+        if limit is None:
+            statements = [_filtered(partition_table(key), user_id, service_id, start, end) for key in keys]
+            if not statements:
+                return []
+            combined = union_all(*statements).subquery() if len(statements) > 1 else statements[0].subquery()
+            ordering = combined.c.timestamp.desc() if newest_first else combined.c.timestamp
+            rows = connection.execute(select(combined).order_by(ordering)).all()
+        else:
+            rows = []
+            for key in keys:
+                table = partition_table(key)
+                ordering = table.c.timestamp.desc() if newest_first else table.c.timestamp
+                statement = _filtered(table, user_id, service_id, start, end)
+                rows.extend(connection.execute(statement.order_by(ordering).limit(limit - len(rows))))
+                if len(rows) >= limit:
+                    break
+        return _decode(connection, rows)
+
+    return _with_retry(db, bind, run)
+
+def has_logs(db: Session, user_id: int) -> bool:
+    bind = _bind_of(db)
+
+    def run(refresh: bool) -> bool:
+        for key in _partition_keys(bind, refresh=refresh):
+            table = partition_table(key)
+            if db.execute(select(literal(1)).where(table.c.user_id == user_id).limit(1)).first():
+                return True
+        return False
+
+    return _with_retry(db, bind, run)
+
+def count_logs(db: Session) -> dict:
+    """Row count per partition"""
+    bind = _bind_of(db)
+    return {
+        f"{TABLE_PREFIX}_{key}": db.execute(select(func.count()).select_from(partition_table(key))).scalar()
+        for key in _partition_keys(bind, refresh=True)
+    }
+
+def delete_user_logs(db: Session, user_id: int, chunk_size: int, on_chunk=None) -> int:
+    """Delete a user's logs from every partition in chunks, committing after each one"""
+    bind = _bind_of(db)
+    deleted = 0
+    for key in _partition_keys(bind, refresh=True):
+        table = partition_table(key)
+        while True:
+            chunk = select(table.c.id).where(table.c.user_id == user_id).limit(chunk_size).scalar_subquery()
+            result = db.execute(delete(table).where(table.c.id.in_(chunk)))
+            db.commit()
+            deleted += result.rowcount
+            if on_chunk:
+                on_chunk(deleted)
+            if result.rowcount < chunk_size:
+                break
+            time.sleep(0)
+    return deleted
+
+def _copy_legacy_rows(bind, name: str, chunk_size: int) -> int:
+    """Re-insert the rows of a table with string columns through ``insert_logs``, then drop it"""
+    legacy = Table(name, MetaData(), autoload_with=bind)
+    moved = 0
+    last_id = 0
+    while True:
+        with bind.begin() as connection:
+            rows = [dict(row._mapping) for row in connection.execute(
+                select(legacy).where(legacy.c.id > last_id).order_by(legacy.c.id).limit(chunk_size)
+            )]
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            for row in rows:
+                row.pop("id")
+                row["timestamp"] = row["timestamp"] or datetime.utcnow()
+            insert_logs(connection, rows)
+            moved += len(rows)
+    with bind.begin() as connection:
+        connection.execute(DropTable(legacy))
+    return moved
+
+def migrate_legacy_table(bind, chunk_size: int = 50_000) -> int:
+    """
+    Move rows stored with plain string columns into encoded partitions: the old
+    unpartitioned service_logs table, and partitions created before dictionary
+    encoding. Each old partition is renamed aside, copied back and dropped.
+    """
+    with bind.connect() as connection:
+        inspector = inspect(connection)
+        names = inspector.get_table_names()
+        unencoded = [
+            name for name in names
+            if _PARTITION_NAME.match(name) and "service_name" in {column["name"] for column in inspector.get_columns(name)}
+        ]
+        legacy_indexes = {name: [index["name"] for index in inspector.get_indexes(name)] for name in unencoded}
+        # Left behind by a migration that stopped after renaming
+        set_aside = [name for name in names if _UNENCODED_NAME.match(name)]
+
+    moved = 0
+    if TABLE_PREFIX in names:
+        moved += _copy_legacy_rows(bind, TABLE_PREFIX, chunk_size)
+    for name in set_aside:
+        moved += _copy_legacy_rows(bind, name, chunk_size)
+    for name in unencoded:
+        aside = f"{name}_unencoded"
+        with bind.begin() as connection:
+            # The encoded partition reuses these index names
+            for index in legacy_indexes[name]:
+                connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index}")
+            connection.exec_driver_sql(f"ALTER TABLE {name} RENAME TO {aside}")
+        partitions.discard(bind, int(_PARTITION_NAME.match(name).group(1)))
+        moved += _copy_legacy_rows(bind, aside, chunk_size)
+    if moved:
+        logger.info(f"Moved {moved} service log rows into encoded monthly partitions")
+    return moved
@@ -0,0 +1,342 @@
+"""
+Transactional outbox for calls to external services.
+
+An endpoint that has to call Stripe or RabbitMQ does not make the call itself.
+It adds an ``OutboxJob`` row with ``enqueue``, in the same transaction that
+counts the call against the user's quota (``check_access(..., atomic=True)``),
+and answers 202 with the job id. The quota count and the job therefore commit
+or roll back together, and the caller never waits on the upstream API.
+
+A dispatcher thread claims due jobs with one ``UPDATE ... RETURNING`` per
+database (each shard when sharded). A claim marks the job running until
+OUTBOX_CLAIM_TIMEOUT_SECONDS from now, and the job is handed to a pool of
+OUTBOX_WORKERS threads. Several processes can dispatch from the same tables
+without taking the same job twice. A job left running by a crashed process
+becomes due again once its claim runs out.
+
+A failed attempt is retried with exponential backoff and jitter, up to
+OUTBOX_MAX_ATTEMPTS attempts. After that, the job is marked failed. Every job
+has an idempotency key, taken from the client's Idempotency-Key header or
+generated. The key, prefixed with the user id because client keys are only
+unique per user, is passed to the upstream API, so a retry after a crash
+does not charge or publish twice. A request repeating a key the user already
+used gets the existing job back and is not counted again.
+
+Finished jobs are deleted after OUTBOX_RETENTION_HOURS.
+"""
+from datetime import datetime, timedelta
+import logging
+import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pika
+from fastapi import HTTPException
+from sqlalchemy import delete, event, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from config import get_settings
+from database import SessionLocal, shards, shard_sessions
+from models import OutboxJob, PaymentLog
+from services.clients import stripe, get_rabbitmq_channel
+from utils.metrics import record_outbox_job, track_external_call
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_jobs = OutboxJob.__table__
+_WAKE_KEY = "outbox_wake"
+
+# Payments: create the PaymentIntent, then record it with the job's result
+def _create_payment(db: Session, job) -> dict:
+    payload = job.payload
+    with track_external_call("stripe"):
+        payment_intent = stripe.PaymentIntent.create(
+            amount=payload["amount"],
+            currency=payload["currency"],
+            idempotency_key=upstream_key(job)
+        )
+    db.add(PaymentLog(
+        user_id=job.user_id,
+        amount=payload["amount"] / 100,
+        currency=payload["currency"],
+        status="success",
+        stripe_payment_id=payment_intent.id
+    ))
+    return {"stripe_payment_id": payment_intent.id, "client_secret": payment_intent.client_secret}
+
+def _payment_failed(db: Session, job):
+    payload = job.payload
+    db.add(PaymentLog(
+        user_id=job.user_id,
+        amount=payload["amount"] / 100,
+        currency=payload["currency"],
+        status="failed"
+    ))
+
+# Queue messages: consumers can drop redeliveries by message_id
+def _publish_message(db: Session, job) -> dict:
+    payload = job.payload
+    with track_external_call("rabbitmq"):
+        channel = get_rabbitmq_channel()
+        channel.queue_declare(queue=payload["queue"])
+        channel.basic_publish(
+            exchange='',
+            routing_key=payload["queue"],
+            body=payload["body"],
+            properties=pika.BasicProperties(message_id=upstream_key(job))
+        )
+    return {"queue": payload["queue"]}
+
+# kind -> (handler, called once when the job finally fails or None)
+HANDLERS = {
+    "payment": (_create_payment, _payment_failed),
+    "queue_message": (_publish_message, None),
+}
+
+def upstream_key(job) -> str:
+    """
+    The idempotency key sent to Stripe and RabbitMQ. Client keys are only
+    unique per user, while Stripe's are account wide, so they carry the user.
+    """
+    return f"{job.user_id}:{job.idempotency_key}"
+
+def find_existing(db: Session, kind: str, user_id: int, payload: dict, idempotency_key: str):
+    """
+    The job the user already queued with ``idempotency_key``, or None; 409 if
+    that job was for a different request.
+    """
+    existing = db.query(OutboxJob).filter(
+        OutboxJob.user_id == user_id,
+        OutboxJob.idempotency_key == idempotency_key
+    ).first()
+    if existing and (existing.kind != kind or existing.payload != payload):
+        raise HTTPException(
+            status_code=409,
+            detail="Idempotency-Key was already used for a different request"
+        )
+    return existing
+
+def enqueue(db: Session, kind: str, user_id: int, payload: dict, idempotency_key: str = None) -> OutboxJob:
+    """
+    Add a job to ``db``'s transaction; the caller commits. A key the user has
+    already used returns that job instead, and rolls the transaction back so
+    the repeated request is not counted again.
+    """
+    if idempotency_key:
+        existing = find_existing(db, kind, user_id, payload, idempotency_key)
+        if existing:
+            db.rollback()
+            return existing
+
+    job_id = uuid.uuid4().hex
+    job = OutboxJob(
+        id=job_id,
+        kind=kind,
+        user_id=user_id,
+        idempotency_key=idempotency_key or job_id,
+        payload=payload,
+        status="pending",
+        attempts=0,
+        next_attempt_at=datetime.utcnow(),
+        created_at=datetime.utcnow()
+    )
+    db.add(job)
+    try:
+        db.flush()
+    except IntegrityError:
+        # A concurrent request with the same key inserted its job first
+        db.rollback()
+        existing = find_existing(db, kind, user_id, payload, idempotency_key)
+        if existing is None:
+            raise
+        return existing
+    db.info[_WAKE_KEY] = True
+    return job
+
+def get_job(db: Session, user_id: int, job_id: str):
+    job = db.get(OutboxJob, job_id)
+    return job if job is not None and job.user_id == user_id else None
+
+def list_jobs(db: Session, user_id: int, status: str = None, limit: int = 50) -> list:
+    query = db.query(OutboxJob).filter(OutboxJob.user_id == user_id)
+    if status:
+        query = query.filter(OutboxJob.status == status)
+    return query.order_by(OutboxJob.created_at.desc()).limit(limit).all()
+
+def backoff(attempts: int) -> timedelta:
+    """Delay before the next attempt: exponential, capped, with jitter"""
+    delay = min(
+        settings.OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1),
+        settings.OUTBOX_BACKOFF_MAX_SECONDS
+    )
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+def claim(db: Session, limit: int, now: datetime = None) -> list:
+    """Mark up to ``limit`` due jobs as running and return them; commits"""
+    now = now or datetime.utcnow()
+    due = (_jobs.c.status.in_(("pending", "running")), _jobs.c.next_attempt_at <= now)
+    chunk = select(_jobs.c.id).where(*due).order_by(_jobs.c.next_attempt_at).limit(limit).scalar_subquery()
+    claimed = db.execute(
+        update(_jobs)
+        .where(_jobs.c.id.in_(chunk), *due)
+        .values(
+            status="running",
+            attempts=_jobs.c.attempts + 1,
+            next_attempt_at=now + timedelta(seconds=settings.OUTBOX_CLAIM_TIMEOUT_SECONDS)
+        )
+        .returning(_jobs.c.id, _jobs.c.kind, _jobs.c.user_id, _jobs.c.idempotency_key,
+                   _jobs.c.payload, _jobs.c.attempts)
+    ).all()
+    db.commit()
+    return claimed
+
+def _finish(db: Session, job, **values) -> bool:
+    """Update the job unless another claim has taken it over since; does not commit"""
+    return db.execute(
+        update(_jobs)
+        .where(_jobs.c.id == job.id, _jobs.c.status == "running", _jobs.c.attempts == job.attempts)
+        .values(**values)
+    ).rowcount == 1
+
+def run_job(db: Session, job, now: datetime = None):
+    """Make one attempt at a claimed job and record the outcome; commits"""
+    handler, on_failure = HANDLERS[job.kind]
+    try:
+        result = handler(db, job)
+        if _finish(db, job, status="succeeded", result=result, error=None, finished_at=datetime.utcnow()):
+            db.commit()
+            record_outbox_job(job.kind, "succeeded")
+        else:
+            db.rollback()
+        return
+    except Exception as e:
+        db.rollback()
+        error = str(e)
+
+    now = now or datetime.utcnow()
+    if job.attempts < settings.OUTBOX_MAX_ATTEMPTS:
+        if _finish(db, job, status="pending", error=error, next_attempt_at=now + backoff(job.attempts)):
+            record_outbox_job(job.kind, "retried")
+            logger.warning(f"Outbox job {job.id} ({job.kind}) attempt {job.attempts} failed: {error}")
+    else:
+        if _finish(db, job, status="failed", error=error, finished_at=now):
+            if on_failure:
+                on_failure(db, job)
+            record_outbox_job(job.kind, "failed")
+            logger.error(f"Outbox job {job.id} ({job.kind}) failed after {job.attempts} attempts: {error}")
+    db.commit()
+
+def purge_finished(db: Session, now: datetime = None) -> int:
+    """Delete jobs finished more than OUTBOX_RETENTION_HOURS ago, in chunks; commits"""
+    cutoff = (now or datetime.utcnow()) - timedelta(hours=settings.OUTBOX_RETENTION_HOURS)
+    purged = 0
+    while True:
+        chunk = (
+            select(_jobs.c.id)
+            .where(_jobs.c.status.in_(("succeeded", "failed")), _jobs.c.finished_at <= cutoff)
+            .limit(settings.DELETE_CHUNK_SIZE)
+            .scalar_subquery()
+        )
+        deleted = db.execute(delete(_jobs).where(_jobs.c.id.in_(chunk))).rowcount
+        db.commit()
+        purged += deleted
+        if deleted < settings.DELETE_CHUNK_SIZE:
+            return purged
+
+def _session_for(user_id: int) -> Session:
+    return shards.user_session(user_id) if shards.enabled else SessionLocal()
+
+class Dispatcher:
+    """Claims due jobs and runs them on a pool of OUTBOX_WORKERS threads"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._last_purge = None
+
+    def start(self):
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbox")
+        self._thread = threading.Thread(target=self._loop, name="outbox-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop claiming jobs and wait for the running ones"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+            self._thread = None
+
+    def wake(self):
+        """Look for due jobs now instead of after the poll interval"""
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self.dispatch()
+            except Exception as e:
+                logger.error(f"Error dispatching outbox jobs: {e}")
+            self._wake.wait(settings.OUTBOX_POLL_INTERVAL_SECONDS)
+
+    def dispatch(self) -> int:
+        """Claim as many due jobs as there are idle workers; returns how many"""
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            claimed = 0
+            for session in shard_sessions(db):
+                with self._lock:
+                    idle = self.workers - self._in_flight
+                if idle <= 0:
+                    break
+                jobs = claim(session, idle, now)
+                with self._lock:
+                    self._in_flight += len(jobs)
+                for job in jobs:
+                    self._executor.submit(self._run, job)
+                claimed += len(jobs)
+            if self._last_purge is None or now - self._last_purge >= timedelta(hours=1):
+                self._last_purge = now
+                for session in shard_sessions(db):
+                    purge_finished(session, now)
+            return claimed
+        finally:
+            db.close()
+
+    def _run(self, job):
+        db = _session_for(job.user_id)
+        try:
+            run_job(db, job)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error running outbox job {job.id}: {e}")
+        finally:
+            db.close()
+            with self._lock:
+                self._in_flight -= 1
+            # A worker is free again
+            self._wake.set()
+
+dispatcher = Dispatcher(settings.OUTBOX_WORKERS)
+
+@event.listens_for(Session, "after_commit")
+def _wake_dispatcher(session):
+    if session.info.pop(_WAKE_KEY, False):
+        dispatcher.wake()
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_wake(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_WAKE_KEY, None)
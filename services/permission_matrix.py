@@ -0,0 +1,226 @@
+"""
+Compiled plan -> endpoint authorization.
+
+Every distinct ``Permission.endpoint`` pattern is interned to a small integer
+id, and each plan's permissions are folded into one integer used as a bitset
+over those ids. The patterns are compiled into a path-segment trie that
+resolves a path to the mask of every pattern matching it. "Can plan P call
+endpoint E" is then a bitwise AND of the plan's bits and E's mask, with no
+join through plan_permissions. Resolved masks are cached per path.
+
+Pattern syntax, one path segment at a time:
+
+- ``cloud-service-3/storage`` matches exactly that path.
+- ``cloud-service-*/logs`` matches any segment the glob accepts
+  (``*``, ``?`` and ``[...]`` as in fnmatch), so it covers every service's
+  ``/logs`` route.
+- ``cloud-service-3/*`` ends in a lone ``*`` (or ``**``) and matches the
+  prefix itself plus everything below it.
+
+The matrix is immutable. It is rebuilt whenever the plans or permissions
+catalog version moves (or after CATALOG_MAX_AGE_SECONDS), and the new matrix
+replaces the old one with a single reference assignment. Readers always see a
+complete matrix.
+
+Plans that were never given permissions stay unrestricted, which is how every
+plan behaved before permissions were enforced. A plan given permissions is
+marked ``restricted`` and stays restricted when those permissions are deleted
+later: with no grants left it reaches nothing. A grant of a permission that
+no longer exists does not count, so the rule is the same whether the grant
+row was removed or left behind.
+"""
+from fnmatch import translate
+import re
+import threading
+import time
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from config import get_settings
+from models import Permission, Plan, plan_permissions
+from services.catalog import plans_catalog, permissions_catalog
+
+settings = get_settings()
+
+def normalize_endpoint(endpoint: str) -> str:
+    """'/api/cloud-service-3/storage/' and 'cloud-service-3/storage' name the same endpoint"""
+    endpoint = endpoint.strip().strip("/")
+    if endpoint == "api" or endpoint.startswith("api/"):
+        endpoint = endpoint[4:]
+    return endpoint
+
+# Upper bound on cached path masks; /access accepts arbitrary paths
+MAX_CACHED_PATHS = 4096
+
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+class _TrieNode:
+    __slots__ = ("children", "globs", "glob_prefix_lengths", "mask", "subtree_mask")
+
+    def __init__(self):
+        self.children = {}
+        # Glob children keyed by the literal text before their first wildcard, so
+        # a segment only tries the globs whose prefix it actually starts with
+        self.globs = {}
+        self.glob_prefix_lengths = ()
+        # Patterns ending exactly here, and prefix patterns covering everything below
+        self.mask = 0
+        self.subtree_mask = 0
+
+class PatternTrie:
+    """Path-segment trie over endpoint patterns; ``match`` costs O(path depth), not O(patterns)"""
+
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def add(self, pattern: str, bit: int):
+        node = self.root
+        segments = pattern.split("/") if pattern else []
+        if segments and segments[-1] in ("*", "**"):
+            segments.pop()
+            prefix = True
+        else:
+            prefix = False
+
+        for segment in segments:
+            wildcard = _GLOB_CHARS.search(segment)
+            if wildcard:
+                literal_prefix = segment[:wildcard.start()]
+                entries = node.globs.setdefault(literal_prefix, [])
+                for glob, matcher, child in entries:
+                    if glob == segment:
+                        break
+                else:
+                    child = _TrieNode()
+                    entries.append((segment, re.compile(translate(segment)).match, child))
+                    node.glob_prefix_lengths = tuple(sorted({len(prefix) for prefix in node.globs}))
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _TrieNode()
+            node = child
+
+        if prefix:
+            node.subtree_mask |= bit
+        else:
+            node.mask |= bit
+
+    def match(self, path: str) -> int:
+        """Mask of every pattern matching the normalized ``path``"""
+        segments = path.split("/") if path else []
+        depth = len(segments)
+        mask = 0
+        frontier = [self.root]
+        for index in range(depth + 1):
+            next_frontier = []
+            for node in frontier:
+                mask |= node.subtree_mask
+                if index == depth:
+                    mask |= node.mask
+                    continue
+                segment = segments[index]
+                child = node.children.get(segment)
+                if child is not None:
+                    next_frontier.append(child)
+                for length in node.glob_prefix_lengths:
+                    if length > len(segment):
+                        break
+                    for _, matcher, child in node.globs.get(segment[:length], ()):
+                        if matcher(segment):
+                            next_frontier.append(child)
+            frontier = next_frontier
+            if not frontier:
+                break
+        return mask
+
+class PermissionMatrix:
+    def __init__(self, endpoint_ids: dict, plan_bits: dict, version=None):
+        self.endpoint_ids = endpoint_ids
+        self.plan_bits = plan_bits
+        self.version = version
+        self.built_at = time.monotonic()
+        self.trie = PatternTrie()
+        for pattern, endpoint_id in endpoint_ids.items():
+            self.trie.add(pattern, 1 << endpoint_id)
+        self._path_masks = {}
+
+    @classmethod
+    def compile(cls, permissions, grants, version=None, restricted=()) -> "PermissionMatrix":
+        """
+        Args:
+            permissions: (permission_id, endpoint) pairs.
+            grants: (plan_id, permission_id) pairs from plan_permissions.
+            version: Catalog version the rows were read at.
+            restricted: Ids of plans limited to their grants even with none left.
+        """
+        endpoint_ids = {}
+        permission_bits = {}
+        for permission_id, endpoint in permissions:
+            endpoint_id = endpoint_ids.setdefault(normalize_endpoint(endpoint), len(endpoint_ids))
+            permission_bits[permission_id] = 1 << endpoint_id
+
+        plan_bits = dict.fromkeys(restricted, 0)
+        for plan_id, permission_id in grants:
+            plan_bits.setdefault(plan_id, 0)
+            if permission_id in permission_bits:
+                plan_bits[plan_id] = plan_bits.get(plan_id, 0) | permission_bits[permission_id]
+        return cls(endpoint_ids, plan_bits, version)
+
+    def resolve(self, endpoint: str) -> int:
+        """Mask of the patterns matching a normalized endpoint, cached per path"""
+        mask = self._path_masks.get(endpoint)
+        if mask is None:
+            mask = self.trie.match(endpoint)
+            if len(self._path_masks) >= MAX_CACHED_PATHS:
+                self._path_masks.clear()
+            self._path_masks[endpoint] = mask
+        return mask
+
+    def allows(self, plan_id: int, *endpoints: str) -> bool:
+        """True if the plan is unrestricted or grants any of the given (normalized) endpoints"""
+        bits = self.plan_bits.get(plan_id)
+        if bits is None:
+            return True
+        for endpoint in endpoints:
+            if bits & self.resolve(endpoint):
+                return True
+        return False
+
+def load_permission_matrix(db: Session, version=None) -> PermissionMatrix:
+    permissions = db.execute(select(Permission.id, Permission.endpoint)).all()
+    grants = db.execute(
+        select(plan_permissions.c.plan_id, plan_permissions.c.permission_id)
+    ).all()
+    restricted = db.execute(select(Plan.id).where(Plan.restricted == True)).scalars().all()
+    return PermissionMatrix.compile(permissions, grants, version, restricted)
+
+_matrix = None
+_rebuild_lock = threading.Lock()
+
+def _catalog_version() -> tuple:
+    return (plans_catalog.version, permissions_catalog.version)
+
+def get_permission_matrix(db: Session) -> PermissionMatrix:
+    """The current matrix, rebuilding it first if plans or permissions changed"""
+    global _matrix
+    matrix = _matrix
+    if (
+        matrix is not None
+        and matrix.version == _catalog_version()
+        and time.monotonic() - matrix.built_at < settings.CATALOG_MAX_AGE_SECONDS
+    ):
+        return matrix
+
+    # While one request rebuilds, everyone else keeps using the previous matrix
+    if not _rebuild_lock.acquire(blocking=matrix is None):
+        return matrix
+    try:
+        if _matrix is not matrix and _matrix.version == _catalog_version():
+            return _matrix
+        # Read the version first so a write racing with the rebuild leaves the result stale
+        version = _catalog_version()
+        _matrix = load_permission_matrix(db, version)
+        return _matrix
+    finally:
+        _rebuild_lock.release()
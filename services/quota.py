@@ -0,0 +1,114 @@
+"""
+Quota accounting with lazy billing-period resets.
+
+A plan's ``quota_period`` splits time into numbered periods:
+
+- ``none``: one period forever; usage never resets (the original behaviour).
+- ``daily``: UTC calendar days.
+- ``monthly``: UTC calendar months.
+- ``rolling``: consecutive windows of ``quota_period_days`` days, counted from
+  the subscription's start date.
+
+Each subscription stores the ``period_epoch`` its ``usage_count`` belongs to.
+The epoch encodes the period kind (and the length of a rolling period) next
+to the period number, so epochs of different kinds never coincide. Nothing
+resets counters in bulk. The first consume that sees a stored epoch other than
+the current one, because the period rolled over or the plan's period changed,
+restarts the count at zero and stamps the current epoch. The check, the reset
+and the increment run as one conditional UPDATE, so concurrent requests can
+neither overshoot the limit nor double-reset.
+"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import bindparam, case, func, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import Plan, UserSubscription
+from services import quota_events
+
+QUOTA_PERIODS = ("none", "daily", "monthly", "rolling")
+
+# Longest rolling period; the period kinds share _KIND_SPACE tags
+MAX_ROLLING_DAYS = 1000
+_KIND_SPACE = 1024
+_KIND_TAGS = {"none": 0, "daily": 1, "monthly": 2}
+
+# Stamped when a subscription moves to another plan; matches no period, so
+# the count starts over and no older lease is refunded into it
+RESET_EPOCH = -1
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+
+_subscriptions = UserSubscription.__table__
+_usage = case(
+    (func.coalesce(_subscriptions.c.period_epoch, 0) != bindparam("epoch"), 0),
+    else_=func.coalesce(_subscriptions.c.usage_count, 0)
+)
+
+# Built once so every call reuses SQLAlchemy's cached compilation
+CONSUME_STATEMENT = (
+    update(_subscriptions)
+    .where(_subscriptions.c.id == bindparam("subscription_id"), _usage < bindparam("usage_limit"))
+    .values(
+        usage_count=_usage + 1,
+        period_epoch=bindparam("epoch")
+    )
+    .returning(_subscriptions.c.usage_count, _subscriptions.c.period_epoch)
+)
+
+def period_epoch(quota_period: Optional[str], quota_period_days: Optional[int],
+                 start_date: Optional[datetime], now: datetime = None) -> int:
+    """
+    Epoch of the quota period ``now`` falls in, from the plain plan and
+    subscription columns: the period number times _KIND_SPACE plus the kind's
+    tag. Only equality between epochs is meaningful.
+    """
+    now = now or datetime.utcnow()
+    period = quota_period or "none"
+    if period == "daily":
+        number = (now - _UNIX_EPOCH).days
+    elif period == "monthly":
+        number = now.year * 12 + now.month - 1
+    elif period == "rolling":
+        days = min(max(quota_period_days or 1, 1), MAX_ROLLING_DAYS)
+        started = start_date or _UNIX_EPOCH
+        return (max((now - started).days, 0) // days) * _KIND_SPACE + len(_KIND_TAGS) + days - 1
+    else:
+        return 0
+    return number * _KIND_SPACE + _KIND_TAGS[period]
+
+def current_period_epoch(plan: Plan, subscription: UserSubscription, now: datetime = None) -> int:
+    """Number of the quota period ``now`` falls in for this plan and subscription"""
+    return period_epoch(plan.quota_period, plan.quota_period_days, subscription.start_date, now)
+
+def effective_usage(plan: Plan, subscription: UserSubscription, now: datetime = None) -> int:
+    """Usage in the current period; a counter from any other period reads as zero"""
+    if (subscription.period_epoch or 0) != current_period_epoch(plan, subscription, now):
+        return 0
+    return subscription.usage_count or 0
+
+def consume_quota(db: Session, plan: Plan, subscription: UserSubscription, now: datetime = None) -> Optional[int]:
+    """
+    Atomically reset the counter if its period rolled over, check it against the
+    plan's limit and count one call. Does not commit.
+
+    Returns:
+        The new usage count, or None if the limit was already reached.
+    """
+    row = db.connection().execute(CONSUME_STATEMENT, {
+        "subscription_id": subscription.id,
+        "usage_limit": plan.usage_limit,
+        "epoch": current_period_epoch(plan, subscription, now),
+    }).first()
+    if row is None:
+        return None
+
+    # Keep the loaded object in step without another SELECT
+    set_committed_value(subscription, "usage_count", row.usage_count)
+    set_committed_value(subscription, "period_epoch", row.period_epoch)
+    quota_events.record_usage(
+        db, subscription.user_id, subscription.id, row.usage_count - 1, row.usage_count, plan.usage_limit
+    )
+    return row.usage_count
@@ -0,0 +1,182 @@
+"""
+In-process pub/sub for quota notifications, served as server-sent events by
+GET /api/usage/{user_id}/events.
+
+The quota-consume paths (access checks, batch checks, usage tracking and
+leases) report each change of a subscription's usage with ``record_usage``,
+and deactivations with ``record_deactivated``. A report costs one dict lookup
+when nobody is watching the user. Otherwise it waits in the Session's ``info``
+and is published once the transaction commits, so a rolled-back call never
+notifies anyone.
+
+Each subscriber picks its own thresholds (percent of the plan's limit,
+QUOTA_EVENT_THRESHOLDS by default) and gets a ``threshold`` event whenever the
+usage moves from below a threshold to at or above it. A subscriber's buffer
+holds QUOTA_EVENT_BUFFER_SIZE events. A client too slow to drain it gets an
+``overflow`` event and is disconnected instead of holding the publisher up;
+it should reconnect, and its first event is the current usage again.
+
+Events only reach clients connected to the worker process that handled the
+call. With several workers, run the stream endpoint on a single worker or
+route each user to a fixed worker.
+"""
+from collections import deque
+import asyncio
+import json
+import logging
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_PENDING_KEY = "quota_events_pending"
+
+class Subscriber:
+    """One connected client; fed from any thread, drained by its event loop"""
+
+    def __init__(self, user_id: int, thresholds: list, loop: asyncio.AbstractEventLoop, max_events: int):
+        self.user_id = user_id
+        self.thresholds = sorted(thresholds)
+        self.overflowed = False
+        self.ready = asyncio.Event()
+        self._events = deque()
+        self._max_events = max_events
+        self._loop = loop
+        self._lock = threading.Lock()
+
+    def push(self, name: str, data: dict):
+        with self._lock:
+            if self.overflowed:
+                return
+            if len(self._events) >= self._max_events:
+                self.overflowed = True
+            else:
+                self._events.append((name, data))
+        try:
+            self._loop.call_soon_threadsafe(self.ready.set)
+        except RuntimeError:
+            # The client's event loop is gone; unsubscribe will follow
+            pass
+
+    def drain(self) -> list:
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+    def crossed(self, before: int, after: int, limit: int) -> list:
+        """Thresholds (percent of ``limit``) that usage moving from ``before`` to ``after`` reached"""
+        return [
+            threshold for threshold in self.thresholds
+            if before * 100 < threshold * limit <= after * 100
+        ]
+
+class QuotaEventBus:
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def watching(self, user_id: int) -> bool:
+        return user_id in self._subscribers
+
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def subscribe(self, user_id: int, thresholds: list) -> Subscriber:
+        subscriber = Subscriber(
+            user_id, thresholds, asyncio.get_running_loop(), settings.QUOTA_EVENT_BUFFER_SIZE
+        )
+        with self._lock:
+            # Copy on write, so publishers iterate without taking the lock
+            self._subscribers[user_id] = self._subscribers.get(user_id, frozenset()) | {subscriber}
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            remaining = self._subscribers.get(subscriber.user_id, frozenset()) - {subscriber}
+            if remaining:
+                self._subscribers[subscriber.user_id] = remaining
+            else:
+                self._subscribers.pop(subscriber.user_id, None)
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish_usage(self, user_id: int, subscription_id: int, before: int, after: int, limit: int):
+        for subscriber in self._subscribers.get(user_id, ()):
+            for threshold in subscriber.crossed(before, after, limit):
+                subscriber.push("threshold", {
+                    "user_id": user_id,
+                    "subscription_id": subscription_id,
+                    "threshold": threshold,
+                    "usage_count": after,
+                    "usage_limit": limit,
+                })
+
+    def publish_deactivated(self, user_id: int, subscription_id: int):
+        for subscriber in self._subscribers.get(user_id, ()):
+            subscriber.push("deactivated", {
+                "user_id": user_id,
+                "subscription_id": subscription_id,
+            })
+
+bus = QuotaEventBus()
+
+def record_usage(db: Session, user_id: int, subscription_id: int, before: int, after: int, limit: int):
+    """Publish a usage change when ``db`` commits, if anyone is watching the user"""
+    if after > before and bus.watching(user_id):
+        db.info.setdefault(_PENDING_KEY, []).append(
+            (bus.publish_usage, (user_id, subscription_id, before, after, limit))
+        )
+
+def record_deactivated(db: Session, user_id: int, subscription_id: int):
+    """Publish a deactivation when ``db`` commits, if anyone is watching the user"""
+    if bus.watching(user_id):
+        db.info.setdefault(_PENDING_KEY, []).append((bus.publish_deactivated, (user_id, subscription_id)))
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending(session):
+    for publish, args in session.info.pop(_PENDING_KEY, ()):
+        try:
+            publish(*args)
+        except Exception as e:
+            logger.error(f"Error publishing quota event: {e}")
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_pending(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+
+def format_event(name: str, data: dict) -> str:
+    """One server-sent event"""
+    return f"event: {name}\ndata: {json.dumps(data, separators=(',', ':'), default=str)}\n\n"
+
+async def stream(subscriber: Subscriber, snapshot: dict):
+    """
+    The subscriber's server-sent events: ``snapshot`` as a ``usage`` event, then
+    its events as they are published, with a keepalive comment on idle streams.
+    Ends after an ``overflow`` event if the client fell behind; unsubscribes
+    when the stream ends or the client disconnects.
+    """
+    try:
+        yield format_event("usage", snapshot)
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.ready.wait(), settings.QUOTA_EVENT_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            subscriber.ready.clear()
+            for name, data in subscriber.drain():
+                yield format_event(name, data)
+            if subscriber.overflowed:
+                logger.warning(f"Dropped slow quota event subscriber for user {subscriber.user_id}")
+                yield format_event("overflow", {"user_id": subscriber.user_id})
+                return
+    finally:
+        bus.unsubscribe(subscriber)
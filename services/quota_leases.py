@@ -0,0 +1,218 @@
+"""
+Quota leases: blocks of a subscription's quota handed to a client, such as an
+edge proxy, to spend without asking this service about every call.
+
+A lease is taken out of ``UserSubscription.usage_count`` when it is granted,
+so the central counter already covers every unit out on lease, and ordinary
+access checks see that much less quota. The client consumes the units
+locally, then either:
+
+- renews the lease before it expires, reporting how many units it has used so
+  far and optionally asking for more, or
+- returns it, reporting its final usage. The unused rest is subtracted from
+  the counter again.
+
+A lease that is not renewed in time is reclaimed: its unused units (granted
+minus the usage last reported) go back to the subscription. This happens in
+the background every LEASE_RECLAIM_INTERVAL_SECONDS, and also before a user's
+next reservation. Units only go back to the period they were taken from. Once
+the quota period rolls over, the counter has been reset anyway, so an old
+lease is settled without a refund and the client has to reserve a new one.
+
+Leases are removed with DELETE ... RETURNING, so a return racing with the
+reclaimer refunds the lease once.
+"""
+from datetime import datetime, timedelta
+import logging
+import uuid
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, delete, func, select, update
+from sqlalchemy.orm import Session
+
+from config import get_settings
+from database import SessionLocal, shard_sessions
+from models import QuotaLease, UserSubscription
+from services import quota_events
+from services.access_check import (
+    BATCH_ATTEMPTS, compare_and_set, current_epoch, find_subscription, plan_limits, usage_in_period
+)
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_subscriptions = UserSubscription.__table__
+_leases = QuotaLease.__table__
+
+# Give units back to the period they were taken from, never below zero
+REFUND_STATEMENT = (
+    update(_subscriptions)
+    .where(
+        _subscriptions.c.id == bindparam("subscription_id"),
+        func.coalesce(_subscriptions.c.period_epoch, 0) == bindparam("lease_epoch")
+    )
+    .values(usage_count=func.max(func.coalesce(_subscriptions.c.usage_count, 0) - bindparam("refund"), 0))
+)
+
+_SETTLED_COLUMNS = (_leases.c.subscription_id, _leases.c.period_epoch, _leases.c.granted, _leases.c.used)
+
+def _ttl(ttl_seconds: int = None) -> timedelta:
+    return timedelta(seconds=min(ttl_seconds or settings.LEASE_DEFAULT_TTL_SECONDS, settings.LEASE_MAX_TTL_SECONDS))
+
+def _refund(connection, settled: list, used: int = None) -> int:
+    """Give back the unused units of deleted (subscription_id, epoch, granted, used) rows"""
+    params = [
+        {"subscription_id": subscription_id, "lease_epoch": epoch,
+         "refund": granted - (used if used is not None else lease_used)}
+        for subscription_id, epoch, granted, lease_used in settled
+    ]
+    params = [param for param in params if param["refund"] > 0]
+    if params:
+        connection.execute(REFUND_STATEMENT, params)
+    return sum(param["refund"] for param in params)
+
+def _take_units(db: Session, user_id: int, units: int, now: datetime) -> tuple:
+    """
+    Count up to ``units`` more against the user's subscription; returns
+    (subscription, plan, units granted), which is fewer near the limit.
+    """
+    connection = db.connection()
+    for _ in range(BATCH_ATTEMPTS):
+        subscription = find_subscription(connection, user_id)
+        if subscription is None:
+            raise HTTPException(status_code=404, detail=f"No subscription found for user {user_id}")
+        plan = plan_limits.get(db, subscription.plan_id)
+        if plan is None:
+            raise HTTPException(status_code=404, detail="Plan not found for subscription")
+
+        used = usage_in_period(plan, subscription, now)
+        granted = min(units, max(plan.usage_limit - used, 0))
+        if granted == 0:
+            return subscription, plan, 0
+        epoch = current_epoch(plan, subscription, now)
+        if compare_and_set(connection, [(subscription, used + granted, epoch)]):
+            quota_events.record_usage(db, user_id, subscription.id, used, used + granted, plan.usage_limit)
+            return subscription, plan, granted
+    raise HTTPException(status_code=409, detail="Usage counter is changing too quickly; retry the request")
+
+def reserve(db: Session, user_id: int, units: int, ttl_seconds: int = None, now: datetime = None) -> QuotaLease:
+    """Lease up to ``units`` of the user's remaining quota; commits"""
+    now = now or datetime.utcnow()
+    reclaim_expired(db, now, user_id=user_id)
+    subscription, plan, granted = _take_units(db, user_id, units, now)
+    if granted == 0:
+        db.commit()
+        raise HTTPException(
+            status_code=429,
+            detail=f"Usage limit exceeded. Limit: {plan.usage_limit}"
+        )
+
+    lease = QuotaLease(
+        id=uuid.uuid4().hex,
+        subscription_id=subscription.id,
+        user_id=user_id,
+        period_epoch=current_epoch(plan, subscription, now),
+        granted=granted,
+        used=0,
+        created_at=now,
+        expires_at=now + _ttl(ttl_seconds)
+    )
+    db.add(lease)
+    db.commit()
+    logger.info(f"Leased {granted} units to user {user_id} until {lease.expires_at}")
+    return lease
+
+def _active_lease(db: Session, user_id: int, lease_id: str, used: int) -> QuotaLease:
+    """The user's lease, if ``used`` is a valid usage report for it"""
+    lease = db.get(QuotaLease, lease_id)
+    if lease is None or lease.user_id != user_id:
+        raise HTTPException(status_code=404, detail=f"Lease {lease_id} not found")
+    if not lease.used <= used <= lease.granted:
+        raise HTTPException(
+            status_code=400,
+            detail=f"used must be between {lease.used} and the {lease.granted} units granted"
+        )
+    return lease
+
+def renew(db: Session, user_id: int, lease_id: str, used: int, units: int = 0,
+          ttl_seconds: int = None, now: datetime = None) -> QuotaLease:
+    """Record the usage reported so far, extend the lease and optionally add units; commits"""
+    now = now or datetime.utcnow()
+    lease = _active_lease(db, user_id, lease_id, used)
+    subscription = find_subscription(db.connection(), user_id)
+    plan = plan_limits.get(db, subscription.plan_id) if subscription else None
+    if lease.expires_at <= now or plan is None or lease.period_epoch != current_epoch(plan, subscription, now):
+        settle(db, user_id, lease_id, used)
+        raise HTTPException(
+            status_code=410,
+            detail=f"Lease {lease_id} expired or its quota period ended; its unused units were returned"
+        )
+
+    granted = 0
+    if units:
+        _, _, granted = _take_units(db, user_id, units, now)
+    # Only the live lease is extended; a reclaim that got there first wins
+    extended = db.execute(
+        update(QuotaLease)
+        .where(QuotaLease.id == lease_id, QuotaLease.expires_at > now)
+        .values(used=used, granted=QuotaLease.granted + granted, expires_at=now + _ttl(ttl_seconds))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not extended:
+        db.rollback()
+        raise HTTPException(status_code=410, detail=f"Lease {lease_id} expired")
+    db.commit()
+    db.refresh(lease)
+    return lease
+
+def settle(db: Session, user_id: int, lease_id: str, used: int) -> int:
+    """Close a lease with its final usage and give back the rest; returns the units given back. Commits."""
+    _active_lease(db, user_id, lease_id, used)
+    connection = db.connection()
+    settled = connection.execute(
+        delete(_leases).where(_leases.c.id == lease_id).returning(*_SETTLED_COLUMNS)
+    ).all()
+    if not settled:
+        db.rollback()
+        raise HTTPException(status_code=404, detail=f"Lease {lease_id} not found")
+    returned = _refund(connection, settled, used)
+    db.commit()
+    return returned
+
+def list_leases(db: Session, user_id: int) -> list:
+    return db.query(QuotaLease).filter(QuotaLease.user_id == user_id).order_by(QuotaLease.expires_at).all()
+
+def reclaim_expired(db: Session, now: datetime = None, user_id: int = None) -> int:
+    """
+    Delete expired leases and give back their unused units, in chunks of
+    DELETE_CHUNK_SIZE. Does not commit; returns the number of leases reclaimed.
+    """
+    now = now or datetime.utcnow()
+    connection = db.connection()
+    criteria = [_leases.c.expires_at <= now]
+    if user_id is not None:
+        criteria.append(_leases.c.user_id == user_id)
+    reclaimed = 0
+    while True:
+        chunk = select(_leases.c.id).where(*criteria).limit(settings.DELETE_CHUNK_SIZE).scalar_subquery()
+        settled = connection.execute(
+            delete(_leases).where(_leases.c.id.in_(chunk)).returning(*_SETTLED_COLUMNS)
+        ).all()
+        _refund(connection, settled)
+        reclaimed += len(settled)
+        if len(settled) < settings.DELETE_CHUNK_SIZE:
+            return reclaimed
+
+def reclaim_all_expired(now: datetime = None) -> int:
+    """Reclaim expired leases in the database, or on every shard; commits each"""
+    db = SessionLocal()
+    try:
+        reclaimed = 0
+        for session in shard_sessions(db):
+            reclaimed += reclaim_expired(session, now)
+            session.commit()
+        if reclaimed:
+            logger.info(f"Reclaimed {reclaimed} expired quota leases")
+        return reclaimed
+    finally:
+        db.close()
@@ -0,0 +1,254 @@
+"""
+Log retention: archive old rows to gzip-JSONL files, then delete them.
+
+For every table listed in LOG_RETENTION_DAYS, rows older than the cutoff are
+read in (timestamp, id) order, ARCHIVE_CHUNK_SIZE at a time. Each chunk is
+written to ``ARCHIVE_DIR/<table>/<first timestamp>-<last id>.jsonl.gz`` and
+recorded in ``ARCHIVE_DIR/<table>/manifest.jsonl``. Only then are the chunk's
+rows deleted, in their own short transaction. Service logs are stored in
+monthly partitions, so a month that is entirely past the cutoff is archived
+and then dropped as a whole table, with no row deletes. They are archived
+decoded, with the plain string columns they had before dictionary encoding.
+A finished run ends
+with PRAGMA incremental_vacuum, so the file actually shrinks.
+
+With DATABASE_SHARDS set, every shard is archived under its own
+``ARCHIVE_DIR/shard<N>/`` and ``read_archive`` merges them.
+
+A crash between writing a chunk and deleting it archives those rows again
+on the next run. ``read_archive`` drops the duplicates by (timestamp, id).
+"""
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import gzip
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+
+from sqlalchemy import delete, select, tuple_, type_coerce
+
+from config import get_settings
+from database import engine, shards, run_incremental_vacuum
+from models import UsageLog, PaymentLog
+from services import log_store
+
+try:
+    import fcntl
+except ImportError:  # Windows: runs are only serialized within one process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+ARCHIVED_MODELS = {model.__tablename__: model for model in (UsageLog, PaymentLog)}
+ARCHIVED_TABLES = (log_store.TABLE_PREFIX, *ARCHIVED_MODELS)
+
+_run_lock = threading.Lock()
+
+def archive_locations() -> list:
+    """(engine, archive root) for every database holding logs; each shard archives to its own directory"""
+    if not shards.enabled:
+        return [(engine, settings.ARCHIVE_DIR)]
+    return [
+        (shard_engine, os.path.join(settings.ARCHIVE_DIR, f"shard{shard}"))
+        for shard, shard_engine in enumerate(shards.engines)
+    ]
+
+def _table_dir(table: str, root: str = None) -> str:
+    return os.path.join(root or settings.ARCHIVE_DIR, table)
+
+@contextmanager
+def _exclusive_run():
+    """Keep two workers (or two threads) from archiving the same rows at once"""
+    os.makedirs(settings.ARCHIVE_DIR, exist_ok=True)
+    with _run_lock, open(os.path.join(settings.ARCHIVE_DIR, ".lock"), "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def _write_chunk(table: str, rows: list, root: str = None) -> dict:
+    """Write one chunk durably and append it to the table's manifest"""
+    directory = _table_dir(table, root)
+    os.makedirs(directory, exist_ok=True)
+    first, last = rows[0], rows[-1]
+    filename = f"{first['timestamp']:%Y%m%dT%H%M%S}-{last['id']}.jsonl.gz"
+    path = os.path.join(directory, filename)
+
+    with open(path + ".tmp", "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            for row in rows:
+                archive.write(json.dumps(row, default=str, separators=(",", ":")).encode("utf-8") + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(path + ".tmp", path)
+
+    entry = {
+        "file": filename,
+        "rows": len(rows),
+        "min_timestamp": first["timestamp"].isoformat(),
+        "max_timestamp": last["timestamp"].isoformat(),
+        "min_id": min(row["id"] for row in rows),
+        "max_id": max(row["id"] for row in rows),
+    }
+    with open(os.path.join(directory, "manifest.jsonl"), "a") as manifest:
+        manifest.write(json.dumps(entry) + "\n")
+        manifest.flush()
+        os.fsync(manifest.fileno())
+    return entry
+
+def _archive_rows(name: str, table, cutoff: datetime, bind, delete_rows: bool = True, on_chunk=None,
+                  decode=None, root: str = None) -> int:
+    """
+    Archive the rows of ``table`` older than ``cutoff`` under ``name`` and, unless
+    the caller drops the whole table afterwards, delete them chunk by chunk.
+    ``decode(connection, rows)`` turns stored rows into the archived form.
+    """
+    columns = table.c
+    archived = 0
+    last_key = None
+    while True:
+        statement = select(table).where(columns.timestamp < cutoff)
+        if last_key is not None:
+            statement = statement.where(tuple_(columns.timestamp, columns.id) > last_key)
+        with bind.connect() as connection:
+            result = connection.execute(
+                statement.order_by(columns.timestamp, columns.id).limit(settings.ARCHIVE_CHUNK_SIZE)
+            )
+            rows = decode(connection, result.all()) if decode else [dict(row._mapping) for row in result]
+        if not rows:
+            return archived
+
+        _write_chunk(name, rows, root)
+        # Bind the timestamp with the column's type; service log partitions store it as an integer
+        last_key = tuple_(type_coerce(rows[-1]["timestamp"], columns.timestamp.type), rows[-1]["id"])
+        if delete_rows:
+            with bind.begin() as connection:
+                connection.execute(delete(table).where(columns.id.in_([row["id"] for row in rows])))
+        archived += len(rows)
+        if on_chunk:
+            on_chunk(archived)
+
+def archive_table(table: str, cutoff: datetime, bind=None, progress: dict = None, root: str = None,
+                  progress_key: str = None) -> int:
+    """Archive and delete the rows of ``table`` older than ``cutoff``; returns the row count"""
+    bind = bind or engine
+
+    def record_progress(archived):
+        if progress is not None:
+            progress[progress_key or table] = archived
+
+    if table != log_store.TABLE_PREFIX:
+        return _archive_rows(
+            table, ARCHIVED_MODELS[table].__table__, cutoff, bind, on_chunk=record_progress, root=root
+        )
+
+    archived = 0
+    for partition in log_store.list_partitions(bind):
+        if partition["start"] >= cutoff:
+            break
+        whole_month = partition["end"] <= cutoff
+        archived += _archive_rows(
+            table, log_store.partition_table(partition["key"]), cutoff, bind,
+            delete_rows=not whole_month, decode=log_store.decode_rows, root=root,
+            on_chunk=lambda count, done=archived: record_progress(done + count)
+        )
+        if whole_month:
+            log_store.drop_partition(bind, partition["key"])
+    return archived
+
+def run_retention(bind=None, now: datetime = None, progress: dict = None) -> dict:
+    """
+    Apply LOG_RETENTION_DAYS to every configured table, on ``bind`` or on every
+    shard; returns rows archived per table
+    """
+    locations = [(bind, settings.ARCHIVE_DIR)] if bind is not None else archive_locations()
+    now = now or datetime.utcnow()
+    summary = {}
+    with _exclusive_run():
+        for location, (location_bind, root) in enumerate(locations):
+            archived = {}
+            for table, days in settings.LOG_RETENTION_DAYS.items():
+                if table not in ARCHIVED_TABLES:
+                    logger.warning(f"Ignoring retention for unknown table '{table}'")
+                    continue
+                key = table if len(locations) == 1 else f"shard{location}/{table}"
+                archived[table] = archive_table(
+                    table, now - timedelta(days=days), location_bind, progress, root, progress_key=key
+                )
+                summary[table] = summary.get(table, 0) + archived[table]
+            if any(archived.values()):
+                freed = run_incremental_vacuum(location_bind)
+                logger.info(f"Retention archived {archived} under {root}, released {freed} free pages")
+    return summary
+
+def _read_manifest(table: str, root: str = None) -> list:
+    path = os.path.join(_table_dir(table, root), "manifest.jsonl")
+    if not os.path.exists(path):
+        return []
+    with open(path) as manifest:
+        return [json.loads(line) for line in manifest if line.strip()]
+
+def _archived_rows(path: str, shard: int, start: datetime, end: datetime, user_id: int):
+    """(sort key, row) for the matching rows of one archive file, which is in (timestamp, id) order"""
+    with gzip.open(path, "rt", encoding="utf-8") as archive:
+        for line in archive:
+            row = json.loads(line)
+            timestamp = datetime.fromisoformat(row["timestamp"])
+            if end and timestamp >= end:
+                return
+            if start and timestamp < start or user_id is not None and row["user_id"] != user_id:
+                continue
+            # Row ids are only unique within one shard
+            yield (timestamp, row["id"], shard), row
+
+def read_archive(table: str, start: datetime = None, end: datetime = None,
+                 user_id: int = None, limit: int = 1000) -> list:
+    """
+    Archived rows of ``table`` with start <= timestamp < end, oldest first.
+    Only the files whose time range overlaps the request are read, each one
+    streamed and opened only once the merge reaches its first timestamp, so
+    at most ``limit`` rows are held however wide the range is.
+    """
+    if table not in ARCHIVED_TABLES:
+        raise KeyError(table)
+    pending = deque(sorted(
+        (datetime.fromisoformat(entry["min_timestamp"]), shard, os.path.join(_table_dir(table, root), entry["file"]))
+        for shard, (_, root) in enumerate(archive_locations())
+        for entry in _read_manifest(table, root)
+        if not (start and datetime.fromisoformat(entry["max_timestamp"]) < start)
+        and not (end and datetime.fromisoformat(entry["min_timestamp"]) >= end)
+    ))
+    heap = []
+    sources = []
+    tiebreak = itertools.count()
+
+    def advance(source):
+        item = next(source, None)
+        if item is not None:
+            heapq.heappush(heap, (item[0], next(tiebreak), item[1], source))
+
+    rows = []
+    last_key = None
+    try:
+        while len(rows) < limit:
+            # A file whose first row is not after the oldest row in hand may hold the next one
+            while pending and (not heap or pending[0][0] <= heap[0][0][0]):
+                _, shard, path = pending.popleft()
+                sources.append(_archived_rows(path, shard, start, end, user_id))
+                advance(sources[-1])
+            if not heap:
+                break
+            key, _, row, source = heapq.heappop(heap)
+            # A chunk archived twice (a run that stopped before deleting it) yields the same rows again
+            if key != last_key:
+                rows.append(row)
+                last_key = key
+            advance(source)
+    finally:
+        for source in sources:
+            source.close()
+    return rows
@@ -1,88 +1,145 @@
-from sqlalchemy.orm import Session
-from models import UserSubscription, UsageLog
-from fastapi import HTTPException
-from datetime import datetime
-
-# Function to increment usage count
-def increment_usage(user_id: int, api_endpoint: str, db: Session):
-    """
-    Increment the usage count for a user and log the API request.
-
-    Args:
-        user_id (int): The ID of the user.
-        api_endpoint (str): The endpoint being accessed.
-        db (Session): Database session.
-    """
-    # Fetch user's subscription
-    subscription = db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
-    if not subscription:
-        raise HTTPException(status_code=404, detail="Subscription not found")
-
-    # Fetch the plan usage limit
-    plan = db.query(UserSubscription).filter(UserSubscription.plan_id == subscription.plan_id).first()
-    if not plan:
-        raise HTTPException(status_code=404, detail="Subscription plan not found")
-
-    # Check if usage limit is exceeded
-    if subscription.usage_count >= plan.usage_limit:
-        raise HTTPException(status_code=403, detail="Usage limit exceeded for this plan")
-
-    # Increment usage and log the API call
-    subscription.usage_count += 1
-    usage_log = UsageLog(user_id=user_id, api_endpoint=api_endpoint)
-    db.add(usage_log)
-    db.commit()
-
-# Function to get usage statistics
-def get_usage_stats(user_id: int, db: Session):
-    """
-    Retrieve the usage statistics for a specific user.
-
-    Args:
-        user_id (int): The ID of the user.
-        db (Session): Database session.
-
-    Returns:
-        dict: Usage statistics including usage count and API logs.
-    """
-    # Fetch subscription
-    subscription = db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
-    if not subscription:
-        raise HTTPException(status_code=404, detail="Subscription not found")
-
-    # Fetch usage logs
-    usage_logs = db.query(UsageLog).filter(UsageLog.user_id == user_id).all()
-
-    return {
-        "user_id": user_id,
-        "usage_count": subscription.usage_count,
-        "api_calls": [{"api_endpoint": log.api_endpoint, "timestamp": datetime.now()} for log in usage_logs]
-    }
-
-@router.get("/usage/{user_id}/limit")
-async def check_limit_status(user_id: int, db: Session = Depends(get_db)):
-    subscription = db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
-    if not subscription:
-        raise HTTPException(status_code=404, detail="Subscription not found")
-    
-    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
-    remaining_calls = plan.usage_limit - subscription.usage_count
-    
-    return {
-        "user_id": user_id,
-        "plan_name": plan.name,
-        "usage_count": subscription.usage_count,
-        "usage_limit": plan.usage_limit,
-        "remaining_calls": remaining_calls,
-        "limit_exceeded": subscription.usage_count >= plan.usage_limit
-    }
-
-@router.post("/usage/{user_id}")
-async def track_api_request(user_id: int, api_endpoint: str, db: Session = Depends(get_db)):
-    try:
-        increment_usage(user_id, api_endpoint, db)
-        return {"message": "API request tracked successfully"}
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+from sqlalchemy.orm import Session
+from models import UserSubscription, UsageLog, Plan
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from database import get_db, SessionLocal, shards
+from services import quota_events
+from services.quota import consume_quota, effective_usage
+from utils.metrics import record_quota_rejection
+from config import get_settings
+
+settings = get_settings()
+
+router = APIRouter(tags=["Usage"])
+
+# Function to increment usage count
+def increment_usage(user_id: int, api_endpoint: str, db: Session):
+    """
+    Increment the usage count for a user and log the API request.
+
+    Args:
+        user_id (int): The ID of the user.
+        api_endpoint (str): The endpoint being accessed.
+        db (Session): Database session.
+    """
+    # Fetch user's subscription
+    subscription = db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
+    if not subscription:
+        raise HTTPException(status_code=404, detail="Subscription not found")
+
+    # Fetch the plan usage limit
+    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+    if not plan:
+        raise HTTPException(status_code=404, detail="Subscription plan not found")
+
+    # Check the usage limit and increment usage, resetting it if the period rolled over
+    if consume_quota(db, plan, subscription) is None:
+        record_quota_rejection("usage")
+        raise HTTPException(status_code=403, detail="Usage limit exceeded for this plan")
+
+    # Log the API call
+    usage_log = UsageLog(user_id=user_id, api_endpoint=api_endpoint)
+    db.add(usage_log)
+    db.commit()
+
+# Function to get usage statistics
+def get_usage_stats(user_id: int, db: Session):
+    """
+    Retrieve the usage statistics for a specific user.
+
+    Args:
+        user_id (int): The ID of the user.
+        db (Session): Database session.
+
+    Returns:
+        dict: Usage statistics including usage count and API logs.
+    """
+    # Fetch subscription
+    subscription = db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
+    if not subscription:
+        raise HTTPException(status_code=404, detail="Subscription not found")
+
+    # Fetch usage logs
+    usage_logs = db.query(UsageLog).filter(UsageLog.user_id == user_id).all()
+
+    return {
+        "user_id": user_id,
+        "usage_count": subscription.usage_count,
+        "api_calls": [{"api_endpoint": log.api_endpoint, "timestamp": log.timestamp} for log in usage_logs]
+    }
+
+@router.get("/usage/{user_id}/limit")
+async def check_limit_status(user_id: int, db: Session = Depends(get_db)):
+    subscription = db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
+    if not subscription:
+        raise HTTPException(status_code=404, detail="Subscription not found")
+    
+    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+    usage_count = effective_usage(plan, subscription)
+    remaining_calls = plan.usage_limit - usage_count
+    
+    return {
+        "user_id": user_id,
+        "plan_name": plan.name,
+        "usage_count": usage_count,
+        "usage_limit": plan.usage_limit,
+        "remaining_calls": remaining_calls,
+        "limit_exceeded": usage_count >= plan.usage_limit
+    }
+
+@router.post("/usage/{user_id}")
+async def track_api_request(user_id: int, api_endpoint: str, db: Session = Depends(get_db)):
+    try:
+        increment_usage(user_id, api_endpoint, db)
+        return {"message": "API request tracked successfully"}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/usage/{user_id}/events")
+async def stream_quota_events(user_id: int, thresholds: Optional[str] = None):
+    """
+    Server-sent events for the user's subscription, instead of polling the limit:
+    the current usage first, then ``threshold`` whenever usage crosses one of
+    ``thresholds`` (comma-separated percentages of the limit) and
+    ``deactivated`` when the subscription is deactivated.
+    """
+    try:
+        levels = [int(level) for level in thresholds.split(",")] if thresholds else settings.QUOTA_EVENT_THRESHOLDS
+    except ValueError:
+        raise HTTPException(status_code=400, detail="thresholds must be comma-separated integers")
+    if not levels or not all(0 < level <= 100 for level in levels):
+        raise HTTPException(status_code=400, detail="thresholds must be between 1 and 100")
+
+    # Subscribe before reading the snapshot so no change falls in between
+    subscriber = quota_events.bus.subscribe(user_id, levels)
+    try:
+        # A session of its own, closed before streaming: a request session
+        # would hold a pooled connection and a read transaction for as long
+        # as the client stays connected
+        with (shards.user_session(user_id) if shards.enabled else SessionLocal()) as db:
+            subscription = db.query(UserSubscription).filter(UserSubscription.user_id == user_id).first()
+            if not subscription:
+                raise HTTPException(status_code=404, detail="Subscription not found")
+            plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+            if not plan:
+                raise HTTPException(status_code=404, detail="Subscription plan not found")
+            snapshot = {
+                "user_id": user_id,
+                "subscription_id": subscription.id,
+                "is_active": subscription.is_active,
+                "usage_count": effective_usage(plan, subscription),
+                "usage_limit": plan.usage_limit,
+                "thresholds": subscriber.thresholds,
+            }
+    except Exception:
+        quota_events.bus.unsubscribe(subscriber)
+        raise
+
+    return StreamingResponse(
+        quota_events.stream(subscriber, snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,199 @@
+"""
+Minimal in-process metrics registry rendered in the Prometheus text format.
+
+Recording a sample costs a dict lookup, a bisect and a couple of additions
+under a lock, which keeps the per-request overhead in the low microseconds.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+def _format_labels(labelnames: tuple, labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last slot is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (bucket_counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_labels = _format_labels(self.labelnames, labels, 'le="%s"' % le)
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+http_request_duration = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")
+))
+db_queries_per_request = REGISTRY.register(Histogram(
+    "db_queries_per_request", "SQL statements executed while handling one request", ("route",), COUNT_BUCKETS
+))
+db_time_per_request = REGISTRY.register(Histogram(
+    "db_time_per_request_seconds", "Time spent executing SQL while handling one request", ("route",)
+))
+external_call_duration = REGISTRY.register(Histogram(
+    "external_call_duration_seconds", "Latency of calls to external cloud services", ("service",)
+))
+external_call_errors = REGISTRY.register(Counter(
+    "external_call_errors_total", "Failed calls to external cloud services", ("service",)
+))
+quota_rejections = REGISTRY.register(Counter(
+    "quota_rejections_total", "Requests rejected because the usage limit was reached", ("endpoint",)
+))
+outbox_jobs = REGISTRY.register(Counter(
+    "outbox_jobs_total", "Outbox job attempts by outcome (succeeded, retried or failed)", ("kind", "outcome")
+))
+admission_requests = REGISTRY.register(Counter(
+    "admission_requests_total", "Requests by route class and admission outcome (admitted, queue_full or timeout)",
+    ("route_class", "outcome")
+))
+admission_queue_wait = REGISTRY.register(Histogram(
+    "admission_queue_wait_seconds", "Time admitted requests waited for a concurrency slot", ("route_class",)
+))
+dependency_probe_duration = REGISTRY.register(Histogram(
+    "dependency_probe_duration_seconds", "Round trip of background health probes", ("dependency",)
+))
+dependency_probe_failures = REGISTRY.register(Counter(
+    "dependency_probe_failures_total", "Health probes that failed or timed out", ("dependency",)
+))
+cache_requests = REGISTRY.register(Counter(
+    "cache_requests_total", "Cache lookups by result (hit or miss)", ("cache", "result")
+))
+
+class RequestStats:
+    __slots__ = ("sql_count", "sql_time")
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+# Stats of the request being handled in the current context, if any
+current_request_stats: ContextVar = ContextVar("current_request_stats", default=None)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start_time"] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_time"]
+    stats = current_request_stats.get()
+    if stats is not None:
+        stats.sql_count += 1
+        stats.sql_time += elapsed
+
+def instrument_engine(engine):
+    """Attribute every SQL statement run through ``engine`` to the current request"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+@contextmanager
+def track_external_call(service: str):
+    """Time a call to an external service and count it as an error if it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        external_call_errors.inc(service)
+        raise
+    finally:
+        external_call_duration.observe(time.perf_counter() - started, service)
+
+def record_cache_lookup(cache: str, hit: bool):
+    cache_requests.inc(cache, "hit" if hit else "miss")
+
+def record_quota_rejection(endpoint: str):
+    quota_rejections.inc(endpoint)
+
+def record_outbox_job(kind: str, outcome: str):
+    outbox_jobs.inc(kind, outcome)
+
+def record_admission(route_class: str, outcome: str, wait: float = None):
+    admission_requests.inc(route_class, outcome)
+    if wait is not None:
+        admission_queue_wait.observe(wait, route_class)
+
+def record_dependency_probe(dependency: str, seconds: float, ok: bool):
+    dependency_probe_duration.observe(seconds, dependency)
+    if not ok:
+        dependency_probe_failures.inc(dependency)
+
+def render_metrics() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,168 @@
+"""
+Debug-mode SQL profiler and N+1 detector.
+
+With DEBUG_QUERY_PROFILER enabled every statement issued while handling a
+request is recorded, grouped by normalized text, and summarized in the
+X-Query-Profile response header and at GET /api/debug/queries. Statement
+shapes repeated at least N_PLUS_ONE_THRESHOLD times in one request are
+flagged as likely N+1 patterns.
+
+Tests can cap the number of queries an endpoint issues with the
+``max_queries`` pytest fixture (add ``pytest_plugins = ["utils.query_profiler"]``
+to conftest.py) or the ``assert_max_queries`` context manager.
+"""
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import re
+import time
+
+from sqlalchemy import event
+
+from config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_statement(statement: str) -> str:
+    """Collapse literals, IN-lists and whitespace so equivalent statements group together"""
+    statement = _STRING_LITERAL.sub("?", statement)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    statement = _PLACEHOLDER_LIST.sub("(?, ...)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+class QueryProfile:
+    def __init__(self):
+        self.queries = []
+
+    def record(self, statement: str, duration: float):
+        self.queries.append((statement, duration))
+
+    def groups(self) -> list:
+        grouped = {}
+        for statement, duration in self.queries:
+            group = grouped.setdefault(normalize_statement(statement), {"count": 0, "time": 0.0})
+            group["count"] += 1
+            group["time"] += duration
+        return sorted(
+            ({"statement": statement, "count": group["count"], "time_ms": round(group["time"] * 1000, 3)}
+             for statement, group in grouped.items()),
+            key=lambda group: group["count"],
+            reverse=True
+        )
+
+    def summary(self, threshold: int = None) -> dict:
+        threshold = threshold or settings.N_PLUS_ONE_THRESHOLD
+        groups = self.groups()
+        return {
+            "query_count": len(self.queries),
+            "query_time_ms": round(sum(duration for _, duration in self.queries) * 1000, 3),
+            "n_plus_one_suspects": [group for group in groups if group["count"] >= threshold],
+            "statements": groups,
+        }
+
+# Profile of the request being handled in the current context, if any
+current_profile: ContextVar = ContextVar("current_query_profile", default=None)
+
+# Summaries of the most recent requests, served by the debug endpoint
+recent_profiles = deque(maxlen=100)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["profiler_start_time"] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    if profile is not None:
+        profile.record(statement, time.perf_counter() - conn.info["profiler_start_time"])
+
+def instrument_engine(engine):
+    """Record every statement run through ``engine`` into the current request's profile"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+class QueryProfilerMiddleware:
+    """Profiles the SQL of every HTTP request and reports it in the X-Query-Profile header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = QueryProfile()
+        token = current_profile.set(profile)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                summary = profile.summary()
+                header = (
+                    f"queries={summary['query_count']}; time_ms={summary['query_time_ms']}; "
+                    f"n_plus_one={len(summary['n_plus_one_suspects'])}"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"x-query-profile", header.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profile.reset(token)
+            summary = profile.summary()
+            summary.update({"method": scope["method"], "path": scope["path"]})
+            recent_profiles.append(summary)
+            for suspect in summary["n_plus_one_suspects"]:
+                logger.warning(
+                    f"Possible N+1 in {scope['method']} {scope['path']}: "
+                    f"{suspect['count']}x {suspect['statement'][:200]}"
+                )
+
+@contextmanager
+def assert_max_queries(max_count: int, engines: list = None):
+    """
+    Fail with the grouped statements if the block issues more than ``max_count``
+    queries. Counts the primary, the read replica and every shard by default.
+    """
+    if engines is None:
+        from database import engine, read_engine, storage_engines
+        engines = {engine, read_engine, *storage_engines()}
+    profile = QueryProfile()
+    started = {}
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        started[id(conn)] = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        profile.record(statement, time.perf_counter() - started.pop(id(conn), time.perf_counter()))
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before)
+        event.listen(engine, "after_cursor_execute", after)
+    try:
+        yield profile
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before)
+            event.remove(engine, "after_cursor_execute", after)
+
+    if len(profile.queries) > max_count:
+        details = "\n".join(f"  {group['count']}x {group['statement']}" for group in profile.groups())
+        raise AssertionError(f"Expected at most {max_count} queries, got {len(profile.queries)}:\n{details}")
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+if pytest is not None:
+    @pytest.fixture
+    def max_queries():
+        """``with max_queries(3): client.get(...)`` fails the test when the block issues more than 3 queries"""
+        return assert_max_queries
@@ -0,0 +1,203 @@
+"""
+On-demand statistical profiler for the running worker.
+
+While a profile runs, a sampler thread reads the stack of every other thread
+with ``sys._current_frames()`` once per interval. Each stack is counted in
+the collapsed format that flamegraph.pl, speedscope and inferno read: one
+line per distinct stack, ``thread;outermost;...;innermost count``.
+
+In "cpu" mode a thread is only sampled if it used CPU time since the
+previous sample, according to its CPU clock, and is not caught waiting on a
+condition or in the event loop's selector, so idle threads drop out. "wall"
+mode samples every thread.
+
+Samples are attributed to routes. On the event loop thread, this uses the
+asyncio task that is running: ProfilerMiddleware remembers which request
+each task serves while a profile runs. On other threads, it uses the
+innermost frame of an endpoint function, which covers the plain ``def``
+endpoints FastAPI runs in its threadpool. Anything else is unattributed.
+
+Overhead is bounded in two ways. Samples are at least
+PROFILER_MIN_INTERVAL_MS apart. The sampler also spaces them further when
+taking them would use more than PROFILER_MAX_OVERHEAD of the wall time;
+the overhead it actually had is reported. Only one profile runs per worker
+at a time.
+"""
+from collections import Counter
+import asyncio
+import inspect
+import os
+import selectors
+import sys
+import threading
+import time
+
+from config import get_settings
+
+settings = get_settings()
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+UNATTRIBUTED = "(unattributed)"
+
+# Innermost frames of a thread that is blocked, even if it woke up since the last sample
+_WAITING = {threading.Condition.wait.__code__, selectors.DefaultSelector.select.__code__}
+
+class ProfilerBusy(Exception):
+    pass
+
+def _short_path(filename: str) -> str:
+    if filename.startswith(_ROOT):
+        return filename[len(_ROOT):]
+    marker = filename.rfind("site-packages" + os.sep)
+    if marker != -1:
+        return filename[marker + len("site-packages") + 1:]
+    return os.path.basename(filename)
+
+def route_codes(app, codes: dict = None) -> dict:
+    """Code object of every endpoint function -> its route path"""
+    codes = {} if codes is None else codes
+    for route in app.routes:
+        # Included routers keep their own routes, with the paths requests report
+        nested = getattr(route, "original_router", None) or (route if hasattr(route, "routes") else None)
+        if nested is not None:
+            route_codes(nested, codes)
+            continue
+        endpoint = getattr(route, "endpoint", None)
+        code = getattr(inspect.unwrap(endpoint), "__code__", None) if endpoint else None
+        if code is not None:
+            codes[code] = route.path
+    return codes
+
+class SamplingProfiler:
+    """Samples every thread's stack for a while; one profile at a time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Request scope of each asyncio task, kept only while profiling
+        self.task_scopes = {}
+        self.active = False
+        self._labels = {}
+
+    async def profile(self, seconds: float, interval: float, mode: str = "cpu", codes: dict = None) -> dict:
+        """Profile for ``seconds`` from a threadpool thread; raises ProfilerBusy if one is running"""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            self.active = True
+            loop = asyncio.get_running_loop()
+            loop_thread = threading.get_ident()
+            # Not run_in_threadpool: a profile must not hold a slot that requests need
+            return await asyncio.to_thread(self._run, seconds, interval, mode, loop, loop_thread, codes or {})
+        finally:
+            self.active = False
+            self.task_scopes.clear()
+            self._lock.release()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _stack(self, frame) -> list:
+        """Frame labels, outermost first, keeping the innermost PROFILER_MAX_DEPTH"""
+        labels = []
+        while frame is not None and len(labels) < settings.PROFILER_MAX_DEPTH:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        if frame is not None:
+            labels.append("(truncated)")
+        labels.reverse()
+        return labels
+
+    def _route(self, thread: int, frame, loop, loop_thread: int, codes: dict) -> str:
+        if thread == loop_thread:
+            scope = self.task_scopes.get(asyncio.current_task(loop))
+            if scope is None:
+                return UNATTRIBUTED
+            return getattr(scope.get("route"), "path", None) or scope["path"]
+        while frame is not None:
+            route = codes.get(frame.f_code)
+            if route:
+                return route
+            frame = frame.f_back
+        return UNATTRIBUTED
+
+    def _run(self, seconds: float, interval: float, mode: str, loop, loop_thread: int, codes: dict) -> dict:
+        me = threading.get_ident()
+        stacks = Counter()
+        routes = Counter()
+        cpu_clocks = {}
+        last_cpu = {}
+        samples = 0
+        sampling_time = 0.0
+
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread, frame in sys._current_frames().items():
+                if thread == me:
+                    continue
+                if mode == "cpu":
+                    try:
+                        if thread not in cpu_clocks:
+                            cpu_clocks[thread] = time.pthread_getcpuclockid(thread)
+                        cpu = time.clock_gettime(cpu_clocks[thread])
+                    except (AttributeError, OSError):
+                        # No per-thread CPU clock here, or the thread just exited
+                        cpu = None
+                    previous = last_cpu.get(thread)
+                    last_cpu[thread] = cpu
+                    if cpu is not None and (previous is None or cpu <= previous):
+                        continue
+                    if frame.f_code in _WAITING:
+                        continue
+                name = names.get(thread, str(thread))
+                stacks[";".join([name, *self._stack(frame)])] += 1
+                routes[self._route(thread, frame, loop, loop_thread, codes)] += 1
+            samples += 1
+            cost = time.perf_counter() - now
+            sampling_time += cost
+            # Keep cost / (cost + pause) within PROFILER_MAX_OVERHEAD
+            pause = max(interval - cost, cost / settings.PROFILER_MAX_OVERHEAD - cost)
+            time.sleep(max(0.0, min(pause, deadline - time.perf_counter())))
+        elapsed = time.perf_counter() - started
+
+        total = sum(routes.values())
+        return {
+            "pid": os.getpid(),
+            "mode": mode,
+            "seconds": round(elapsed, 3),
+            "interval_ms": interval * 1000,
+            "samples": samples,
+            "thread_samples": total,
+            "overhead_pct": round(sampling_time / elapsed * 100, 2) if elapsed else 0.0,
+            "collapsed": "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()),
+            "routes": [
+                {"route": route, "samples": count, "share": round(count / total, 4)}
+                for route, count in routes.most_common()
+            ],
+        }
+
+profiler = SamplingProfiler()
+
+class ProfilerMiddleware:
+    """Remembers the request each asyncio task is serving while a profile runs"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not profiler.active or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        task = asyncio.current_task()
+        profiler.task_scopes[task] = scope
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.task_scopes.pop(task, None)
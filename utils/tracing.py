@@ -0,0 +1,321 @@
+"""
+Request tracing in the OpenTelemetry data model.
+
+With TRACING_ENABLED, TracingMiddleware opens a server span for every HTTP
+request, continuing the trace of a W3C ``traceparent`` header when the caller
+sends one. ``span()`` opens child spans: check_access, the commit of the
+usage count and service log, the log writes and every call to an external
+SDK. The cursor hooks from ``instrument_engine`` add one span per SQL
+statement.
+
+Sampling is decided once, at the head of the trace. A ``traceparent`` from the
+caller decides it with its sampled flag. Otherwise a fraction of new traces,
+TRACING_SAMPLE_RATE, is kept, choosing by trace id as OpenTelemetry's
+TraceIdRatioBased sampler does. In a trace that is not sampled, ``span()``
+only reads a context variable and creates nothing. Sampled requests get a
+``traceresponse`` header carrying their trace and span id.
+
+The spans of a request are exported together when its server span ends.
+The file exporter appends one OTLP/JSON ``ExportTraceServiceRequest`` per
+line to TRACING_FILE, which the OpenTelemetry Collector's otlpjsonfile
+receiver can read; the writes happen on a background thread. The memory
+exporter keeps the spans in a list for tests.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+from config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# OTLP span kinds
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+
+_STATUS_ERROR = 2
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$")
+
+class Trace:
+    """The spans of one trace that finished in this process, in end order"""
+    __slots__ = ("trace_id", "spans")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans = []
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes",
+                 "error", "is_root")
+
+    def __init__(self, trace: Trace, name: str, kind: int = INTERNAL, parent_id: str = None,
+                 attributes: dict = None, start_ns: int = None, is_root: bool = False):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+        self.is_root = is_root
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exc: BaseException):
+        # Client errors raised as HTTPException are outcomes, not failures
+        status_code = getattr(exc, "status_code", None)
+        if isinstance(status_code, int) and status_code < 500:
+            self.attributes["http.response.status_code"] = status_code
+            return
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def end(self, end_ns: int = None):
+        self.end_ns = end_ns or time.time_ns()
+        self.trace.spans.append(self)
+        if self.is_root:
+            exporter.export(self.trace.spans)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": _STATUS_ERROR, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def to_otlp_request(spans: list) -> dict:
+    """An OTLP/JSON ExportTraceServiceRequest holding ``spans``"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": settings.TRACING_SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in spans]}],
+    }]}
+
+class InMemoryExporter:
+    """Keeps every exported span; for tests"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans: list):
+        self.spans.extend(spans)
+
+    def find(self, name: str) -> list:
+        return [span for span in self.spans if span.name == name]
+
+    def clear(self):
+        self.spans.clear()
+
+    def shutdown(self):
+        pass
+
+class FileExporter:
+    """Appends OTLP/JSON lines to ``path`` from a background thread"""
+
+    def __init__(self, path: str, queue_size: int):
+        self.path = path
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, spans: list):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            # Never hold a request up on the disk
+            self.dropped += len(spans)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _write(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                spans = self._queue.get()
+                if spans is None:
+                    return
+                try:
+                    f.write(json.dumps(to_otlp_request(spans), separators=(",", ":")) + "\n")
+                    if self._queue.empty():
+                        f.flush()
+                except Exception as e:
+                    logger.error(f"Error writing traces to {self.path}: {e}")
+
+    def shutdown(self):
+        """Write out the queued traces and stop the writer"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+def build_exporter():
+    if settings.TRACING_EXPORTER == "memory":
+        return InMemoryExporter()
+    if settings.TRACING_EXPORTER == "file":
+        return FileExporter(settings.TRACING_FILE, settings.TRACING_EXPORT_QUEUE_SIZE)
+    raise ValueError(f"Unknown TRACING_EXPORTER: {settings.TRACING_EXPORTER}")
+
+exporter = build_exporter()
+
+def set_exporter(new_exporter):
+    """Send traces to ``new_exporter`` from now on, e.g. an InMemoryExporter in tests"""
+    global exporter
+    exporter = new_exporter
+
+# The innermost open span of a sampled trace, if any
+current_span: ContextVar = ContextVar("current_span", default=None)
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, **attributes):
+    """A child span of the current span; yields None outside a sampled trace"""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, kind, parent.span_id, attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_exception(e)
+        raise
+    finally:
+        current_span.reset(token)
+        child.end()
+
+def parse_traceparent(header: str):
+    """(trace id, parent span id, sampled) from a traceparent header, or None if it is invalid"""
+    match = _TRACEPARENT.match(header.strip().lower()) if header else None
+    if not match:
+        return None
+    version, trace_id, parent_id, flags, rest = match.groups()
+    # Version ff is forbidden, all-zero ids are invalid, and version 00 has no trailing fields
+    if version == "ff" or trace_id == "0" * 32 or parent_id == "0" * 16 or (version == "00" and rest):
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+def should_sample(trace_id: str, rate: float = None) -> bool:
+    """Keep ``rate`` of traces, decided by the low 64 bits of the trace id"""
+    rate = settings.TRACING_SAMPLE_RATE if rate is None else rate
+    return int(trace_id[16:], 16) < rate * 2 ** 64
+
+class TracingMiddleware:
+    """Opens the server span of each sampled request and exports its trace when it ends"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        parent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                parent = parse_traceparent(value.decode("latin-1"))
+                break
+        if parent:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = should_sample(trace_id)
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+
+        root = Span(Trace(trace_id), scope["method"], SERVER, parent_id, {
+            "http.request.method": scope["method"],
+            "url.path": scope["path"],
+        }, is_root=True)
+        traceresponse = f"00-{trace_id}-{root.span_id}-01".encode()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                root.attributes["http.response.status_code"] = status_code
+                if status_code >= 500:
+                    root.error = f"HTTP {status_code}"
+                message["headers"] = [*message.get("headers", []), (b"traceresponse", traceresponse)]
+            await send(message)
+
+        token = current_span.set(root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            root.record_exception(e)
+            raise
+        finally:
+            current_span.reset(token)
+            # The router stores the matched route in the scope
+            route = getattr(scope.get("route"), "path", None)
+            if route:
+                root.name = f"{scope['method']} {route}"
+                root.attributes["http.route"] = route
+            root.end()
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_span.get() is not None:
+        conn.info["trace_start_ns"] = time.time_ns()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_statement(conn, statement)
+
+def _handle_error(exception_context):
+    if exception_context.connection is not None and exception_context.statement:
+        _record_statement(exception_context.connection, exception_context.statement, exception_context.original_exception)
+
+def _record_statement(conn, statement: str, error: BaseException = None):
+    started = conn.info.pop("trace_start_ns", None)
+    parent = current_span.get()
+    if started is None or parent is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "SQL"
+    statement_span = Span(parent.trace, operation, CLIENT, parent.span_id, {
+        "db.system": conn.engine.dialect.name,
+        "db.statement": statement[:settings.TRACING_MAX_STATEMENT_LENGTH],
+    }, start_ns=started)
+    if error is not None:
+        statement_span.record_exception(error)
+    statement_span.end()
+
+def instrument_engine(engine):
+    """Add a span for every SQL statement run through ``engine`` in a sampled trace"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)